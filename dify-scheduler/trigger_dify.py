@@ -1,15 +1,26 @@
+import argparse
+import base64
+import contextlib
+import hashlib
 import json
 import httpx
 import asyncio
 import logging
+import math
 import os
 import time
 import random
 import uuid
 import re
+import signal
+import unicodedata
+import sqlite3
 import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -30,6 +41,50 @@ BLOG_STORAGE_PATH = os.getenv("BLOG_STORAGE_PATH", "./blogs")
 IMAGE_SERVICE_URL = os.getenv("IMAGE_SERVICE_URL", "http://localhost:8000")
 AWS_REGION = os.getenv("AWS_REGION", "ap-southeast-1")
 DYNAMODB_TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME", "starry_book_blog")
+BLOG_COUNT = int(os.getenv("BLOG_COUNT", "100"))
+BLOG_CONCURRENCY = int(os.getenv("BLOG_CONCURRENCY", "5"))
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "pipeline")
+PIPELINE_STAGE_WORKERS = os.getenv("PIPELINE_STAGE_WORKERS", "")
+PIPELINE_QUEUE_FACTOR = int(os.getenv("PIPELINE_QUEUE_FACTOR", "2"))
+PIPELINE_STATS_INTERVAL = float(os.getenv("PIPELINE_STATS_INTERVAL", "60"))
+DIFY_TIMEOUT = float(os.getenv("DIFY_TIMEOUT", "120"))
+IMAGE_SERVICE_TIMEOUT = float(os.getenv("IMAGE_SERVICE_TIMEOUT", "30"))
+DIFY_RESPONSE_MODE = os.getenv("DIFY_RESPONSE_MODE", "blocking")
+DIFY_STREAM_READ_TIMEOUT = float(os.getenv("DIFY_STREAM_READ_TIMEOUT", "60"))
+RATE_INITIAL = float(os.getenv("RATE_INITIAL", "0.5"))
+RATE_MIN = float(os.getenv("RATE_MIN", "0.02"))
+RATE_MAX = float(os.getenv("RATE_MAX", "5"))
+RATE_STEP = float(os.getenv("RATE_STEP", "0.05"))
+RATE_LATENCY_TOLERANCE = float(os.getenv("RATE_LATENCY_TOLERANCE", "2.0"))
+SCHEDULER_JOURNAL_PATH = os.getenv("SCHEDULER_JOURNAL_PATH", os.path.join(os.path.dirname(__file__), 'scheduler_journal.db'))
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "3"))
+SLUG_INDEX_PATH = os.getenv("SLUG_INDEX_PATH", os.path.join(os.path.dirname(__file__), 'slug_index.json'))
+SLUG_INDEX_CAPACITY = int(os.getenv("SLUG_INDEX_CAPACITY", "100000"))
+# Articles rejected as near-duplicates are kept here instead of being discarded
+REJECTED_BLOG_PATH = os.getenv("REJECTED_BLOG_PATH", os.path.join(BLOG_STORAGE_PATH, "rejected"))
+# GSI with partition key `created_day` and sort key `created_at`; without it each refresh scans the whole table
+SLUG_INDEX_GSI = os.getenv("SLUG_INDEX_GSI", "")
+DIFY_MAX_ATTEMPTS = int(os.getenv("DIFY_MAX_ATTEMPTS", "3"))
+IMAGE_POLL_TIMEOUT = float(os.getenv("IMAGE_POLL_TIMEOUT", "150"))
+# Seconds the image service may hold each status request open (long-poll); 0 disables
+IMAGE_LONG_POLL_WAIT = float(os.getenv("IMAGE_LONG_POLL_WAIT", "25"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+BREAKER_MAX_RESET_TIMEOUT = float(os.getenv("BREAKER_MAX_RESET_TIMEOUT", "600"))
+BREAKER_MAX_WAIT = float(os.getenv("BREAKER_MAX_WAIT", "900"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_RESERVE = int(os.getenv("RETRY_BUDGET_RESERVE", "10"))
+SCHEDULER_CRON = os.getenv("SCHEDULER_CRON", "0 6 * * *")
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "0"))
+# Must stay below the stop grace period of the container runtime (Kubernetes waits 30s by default,
+# `docker stop` 10s) or the drain is cut off by SIGKILL; raise both together
+DAEMON_DRAIN_TIMEOUT = float(os.getenv("DAEMON_DRAIN_TIMEOUT", "8"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_WARM_CONNECTIONS = int(os.getenv("HTTP_WARM_CONNECTIONS", "4"))
+DYNAMODB_FLUSH_INTERVAL = float(os.getenv("DYNAMODB_FLUSH_INTERVAL", "0.5"))
+DYNAMODB_WRITE_CONCURRENCY = int(os.getenv("DYNAMODB_WRITE_CONCURRENCY", "2"))
 
 # Authors and colors list
 AUTHORS = ["Whit", "LunaGaze", "Daisy", "Lily", "Emma", "Joy", "Mia", "AvaStar", "Maya", "Emily"]
@@ -57,47 +112,731 @@ def generate_slug(title):
     slug = slug.strip('-')
     return slug
 
-def save_blog(content, idx):
+# Articles and conjunctions ignored when comparing titles for near-duplicates. Words that change
+# the meaning ("how", "why", "you"...) are kept: dropping them made distinct titles collide
+TITLE_STOPWORDS = {"a", "an", "the", "and", "or", "but", "nor"}
+# Bumped whenever normalize_title changes; a saved index with other title keys is rebuilt
+TITLE_KEY_VERSION = 2
+
+def normalize_title(title):
+    """Normalize a title so near-identical titles compare equal"""
+    text = unicodedata.normalize("NFKC", title).lower()
+    words = [w for w in re.findall(r'\w+', text) if w not in TITLE_STOPWORDS]
+    return " ".join(words)
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, using double hashing of one blake2b digest"""
+
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None and len(bits) == (self.size + 7) // 8 else bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class SlugIndex:
+    """In-process index of existing slugs and normalized titles.
+
+    Lookups go through a Bloom filter first, which answers most "new slug"
+    checks without touching the exact maps; the exact maps (key -> blog uid)
+    settle the rest. The index is persisted to a JSON file and refreshed from
+    DynamoDB: incrementally through the SLUG_INDEX_GSI day index when it is
+    configured, otherwise with a full table scan.
+
+    A claim stays pending until the blog's DynamoDB write succeeds. Only
+    committed claims are persisted, so a failed or abandoned blog does not
+    block its title.
+    """
+
+    def __init__(self, path, capacity=SLUG_INDEX_CAPACITY):
+        self.path = path
+        self.slugs = {}
+        self.titles = {}
+        self.watermark = ""
+        self.bloom = BloomFilter(capacity)
+        # Claims of blogs not written yet: key -> blog uid, and blog uid -> (slug, title key)
+        self.pending_slugs = {}
+        self.pending_titles = {}
+        self.claims = {}
+        self.stats = {"bloom_negatives": 0, "exact_hits": 0, "suffixed": 0, "rejected": 0}
+
+    def _add(self, slug, title_key, blog_uid):
+        if slug:
+            self.slugs.setdefault(slug, blog_uid)
+            self.bloom.add("s:" + slug)
+        if title_key:
+            self.titles.setdefault(title_key, blog_uid)
+            self.bloom.add("t:" + title_key)
+        if len(self.slugs) + len(self.titles) > self.bloom.capacity:
+            self._rebuild_bloom(self.bloom.capacity * 2)
+
+    def _rebuild_bloom(self, capacity):
+        self.bloom = BloomFilter(capacity)
+        for slug in self.slugs:
+            self.bloom.add("s:" + slug)
+        for title_key in self.titles:
+            self.bloom.add("t:" + title_key)
+
+    def _owner(self, mapping, prefix, key):
+        pending = (self.pending_slugs if prefix == "s:" else self.pending_titles).get(key)
+        if pending is not None:
+            return pending
+        if prefix + key not in self.bloom:
+            self.stats["bloom_negatives"] += 1
+            return None
+        owner = mapping.get(key)
+        if owner is not None:
+            self.stats["exact_hits"] += 1
+        return owner
+
+    def claim(self, title, slug, blog_uid):
+        """Reserve a unique slug for a blog.
+
+        Returns the slug to use (suffixed with -2, -3, ... when taken), or
+        None when another blog already has a near-identical title. Claims
+        are idempotent per blog uid, so a retried write gets the same slug.
+        The claim is pending until commit() or release().
+        """
+        self.release(blog_uid)
+        title_key = normalize_title(title)
+        owner = self._owner(self.titles, "t:", title_key) if title_key else None
+        if owner is not None and owner != blog_uid:
+            self.stats["rejected"] += 1
+            return None
+
+        base = slug or blog_uid[:8]
+        candidate, n = base, 1
+        while True:
+            owner = self._owner(self.slugs, "s:", candidate)
+            if owner is None or owner == blog_uid:
+                break
+            n += 1
+            candidate = f"{base}-{n}"
+        if candidate != base:
+            self.stats["suffixed"] += 1
+        self.claims[blog_uid] = (candidate, title_key)
+        self.pending_slugs[candidate] = blog_uid
+        if title_key:
+            self.pending_titles[title_key] = blog_uid
+        return candidate
+
+    def commit(self, blog_uid):
+        """Record a pending claim in the index once its blog is written"""
+        claim = self.claims.get(blog_uid)
+        if claim:
+            self._add(*claim, blog_uid)
+            self.release(blog_uid)
+
+    def release(self, blog_uid):
+        """Drop a pending claim, freeing its slug and title"""
+        claim = self.claims.pop(blog_uid, None)
+        if claim:
+            slug, title_key = claim
+            if self.pending_slugs.get(slug) == blog_uid:
+                del self.pending_slugs[slug]
+            if self.pending_titles.get(title_key) == blog_uid:
+                del self.pending_titles[title_key]
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("title_key_version") != TITLE_KEY_VERSION:
+            logger.info(f"Slug index {self.path} was built with other title normalization, rebuilding it")
+            return False
+        self.slugs = data.get("slugs", {})
+        self.titles = data.get("titles", {})
+        self.watermark = data.get("watermark", "")
+        bloom = data.get("bloom") or {}
+        self.bloom = BloomFilter(bloom.get("capacity", self.bloom.capacity), bits=bytearray(base64.b64decode(bloom.get("bits", ""))))
+        if len(self.slugs) + len(self.titles) > self.bloom.capacity or not bloom.get("bits"):
+            self._rebuild_bloom(max(self.bloom.capacity, 2 * (len(self.slugs) + len(self.titles))))
+        return True
+
+    def save(self):
+        data = {
+            "title_key_version": TITLE_KEY_VERSION,
+            "watermark": self.watermark,
+            "slugs": self.slugs,
+            "titles": self.titles,
+            "bloom": {"capacity": self.bloom.capacity, "bits": base64.b64encode(bytes(self.bloom.bits)).decode("ascii")},
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _paginate(operation, kwargs):
+        items = []
+        while True:
+            response = operation(**kwargs)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                return items
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _load_items(self, watermark):
+        """Fetch blogs created after `watermark`; returns (items, incremental)"""
+        table = boto3.resource('dynamodb', region_name=AWS_REGION).Table(DYNAMODB_TABLE_NAME)
+        projection = {"ProjectionExpression": "uid, slug, title, created_at"}
+        if not (SLUG_INDEX_GSI and watermark):
+            # A scan reads (and is billed for) every item, filtered or not
+            return self._paginate(table.scan, projection), False
+        items = []
+        day = datetime.strptime(watermark[:10], "%Y-%m-%d").date()
+        today = datetime.now().date()
+        while day <= today:
+            items += self._paginate(table.query, dict(
+                projection,
+                IndexName=SLUG_INDEX_GSI,
+                KeyConditionExpression=Key("created_day").eq(day.isoformat()) & Key("created_at").gt(watermark),
+            ))
+            day += timedelta(days=1)
+        return items, True
+
+    async def refresh(self):
+        """Bring the index up to date with DynamoDB, off the event loop"""
+        items, incremental = await asyncio.to_thread(self._load_items, self.watermark)
+        for item in items:
+            self._add(item.get("slug", ""), normalize_title(item.get("title", "")), item.get("uid", ""))
+            self.watermark = max(self.watermark, item.get("created_at", ""))
+        kind = "incrementally" if incremental else "by full scan"
+        logger.info(f"Slug index refreshed {kind} with {len(items)} blog(s): {len(self.slugs)} slugs, {len(self.titles)} titles")
+
+# Slug index of the current run; None when disabled
+slug_index = None
+
+@contextlib.asynccontextmanager
+async def open_slug_index():
+    """Load the slug index, bring it up to date and persist it at the end of the run"""
+    global slug_index
+    if not SLUG_INDEX_PATH:
+        yield None
+        return
+    index = SlugIndex(SLUG_INDEX_PATH)
+    try:
+        index.load()
+    except Exception as e:
+        logger.error(f"Failed to load slug index {SLUG_INDEX_PATH}, rebuilding: {str(e)}")
+        index = SlugIndex(SLUG_INDEX_PATH)
+    try:
+        await index.refresh()
+    except Exception as e:
+        logger.error(f"Failed to refresh slug index from DynamoDB: {str(e)}", exc_info=True)
+    slug_index = index
+    try:
+        yield index
+    finally:
+        slug_index = None
+        logger.info(f"Slug index stats: {index.stats}")
+        try:
+            index.save()
+        except Exception as e:
+            logger.error(f"Failed to save slug index: {str(e)}", exc_info=True)
+
+def save_blog(content, idx, root=BLOG_STORAGE_PATH):
     """Save blog content to Markdown file"""
     date_str = datetime.now().strftime("%Y-%m-%d")
-    dir_path = os.path.join(BLOG_STORAGE_PATH, date_str)
+    dir_path = os.path.join(root, date_str)
     os.makedirs(dir_path, exist_ok=True)
     file_path = os.path.join(dir_path, f"blog_{idx}.md")
     with open(file_path, "w", encoding="utf-8") as f:
         f.write(content)
     logger.info(f"Blog saved: {file_path}")
+    return file_path
+
+class UpstreamPool:
+    """Long-lived pooled httpx client for one upstream, with connection stats"""
+
+    def __init__(self, name, base_url, max_connections, timeout):
+        self.name = name
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "tls_handshakes": 0,
+            "connect_failures": 0,
+        }
+        self.client = httpx.AsyncClient(
+            verify=False,  # Disable certificate verification
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [self._on_request], "response": [self._on_response]},
+        )
+
+    async def _on_request(self, request):
+        self.stats["requests"] += 1
+        request.extensions["trace"] = self._trace
+        request.extensions["started_at"] = time.monotonic()
+
+    async def _on_response(self, response):
+        # Status, latency and Retry-After of every response drive the rate controller.
+        # A long-poll is held open by design, so its duration says nothing about upstream health
+        request = response.request
+        latency = None if request.extensions.get("long_poll") else (
+            time.monotonic() - request.extensions.get("started_at", time.monotonic())
+        )
+        get_rate_controller().observe(
+            f"{self.name} {request.method}",
+            response.status_code,
+            latency,
+            parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+    async def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.stats["connections_opened"] += 1
+        elif event == "connection.connect_tcp.failed":
+            self.stats["connect_failures"] += 1
+        elif event == "connection.start_tls.complete":
+            self.stats["tls_handshakes"] += 1
+
+        # Connect failures and timeouts waiting for a response count as congestion
+        if event.endswith((".connect_tcp.failed", ".start_tls.failed", ".receive_response_headers.failed")):
+            if isinstance(info.get("exception"), Exception):
+                get_rate_controller().observe(self.name, None, 0.0)
+
+    def summary(self):
+        stats = dict(self.stats)
+        stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+        return stats
+
+    async def warm(self, connections):
+        """Open up to `connections` keep-alive connections before the batch starts"""
+        parsed = httpx.URL(self.base_url)
+        origin = f"{parsed.scheme}://{parsed.netloc.decode()}/"
+
+        async def probe():
+            try:
+                # Any response will do: the point is the TCP+TLS handshake
+                await self.client.get(origin, timeout=10.0)
+            except Exception as e:
+                logger.warning(f"Warming {self.name} pool failed: {str(e)}")
+
+        await asyncio.gather(*(probe() for _ in range(min(connections, self.max_connections))))
+        logger.info(f"Warmed {self.name} pool: {self.summary()}")
+
+    async def aclose(self):
+        await self.client.aclose()
+        logger.info(f"Closed {self.name} pool: {self.summary()}")
+
+# Upstream pools shared by every blog in the run, keyed by upstream name
+upstream_pools = {}
+
+def get_pool(name):
+    """Return the pool opened for an upstream by `open_upstream_pools`"""
+    try:
+        return upstream_pools[name]
+    except KeyError:
+        raise RuntimeError(f"Upstream pool '{name}' is not open; run inside open_upstream_pools()") from None
+
+@contextlib.asynccontextmanager
+async def open_upstream_pools(dify_connections, image_connections):
+    """Create, warm and finally close one connection pool per upstream"""
+    upstream_pools["dify"] = UpstreamPool("dify", DIFY_WORKFLOW_API_URL, dify_connections, DIFY_TIMEOUT)
+    upstream_pools["image"] = UpstreamPool("image", IMAGE_SERVICE_URL, image_connections, IMAGE_SERVICE_TIMEOUT)
+    try:
+        await asyncio.gather(*(pool.warm(HTTP_WARM_CONNECTIONS) for pool in upstream_pools.values()))
+        yield upstream_pools
+    finally:
+        pools = list(upstream_pools.values())
+        upstream_pools.clear()
+        for pool in pools:
+            await pool.aclose()
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveRateController:
+    """Token bucket plus in-flight limit tuned by additive-increase/multiplicative-decrease.
+
+    Every upstream response is fed to `observe()`. Successes within the latency
+    tolerance raise the start rate and the in-flight limit a little; a 429, a
+    5xx or a transport error halves both, at most once per cooldown window, and
+    a Retry-After header pauses new starts until it expires.
+    """
+
+    def __init__(self, max_in_flight, initial_rate=RATE_INITIAL, min_rate=RATE_MIN, max_rate=RATE_MAX,
+                 rate_step=RATE_STEP, latency_tolerance=RATE_LATENCY_TOLERANCE, decrease_cooldown=5.0):
+        self.max_in_flight = max_in_flight
+        self.limit = float(max(1, max_in_flight // 2))
+        self.rate = min(max(initial_rate, min_rate), max_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.latency_tolerance = latency_tolerance
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self.tokens = 1.0
+        self.paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        # Per-upstream latency baseline (EWMA)
+        self._latency = {}
+        self._changed = asyncio.Event()
+        self.stats = {"increases": 0, "decreases": 0, "retry_after_pauses": 0}
+
+    def _refill(self, now):
+        self.tokens = min(1.0 + self.rate, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        """Wait for a token, a free in-flight slot and the end of any Retry-After pause"""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                wait = self.paused_until - now
+            elif self.in_flight >= int(self.limit):
+                wait = None
+            elif self.tokens < 1.0:
+                wait = (1.0 - self.tokens) / self.rate
+            else:
+                self.tokens -= 1.0
+                self.in_flight += 1
+                return
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        self.in_flight -= 1
+        self._changed.set()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def observe(self, upstream, status_code, latency, retry_after=None):
+        """Feed one upstream response; status_code is None for transport errors, latency None for long-polls"""
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.stats["retry_after_pauses"] += 1
+            logger.warning(f"{upstream} asked to retry after {retry_after:.1f}s, pausing new blogs")
+
+        if status_code is None or status_code == 429 or status_code >= 500:
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self._last_decrease = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.limit = max(1.0, self.limit / 2)
+                self.stats["decreases"] += 1
+                logger.warning(f"{upstream} returned {status_code or 'a transport error'}, backing off: "
+                               f"rate {self.rate:.2f}/s, in-flight limit {int(self.limit)}")
+            self._changed.set()
+            return
+
+        if latency is not None:
+            baseline = self._latency.get(upstream)
+            self._latency[upstream] = latency if baseline is None else 0.8 * baseline + 0.2 * latency
+            if baseline is not None and latency > baseline * self.latency_tolerance:
+                # Upstream is slowing down: hold the current rate
+                return
+        if status_code < 400:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+            # One extra slot per "window" of successful responses, as in TCP congestion avoidance
+            self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+            self.stats["increases"] += 1
+            self._changed.set()
+
+    def summary(self):
+        return dict(self.stats, rate=round(self.rate, 2), limit=int(self.limit), in_flight=self.in_flight)
+
+# Rate controller shared by every blog in the run
+rate_controller = None
+
+def get_rate_controller():
+    """Return the run's rate controller, creating a default one on first use"""
+    global rate_controller
+    if rate_controller is None:
+        rate_controller = AdaptiveRateController(BLOG_CONCURRENCY)
+    return rate_controller
+
+class UpstreamError(Exception):
+    """A failed upstream call; retryable errors also count against the circuit breaker"""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def raise_for_upstream_status(response):
+    """Turn an error response into an UpstreamError; 429 and 5xx are retryable"""
+    if response.status_code < 400:
+        return
+    retryable = response.status_code == 429 or response.status_code >= 500
+    raise UpstreamError(
+        f"{response.request.method} {response.request.url} returned {response.status_code}: {response.text[:500]}",
+        retryable=retryable,
+        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+    )
+
+class CircuitBreaker:
+    """Per-upstream circuit breaker (closed -> open -> half-open -> closed).
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    callers wait in `wait_until_available()` instead of hammering the
+    upstream. Once `reset_timeout` has passed a single probe is let through
+    (half-open): success closes the circuit, failure re-opens it with a
+    doubled timeout, capped at `max_reset_timeout`.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 max_reset_timeout=BREAKER_MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe_in_flight = False
+        self._changed = asyncio.Event()
+        self.stats = {"opened": 0, "half_opened": 0, "closed": 0, "rejected": 0, "failures": 0}
+
+    def _transition(self, state):
+        message = f"Circuit '{self.name}' {self.state} -> {state}"
+        self.state = state
+        if state == "open":
+            self.opened_until = time.monotonic() + self.reset_timeout
+            self.stats["opened"] += 1
+            message += f", next probe in {self.reset_timeout:.1f}s"
+        elif state == "half-open":
+            self.stats["half_opened"] += 1
+        else:
+            self.stats["closed"] += 1
+        logger.warning(message)
+        self._changed.set()
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() >= self.opened_until:
+            self._transition("half-open")
+        if self.state == "half-open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    async def wait_until_available(self, timeout):
+        """Wait while the circuit is open; False if it is still unavailable after `timeout` seconds"""
+        deadline = time.monotonic() + timeout
+        while not self.allow():
+            now = time.monotonic()
+            if now >= deadline:
+                self.stats["rejected"] += 1
+                return False
+            wake = self.opened_until - now if self.state == "open" else deadline - now
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(0.01, min(wake, deadline - now)))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != "closed":
+            self.probe_in_flight = False
+            self.reset_timeout = self.base_reset_timeout
+            self._transition("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self.stats["failures"] += 1
+        if self.state == "half-open":
+            self.probe_in_flight = False
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self._transition("open")
+        elif self.state == "closed" and self.failures >= self.failure_threshold:
+            self._transition("open")
+
+    def release_probe(self):
+        # A cancelled or inconclusive probe proves nothing; let the next caller probe instead
+        if self.state == "half-open" and self.probe_in_flight:
+            self.probe_in_flight = False
+            self._changed.set()
+
+class RetryBudget:
+    """Caps retries at a fraction of requests so retries cannot multiply an outage"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, reserve=RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+
+    def record_request(self):
+        self.balance = min(self.balance + self.ratio, self.reserve + 100 * self.ratio)
+
+    def try_spend(self):
+        if self.balance >= 1.0:
+            self.balance -= 1.0
+            return True
+        return False
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than the upstream's Retry-After"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+circuit_breakers = {"dify": CircuitBreaker("dify"), "image": CircuitBreaker("image")}
+retry_budgets = {"dify": RetryBudget(), "image": RetryBudget()}
+
+async def call_with_breaker(upstream, attempt_fn, description, max_attempts):
+    """Run `attempt_fn` behind the upstream's circuit breaker with jittered retries.
+
+    Returns the result, or None once the attempts or the retry budget run
+    out, a non-retryable error occurs, or the circuit stays open longer
+    than BREAKER_MAX_WAIT.
+    """
+    breaker = circuit_breakers[upstream]
+    budget = retry_budgets[upstream]
+    for attempt in range(max_attempts):
+        if not await breaker.wait_until_available(BREAKER_MAX_WAIT):
+            logger.error(f"{description}: circuit '{upstream}' still open after {BREAKER_MAX_WAIT:.0f}s, failing fast")
+            return None
+        budget.record_request()
+        try:
+            result = await attempt_fn()
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except UpstreamError as e:
+            if e.retryable:
+                breaker.record_failure()
+            else:
+                # The upstream answered, it just did not like this request
+                breaker.record_success()
+            logger.error(f"{description} failed (attempt {attempt+1}/{max_attempts}): {str(e)}")
+            if not e.retryable or attempt == max_attempts - 1:
+                return None
+            if not budget.try_spend():
+                logger.error(f"{description}: retry budget for '{upstream}' exhausted, giving up")
+                return None
+            delay = backoff_delay(attempt, e.retry_after)
+            logger.info(f"Retrying {description} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            breaker.release_probe()
+            logger.error(f"{description} failed: {str(e)}", exc_info=True)
+            return None
+        else:
+            breaker.record_success()
+            return result
+    return None
 
 async def get_image_urls(task_id):
-    """Get image generation service results via task_id"""
+    """Get image generation service results via task_id
+
+    Each request long-polls: the image service answers as soon as the task
+    changes state, or after IMAGE_LONG_POLL_WAIT seconds. Servers that answer
+    an unfinished task straight away get the old fixed-interval polling.
+
+    Returns the URLs, None when the task finished without images (FAILED,
+    ERROR or TIMEOUT), or [] when polling gave up before the task finished.
+    """
     logger.info(f"Starting to query image task status: {task_id}")
-    max_attempts = 30  # Maximum 30 attempts
-    wait_time = 5  # Wait 5 seconds between attempts
-    
-    async with httpx.AsyncClient(timeout=30.0, verify=False) as client:
-        for attempt in range(max_attempts):
-            try:
+    wait_time = 5  # Wait 5 seconds between polls when the server does not long-poll
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + IMAGE_POLL_TIMEOUT
+    breaker = circuit_breakers["image"]
+    budget = retry_budgets["image"]
+    errors = 0
+
+    client = get_pool("image").client
+    attempt = 0
+    while loop.time() < deadline:
+        attempt += 1
+        # Pause while the image service circuit is open instead of burning attempts
+        if not await breaker.wait_until_available(deadline - loop.time()):
+            logger.error(f"Image service circuit still open, giving up on task {task_id}")
+            return []
+        budget.record_request()
+        long_poll = min(IMAGE_LONG_POLL_WAIT, max(0.0, deadline - loop.time()))
+        started = loop.time()
+        try:
+            if long_poll >= 1:
+                response = await client.get(
+                    f"{IMAGE_SERVICE_URL}/task/{task_id}",
+                    params={"wait": int(long_poll)},
+                    timeout=IMAGE_SERVICE_TIMEOUT + long_poll,
+                    extensions={"long_poll": True}
+                )
+            else:
                 response = await client.get(f"{IMAGE_SERVICE_URL}/task/{task_id}")
-                response.raise_for_status()
-                result = response.json()
-                
-                logger.info(f"Image task status query result: {result}")
-                
-                # If task is complete and has image URLs
-                if result.get("status") == "COMPLETED" and result.get("image_urls"):
-                    logger.info(f"Image generation successful, got URLs: {result['image_urls']}")
-                    return result['image_urls']
-                
-                # If task failed
-                if result.get("status") in ["FAILED", "ERROR", "TIMEOUT"]:
-                    logger.error(f"Image task failed: {result.get('error', 'Unknown error')}")
-                    return []
-                
-                logger.info(f"Image task in progress ({attempt+1}/{max_attempts}), waiting {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
-            except Exception as e:
-                logger.error(f"Error querying image task status: {str(e)}")
-                await asyncio.sleep(wait_time)
-    
+            raise_for_upstream_status(response)
+            result = response.json()
+            breaker.record_success()
+            errors = 0
+
+            logger.info(f"Image task status query result: {result}")
+
+            # If task is complete and has image URLs
+            if result.get("status") == "COMPLETED" and result.get("image_urls"):
+                logger.info(f"Image generation successful, got URLs: {result['image_urls']}")
+                return result['image_urls']
+
+            # If task failed
+            if result.get("status") in ["FAILED", "ERROR", "TIMEOUT"]:
+                logger.error(f"Image task failed: {result.get('error', 'Unknown error')}")
+                return None
+
+            if loop.time() - started >= 1:
+                logger.info(f"Image task still in progress after long-poll {attempt}")
+                continue
+            logger.info(f"Image task in progress (poll {attempt}), waiting {wait_time} seconds...")
+            await asyncio.sleep(min(wait_time, max(0.0, deadline - loop.time())))
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if isinstance(e, httpx.TransportError) or (isinstance(e, UpstreamError) and e.retryable):
+                breaker.record_failure()
+            else:
+                breaker.release_probe()
+            logger.error(f"Error querying image task status: {str(e)}")
+            if not budget.try_spend():
+                logger.error(f"Retry budget for the image service exhausted, giving up on task {task_id}")
+                return []
+            await asyncio.sleep(min(backoff_delay(errors, getattr(e, "retry_after", None)), max(0.0, deadline - loop.time())))
+            errors += 1
+
     logger.warning(f"Waiting for image generation timed out, task ID: {task_id}")
     return []
 
@@ -129,8 +868,222 @@ def get_image_urls_by_type(image_urls, unique_id):
     
     return card_url, cover_url, org_url
 
-def save_blog_to_db(blog_data, image_urls):
-    """Save blog content and image URLs to DynamoDB"""
+class DynamoBatchWriter:
+    """Coalesces DynamoDB puts into BatchWriteItem calls run off the event loop"""
+
+    # Error codes worth retrying for the whole batch
+    RETRYABLE_ERRORS = {
+        "ProvisionedThroughputExceededException",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "InternalServerError",
+        "ServiceUnavailable",
+    }
+
+    def __init__(self, table_name, region_name, batch_size=25, flush_interval=0.5,
+                 max_retries=5, concurrency=2):
+        self.table_name = table_name
+        self.region_name = region_name
+        # BatchWriteItem accepts at most 25 items per call
+        self.batch_size = min(batch_size, 25)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self._client = None
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._flushes = set()
+        self._runner = None
+        self._unacknowledged = 0
+        self.stats = {"items": 0, "batches": 0, "unprocessed_retries": 0, "failed_items": 0}
+
+    def _get_client(self):
+        # The resource's client accepts plain Python types, and clients are thread safe
+        if self._client is None:
+            dynamodb = boto3.resource(
+                'dynamodb',
+                region_name=self.region_name,
+                config=Config(max_pool_connections=self.concurrency * 2),
+            )
+            self._client = dynamodb.meta.client
+        return self._client
+
+    async def start(self):
+        """Create the cached client off the event loop and start the flusher"""
+        await asyncio.to_thread(self._get_client)
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def put(self, item):
+        """Queue an item and wait until DynamoDB acknowledges it; returns success"""
+        if self._runner is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._unacknowledged += 1
+        try:
+            await self._queue.put((item, future))
+            return await future
+        finally:
+            self._unacknowledged -= 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._flushes.discard(task)
+        self._slots.release()
+
+    def _batch_write(self, items):
+        return self._get_client().batch_write_item(
+            RequestItems={self.table_name: [{"PutRequest": {"Item": item}} for item in items]}
+        )
+
+    def _put_item(self, item):
+        return self._get_client().put_item(TableName=self.table_name, Item=item)
+
+    @staticmethod
+    def _resolve(futures, success):
+        for future in futures:
+            if not future.done():
+                future.set_result(success)
+
+    async def _flush(self, batch):
+        # BatchWriteItem rejects duplicate keys, so repeated puts of one uid are merged:
+        # the last item is written and every caller that queued it gets the same result
+        pending = {}
+        for item, future in batch:
+            futures = pending[item["uid"]][1] if item["uid"] in pending else []
+            futures.append(future)
+            pending[item["uid"]] = (item, futures)
+        retry_delay = 0.5
+        for attempt in range(self.max_retries):
+            try:
+                response = await asyncio.to_thread(self._batch_write, [item for item, _ in pending.values()])
+                self.stats["batches"] += 1
+                unprocessed = {
+                    request["PutRequest"]["Item"]["uid"]
+                    for request in response.get("UnprocessedItems", {}).get(self.table_name, [])
+                }
+                for uid in list(pending):
+                    if uid not in unprocessed:
+                        _, futures = pending.pop(uid)
+                        self.stats["items"] += 1
+                        self._resolve(futures, True)
+                if not pending:
+                    logger.info(f"DynamoDB batch write of {len(batch)} item(s) succeeded")
+                    return
+                self.stats["unprocessed_retries"] += 1
+                logger.warning(f"DynamoDB left {len(pending)} item(s) unprocessed (attempt {attempt+1}/{self.max_retries})")
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                error_message = e.response['Error']['Message']
+                if error_code not in self.RETRYABLE_ERRORS:
+                    # Usually one bad item (too large, invalid attribute) rejects the whole
+                    # batch: write the items one by one so only that item fails
+                    logger.error(f"DynamoDB batch_write_item failed, error: {error_code} - {error_message}; "
+                                 f"writing {len(pending)} item(s) individually")
+                    await self._put_individually(pending)
+                    return
+                logger.warning(f"DynamoDB batch_write_item failed (attempt {attempt+1}/{self.max_retries}), error: {error_code} - {error_message}")
+            except Exception as e:
+                logger.error(f"DynamoDB batch_write_item failed: {str(e)}; writing {len(pending)} item(s) individually",
+                             exc_info=True)
+                await self._put_individually(pending)
+                return
+            if attempt < self.max_retries - 1:
+                # Full jitter keeps concurrent flushes from retrying in lockstep
+                await asyncio.sleep(random.uniform(0, retry_delay))
+                retry_delay = min(retry_delay * 2, 10)
+
+        for _, futures in pending.values():
+            self.stats["failed_items"] += 1
+            self._resolve(futures, False)
+
+    async def _put_individually(self, pending):
+        """Write each pending item with its own PutItem, retrying only throttling and server errors"""
+        for uid, (item, futures) in pending.items():
+            retry_delay = 0.5
+            success = False
+            for attempt in range(self.max_retries):
+                try:
+                    await asyncio.to_thread(self._put_item, item)
+                    success = True
+                    break
+                except ClientError as e:
+                    error_code = e.response['Error']['Code']
+                    logger.error(f"DynamoDB put_item for {uid} failed (attempt {attempt+1}/{self.max_retries}), "
+                                 f"error: {error_code} - {e.response['Error']['Message']}")
+                    if error_code not in self.RETRYABLE_ERRORS:
+                        break
+                except Exception as e:
+                    logger.error(f"DynamoDB put_item for {uid} failed: {str(e)}", exc_info=True)
+                    break
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(random.uniform(0, retry_delay))
+                    retry_delay = min(retry_delay * 2, 10)
+            self.stats["items" if success else "failed_items"] += 1
+            self._resolve(futures, success)
+
+    async def aclose(self):
+        """Flush everything still queued, then stop the flusher"""
+        while self._unacknowledged:
+            await asyncio.sleep(self.flush_interval)
+        if self._runner:
+            self._runner.cancel()
+            self._runner = None
+        logger.info(f"DynamoDB writer closed: {self.stats}")
+
+# Batch writer shared by every blog in the run
+db_writer = None
+
+def get_db_writer():
+    """Return the run's DynamoDB writer, creating it on first use"""
+    global db_writer
+    if db_writer is None:
+        db_writer = DynamoBatchWriter(
+            DYNAMODB_TABLE_NAME,
+            AWS_REGION,
+            flush_interval=DYNAMODB_FLUSH_INTERVAL,
+            concurrency=DYNAMODB_WRITE_CONCURRENCY,
+        )
+    return db_writer
+
+@contextlib.asynccontextmanager
+async def open_db_writer():
+    """Start the DynamoDB writer for a run and drain it at the end"""
+    global db_writer
+    writer = get_db_writer()
+    try:
+        await writer.start()
+    except Exception as e:
+        logger.error(f"Error setting up DynamoDB connection: {str(e)}", exc_info=True)
+    try:
+        yield writer
+    finally:
+        await writer.aclose()
+        db_writer = None
+
+async def save_blog_to_db(blog_data, image_urls, blog_uid=None):
+    """Save blog content and image URLs to DynamoDB.
+
+    Returns True when the write was acknowledged, False when it failed and
+    None when the blog was rejected as a duplicate of an existing one.
+    """
     try:
         # Parse blog data
         blog_text = json.loads(blog_data.get("text", "{}"))
@@ -146,88 +1099,85 @@ def save_blog_to_db(blog_data, image_urls):
         keyword = keywords.split(',')[0].strip() if keywords else ""
         
         # Generate other necessary fields
-        blog_uid = str(uuid.uuid4())
+        blog_uid = blog_uid or str(uuid.uuid4())
         author = random.choice(AUTHORS)
         avatar = f"https://sparkle-web-static.s3.ap-southeast-1.amazonaws.com/starrybook/image/blog-authors/{author}.webp"
         color = random.choice(COLORS)
-        created_at = updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = datetime.now()
+        created_at = updated_at = now.strftime("%Y-%m-%d %H:%M:%S")
         published = True
         slug = generate_slug(title)
+        if slug_index:
+            # O(1) in-process check against every existing slug and title
+            unique_slug = slug_index.claim(title, slug, blog_uid)
+            if unique_slug is None:
+                logger.warning(f"Skipping blog '{title}': a blog with a near-identical title already exists")
+                return None
+            if unique_slug != slug:
+                logger.info(f"Slug '{slug}' already taken, using '{unique_slug}'")
+            slug = unique_slug
         
         # Get image URLs for all three types
         card_url, cover_url, org_url = get_image_urls_by_type(image_urls, blog_uid)
         
-        # Create a DynamoDB client
-        try:
-            # Connect to DynamoDB
-            dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-            table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-            
-            # Prepare item data for DynamoDB
-            item = {
-                'uid': blog_uid,
-                'author': author,
-                'avatar': avatar,
-                'card': card_url,
-                'color': color,
-                'content': content,
-                'cover': cover_url,
-                'created_at': created_at,
-                'description': description,
-                'keyword': keyword,
-                'keywords': keywords,
-                'org': org_url,
-                'published': published,
-                'slug': slug,
-                'tag': tag,
-                'title': title,
-                'updated_at': updated_at
-            }
-            
-            # Put item into DynamoDB table
-            max_retries = 3
-            retry_delay = 2
-            
-            for attempt in range(max_retries):
-                try:
-                    response = table.put_item(Item=item)
-                    logger.info(f"Successfully saved blog '{title}' to DynamoDB, ID: {blog_uid}")
-                    logger.info(f"DynamoDB response: {response}")
-                    return True
-                except ClientError as e:
-                    error_code = e.response['Error']['Code']
-                    error_message = e.response['Error']['Message']
-                    
-                    if attempt < max_retries - 1:
-                        logger.warning(f"DynamoDB put_item failed (attempt {attempt+1}/{max_retries}), error: {error_code} - {error_message}, retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                    else:
-                        logger.error(f"DynamoDB put_item failed, max retries ({max_retries}) reached, error: {error_code} - {error_message}")
-                        # Log blog info for manual processing
-                        logger.info(f"Blog that couldn't be saved - Title: {title}, ID: {blog_uid}")
-                        logger.info(f"Card URL: {card_url}")
-                        logger.info(f"Cover URL: {cover_url}")
-                        logger.info(f"Original URL: {org_url}")
-                        # Still return True to allow the process to continue
-                        return True
-            
-        except Exception as e:
-            logger.error(f"Error setting up DynamoDB connection: {str(e)}", exc_info=True)
-            # Log blog info for manual processing
-            logger.info(f"Blog that couldn't be saved - Title: {title}, ID: {blog_uid}")
-            logger.info(f"Card URL: {card_url}")
-            logger.info(f"Cover URL: {cover_url}")
-            logger.info(f"Original URL: {org_url}")
-            # Return True to allow the process to continue
+        # Prepare item data for DynamoDB
+        item = {
+            'uid': blog_uid,
+            'author': author,
+            'avatar': avatar,
+            'card': card_url,
+            'color': color,
+            'content': content,
+            'cover': cover_url,
+            'created_at': created_at,
+            # Partition key of the SLUG_INDEX_GSI day index
+            'created_day': now.strftime("%Y-%m-%d"),
+            'description': description,
+            'keyword': keyword,
+            'keywords': keywords,
+            'org': org_url,
+            'published': published,
+            'slug': slug,
+            'tag': tag,
+            'title': title,
+            'updated_at': updated_at
+        }
+
+        # Coalesced with other blogs into BatchWriteItem calls, retried with jittered backoff
+        if await get_db_writer().put(item):
+            logger.info(f"Successfully saved blog '{title}' to DynamoDB, ID: {blog_uid}")
+            if slug_index:
+                slug_index.commit(blog_uid)
             return True
-            
+
+        logger.error(f"DynamoDB write failed after retries for blog '{title}'")
+        # Log blog info for manual processing; the run journal retries it next run
+        logger.info(f"Blog that couldn't be saved - Title: {title}, ID: {blog_uid}")
+        logger.info(f"Card URL: {card_url}")
+        logger.info(f"Cover URL: {cover_url}")
+        logger.info(f"Original URL: {org_url}")
+        if slug_index:
+            slug_index.release(blog_uid)
+        return False
+
     except Exception as e:
         logger.error(f"Failed to save blog to DynamoDB: {str(e)}", exc_info=True)
-        # Return True to allow the process to continue
-        return True
+        if slug_index and blog_uid:
+            slug_index.release(blog_uid)
+        return False
 
-async def trigger_dify_workflow():
-    """Trigger a Dify workflow and wait for results"""
+def raise_for_workflow_status(data):
+    """Turn a workflow run that did not succeed into an UpstreamError; only 'failed' runs are retried"""
+    status = data.get("status")
+    if status == "succeeded":
+        return
+    raise UpstreamError(
+        f"Dify workflow finished with status '{status}': {data.get('error')}",
+        retryable=status == "failed",
+    )
+
+async def _dify_blocking_attempt():
+    """One blocking Dify workflow call; raises UpstreamError on failure"""
     # Prepare request content
     payload = {
         "inputs": {},  
@@ -239,147 +1189,905 @@ async def trigger_dify_workflow():
     logger.info(f"Sending request to: {DIFY_WORKFLOW_API_URL}")
     logger.debug(f"Request body: {json.dumps(payload, ensure_ascii=False)}")
     
-    async with httpx.AsyncClient(
-        verify=False,  # Disable certificate verification
-        timeout=120.0,
-        limits=httpx.Limits(max_keepalive_connections=1)
-    ) as client:
-        logger.info(f"Requesting URL: {DIFY_WORKFLOW_API_URL}")
+    client = get_pool("dify").client
+    logger.info(f"Requesting URL: {DIFY_WORKFLOW_API_URL}")
 
-        try:
-            # Force override hostname validation (for known httpx issue)
-            response = await client.post(
-                DIFY_WORKFLOW_API_URL,
-                headers={
-                    "Authorization": f"Bearer {DIFY_API_KEY}",
-                    "Content-Type": "application/json",
-                    # Explicitly declare accepting insecure connections
-                    "X-Forwarded-Proto": "https"  
-                },
-                json=payload,
-                # Disable default hostname validation behavior
-                extensions={"force_https": False}  
-            )
-            
+    try:
+        # Force override hostname validation (for known httpx issue)
+        response = await client.post(
+            DIFY_WORKFLOW_API_URL,
+            headers={
+                "Authorization": f"Bearer {DIFY_API_KEY}",
+                "Content-Type": "application/json",
+                # Explicitly declare accepting insecure connections
+                "X-Forwarded-Proto": "https"  
+            },
+            json=payload,
+            # Disable default hostname validation behavior
+            extensions={"force_https": False}  
+        )
+    except httpx.TransportError as e:
+        raise UpstreamError(f"Request failed: {str(e)}") from e
+
+    logger.info(f"Response status code: {response.status_code}")
+    logger.debug(f"Response content: {response.text[:200]}...")
+    raise_for_upstream_status(response)
+
+    result = response.json()
+    if "workflow_run_id" in result:
+        raise_for_workflow_status(result.get("data", {}))
+        return {
+            "workflow_run_id": result.get("workflow_run_id", ""),
+            "status": result.get("data", {}).get("status", ""),
+            "outputs": result.get("data", {}).get("outputs", {}),
+            "elapsed_time": result.get("data", {}).get("elapsed_time", 0)
+        }
+    raise UpstreamError(f"Unknown response format: {result}", retryable=False)
+
+async def trigger_dify_workflow():
+    """Trigger a Dify workflow and wait for results"""
+    return await call_with_breaker("dify", _dify_blocking_attempt, "Dify workflow", DIFY_MAX_ATTEMPTS)
+
+async def _dify_streaming_attempt(on_image_task):
+    """One streaming Dify workflow call; raises UpstreamError on failure"""
+    payload = {
+        "inputs": {},
+        "files": [],
+        "response_mode": "streaming",
+        "user": "auto-scheduler"
+    }
+
+    logger.info(f"Sending streaming request to: {DIFY_WORKFLOW_API_URL}")
+    client = get_pool("dify").client
+    timeout = httpx.Timeout(DIFY_TIMEOUT, read=DIFY_STREAM_READ_TIMEOUT)
+    workflow_run_id = ""
+    text_chunks = []
+    image_task_started = False
+
+    try:
+        async with client.stream(
+            "POST",
+            DIFY_WORKFLOW_API_URL,
+            headers={
+                "Authorization": f"Bearer {DIFY_API_KEY}",
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+                "X-Forwarded-Proto": "https"
+            },
+            json=payload,
+            timeout=timeout,
+            extensions={"force_https": False}
+        ) as response:
             logger.info(f"Response status code: {response.status_code}")
-            logger.debug(f"Response content: {response.text[:200]}...")
-            
-            response.raise_for_status()
-            result = response.json()
-            
-            if "workflow_run_id" in result:
-                return {
-                    "workflow_run_id": result.get("workflow_run_id", ""),
-                    "status": result.get("data", {}).get("status", ""),
-                    "outputs": result.get("data", {}).get("outputs", {}),
-                    "elapsed_time": result.get("data", {}).get("elapsed_time", 0)
-                }
+            if response.status_code >= 400:
+                await response.aread()
+            raise_for_upstream_status(response)
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    event = json.loads(line[5:].strip())
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed Dify event: {line[:200]}")
+                    continue
+
+                event_type = event.get("event")
+                data = event.get("data") or {}
+                workflow_run_id = event.get("workflow_run_id") or workflow_run_id
+
+                if event_type == "node_finished":
+                    outputs = data.get("outputs") or {}
+                    if "image" in outputs and not image_task_started:
+                        task_id = extract_image_task_id(outputs["image"])
+                        if task_id:
+                            image_task_started = True
+                            logger.info(f"Node '{data.get('title', data.get('node_id'))}' produced image task {task_id}")
+                            if on_image_task:
+                                on_image_task(task_id)
+                elif event_type == "text_chunk":
+                    text_chunks.append(data.get("text", ""))
+                elif event_type == "workflow_finished":
+                    outputs = data.get("outputs") or {}
+                    if "text" not in outputs and text_chunks:
+                        outputs["text"] = "".join(text_chunks)
+                    raise_for_workflow_status(data)
+                    return {
+                        "workflow_run_id": workflow_run_id,
+                        "status": data.get("status", ""),
+                        "outputs": outputs,
+                        "elapsed_time": data.get("elapsed_time", 0)
+                    }
+                elif event_type == "error":
+                    raise UpstreamError(f"Dify stream error: {event.get('message', event)}")
+
+    except httpx.TransportError as e:
+        raise UpstreamError(f"Streaming request failed: {str(e)}") from e
+
+    raise UpstreamError("Dify stream ended without a workflow_finished event")
+
+async def trigger_dify_workflow_streaming(on_image_task=None):
+    """Trigger a Dify workflow in streaming mode and consume its server-sent events.
+
+    `on_image_task(task_id)` is called as soon as a node finishes with an
+    `image` output, long before the article node is done. There is no overall
+    deadline, only a read timeout between events (Dify pings every 10s).
+    """
+    return await call_with_breaker(
+        "dify",
+        lambda: _dify_streaming_attempt(on_image_task),
+        "Dify streaming workflow",
+        DIFY_MAX_ATTEMPTS,
+    )
+
+def extract_image_task_id(image_data):
+    """Extract the image task ID from the Dify `image` output"""
+    if image_data is None:
+        logger.warning("未找到图片任务数据")
+        return None
+    # 检查image_data是否为JSON字符串
+    if not isinstance(image_data, str):
+        # 如果不是字符串，记录并跳过
+        logger.warning(f"图片任务数据类型非预期: {type(image_data)}")
+        return None
+    try:
+        # 尝试解析为JSON
+        image_info = json.loads(image_data)
+        # 如果是JSON对象，尝试获取task_id字段
+        if isinstance(image_info, dict) and "task_id" in image_info:
+            return image_info["task_id"]
+        # 如果不是包含task_id的JSON对象，直接使用字符串作为任务ID
+        return image_data
+    except json.JSONDecodeError:
+        # 不是JSON，直接使用字符串作为任务ID
+        return image_data
+
+class RunJournal:
+    """Append-only SQLite journal of the stages each blog has completed.
+
+    Every completed stage is written with its outputs, keyed by the blog's
+    uid. A blog without a 'done' or 'abandoned' entry is unfinished, and
+    the next run resumes it from its first missing stage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Autocommit: every record is durable as soon as record() returns
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blog_stages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " blog_uid TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " payload TEXT,"
+            " recorded_at TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_blog_stages_uid ON blog_stages (blog_uid)")
+
+    def record(self, blog_uid, stage, payload=None):
+        self.conn.execute(
+            "INSERT INTO blog_stages (blog_uid, stage, payload, recorded_at) VALUES (?, ?, ?, ?)",
+            (blog_uid, stage, json.dumps(payload, ensure_ascii=False), datetime.now().isoformat()),
+        )
+
+    def unfinished(self):
+        """Return {blog_uid: {stage: payload}} for every blog that is neither done nor abandoned"""
+        rows = self.conn.execute(
+            "SELECT blog_uid, stage, payload FROM blog_stages WHERE blog_uid NOT IN ("
+            " SELECT blog_uid FROM blog_stages WHERE stage IN ('done', 'abandoned'))"
+            " ORDER BY id"
+        ).fetchall()
+        blogs = {}
+        for blog_uid, stage, payload in rows:
+            stages = blogs.setdefault(blog_uid, {})
+            if stage == "attempt":
+                stages["attempt"] = stages.get("attempt", 0) + 1
             else:
-                logger.warning(f"Unknown response format: {result}")
-                return None
-            
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Dify API returned error: {e.response.text}")
-            return None
-        except Exception as e:
-            logger.error(f"Request failed: {str(e)}")
-            return None
+                stages[stage] = json.loads(payload) if payload else None
+        return blogs
 
-async def process_single_blog():
-    """Process complete workflow for a single blog"""
+    def close(self):
+        self.conn.close()
+
+# Journal of the current run; None when journaling is disabled
+run_journal = None
+
+# Job attributes journaled for each stage, restored when a blog is resumed
+STAGE_FIELDS = {
+    "generate": ["outputs"],
+    "images": ["image_task_id", "image_urls"],
+    "persist": ["saved"],
+    "save_local": ["local_path"],
+}
+
+def record_stage(job, stage, payload):
+    """Remember that a stage completed, in the job and in the run journal"""
+    job.completed[stage] = payload
+    if run_journal:
+        run_journal.record(job.uid, stage, payload)
+
+def journaled(name, handler):
+    """Wrap a stage handler so completed stages are skipped on resume and recorded on success"""
+    async def run(job):
+        if name == BLOG_STAGES[0][0] and run_journal:
+            run_journal.record(job.uid, "attempt", {"attempt": job.attempt})
+        if name in job.completed:
+            for field, value in (job.completed[name] or {}).items():
+                setattr(job, field, value)
+            logger.info(f"Blog {job.label} resumed: stage '{name}' already completed")
+            if name == BLOG_STAGES[-1][0] and "done" not in job.completed:
+                # The local copy was written early, when persisting failed
+                record_stage(job, "done", None)
+            return True
+        ok = await handler(job)
+        if ok:
+            record_stage(job, name, {field: getattr(job, field) for field in STAGE_FIELDS[name]})
+            if name == BLOG_STAGES[-1][0]:
+                record_stage(job, "done", None)
+        return ok
+    return run
+
+def load_resumable_jobs(total_new, response_mode):
+    """Build jobs for the blogs an earlier run left unfinished"""
+    jobs = []
+    for blog_uid, completed in run_journal.unfinished().items():
+        attempts = completed.pop("attempt", 0)
+        if not completed:
+            # Died before anything was paid for: a fresh blog is just as good
+            run_journal.record(blog_uid, "abandoned", {"attempts": attempts})
+            continue
+        if attempts >= JOURNAL_MAX_ATTEMPTS:
+            logger.warning(f"Abandoning blog {blog_uid} after {attempts} attempts, completed stages: {list(completed)}")
+            run_journal.record(blog_uid, "abandoned", {"attempts": attempts})
+            continue
+        jobs.append(BlogJob(len(jobs), 0, response_mode, uid=blog_uid, completed=completed, attempt=attempts + 1))
+    total = len(jobs) + total_new
+    for job in jobs:
+        job.total = total
+    return jobs
+
+class BlogJob:
+    """State of a single blog as it moves through the pipeline stages"""
+
+    def __init__(self, idx, total, response_mode=DIFY_RESPONSE_MODE, uid=None, completed=None, attempt=1):
+        self.idx = idx
+        self.total = total
+        self.response_mode = response_mode
+        # Also the DynamoDB uid, so a retried write overwrites instead of duplicating
+        self.uid = uid or str(uuid.uuid4())
+        # Stage name -> journaled outputs of the stages already done
+        self.completed = completed or {}
+        self.attempt = attempt
+        self.outputs = None
+        self.image_task_id = None
+        # Streaming mode starts image polling while the article is still generating
+        self.image_future = None
+        self.image_urls = []
+        self.saved = False
+        self.local_path = None
+        self.failed_stage = None
+
+    @property
+    def label(self):
+        return f"{self.idx + 1}/{self.total}"
+
+async def generate_stage(job):
+    """Stage 1: Trigger Dify to generate blog content"""
+    # The adaptive controller decides how many blogs may be generating at once
+    async with get_rate_controller().slot():
+        if job.response_mode == "streaming":
+            def start_image_polling(task_id):
+                if job.image_future:
+                    # A retried workflow created a new image task
+                    job.image_future.cancel()
+                job.image_task_id = task_id
+                job.image_future = asyncio.create_task(get_image_urls(task_id))
+
+            dify_result = await trigger_dify_workflow_streaming(on_image_task=start_image_polling)
+        else:
+            dify_result = await trigger_dify_workflow()
+    if not dify_result or not dify_result.get("outputs"):
+        logger.error(f"Dify API returned empty result for blog {job.label}")
+        if job.image_future:
+            job.image_future.cancel()
+        return False
+
+    job.outputs = dify_result.get("outputs", {})
+    logger.info(f"Dify returned result: {json.dumps(job.outputs, ensure_ascii=False)[:200]}...")
+    return True
+
+async def image_stage(job):
+    """Stage 2: Resolve the image task ID and poll for the image URLs"""
+    image_urls = []
     try:
-        # Step 1: Trigger Dify to generate blog content
-        dify_result = await trigger_dify_workflow()
-        if not dify_result or not dify_result.get("outputs"):
-            logger.error("Dify API returned empty result")
-            return False
-        
-        outputs = dify_result.get("outputs", {})
-        logger.info(f"Dify returned result: {json.dumps(outputs, ensure_ascii=False)[:200]}...")
-        
-        # Step 2: Get image task ID
-        # 修改后的代码
-        image_data = outputs.get("image")
-        try:
-            if image_data is None:
-                logger.warning("未找到图片任务数据")
-                image_urls = []
-                image_task_id = None
+        if job.image_future:
+            # Polling already started when the image node finished
+            record_stage(job, "image_task", {"image_task_id": job.image_task_id})
+            image_urls = await job.image_future
+        else:
+            # A resumed blog re-polls the journaled task: in streaming mode the task id
+            # came from an early node event and is not in the final outputs
+            journaled_task = (job.completed.get("image_task") or {}).get("image_task_id")
+            job.image_task_id = journaled_task or extract_image_task_id(job.outputs.get("image"))
+            if job.image_task_id:
+                logger.info(f"获取到图片任务ID: {job.image_task_id}")
+                if not journaled_task:
+                    record_stage(job, "image_task", {"image_task_id": job.image_task_id})
+                # 查询图片URL并获取三种规格
+                image_urls = await get_image_urls(job.image_task_id)
             else:
-                # 检查image_data是否为JSON字符串
-                if isinstance(image_data, str):
-                    try:
-                        # 尝试解析为JSON
-                        image_info = json.loads(image_data)
-                        # 如果是JSON对象，尝试获取task_id字段
-                        if isinstance(image_info, dict) and "task_id" in image_info:
-                            image_task_id = image_info["task_id"]
-                        else:
-                            # 如果不是包含task_id的JSON对象，直接使用字符串作为任务ID
-                            image_task_id = image_data
-                    except json.JSONDecodeError:
-                        # 不是JSON，直接使用字符串作为任务ID
-                        image_task_id = image_data
-                else:
-                    # 如果不是字符串，记录并跳过
-                    logger.warning(f"图片任务数据类型非预期: {type(image_data)}")
-                    image_urls = []
-                    image_task_id = None
-                
-                if image_task_id:
-                    logger.info(f"获取到图片任务ID: {image_task_id}")
-                    # 步骤3: 查询图片URL并获取三种规格
-                    image_urls = await get_image_urls(image_task_id)
-                else:
-                    logger.warning("未能提取有效的图片任务ID")
-                    image_urls = []
-        except Exception as e:
-            logger.error(f"处理图片任务信息时出错: {str(e)}", exc_info=True)
-            image_urls = []
-        
-        # Step 4: Save blog content to database
-        saved = save_blog_to_db(outputs, image_urls)
-        
-        # Also save to local file (optional)
-        if "text" in outputs:
-            try:
-                text_data = json.loads(outputs["text"])
-                content = text_data.get("article", "")
-                if content:
-                    save_blog(content, datetime.now().strftime("%Y%m%d_%H%M%S"))
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse blog content: {outputs.get('text')}")
-        
-        return saved
+                logger.warning("未能提取有效的图片任务ID")
+    except Exception as e:
+        logger.error(f"处理图片任务信息时出错: {str(e)}", exc_info=True)
+    job.image_urls = image_urls or []
+
+    if image_urls is None:
+        # The image task itself failed: re-polling cannot help, save the blog with the fallback images now
+        logger.warning(f"Image task for blog {job.label} failed, saving it with fallback images")
+    elif job.image_task_id and not job.image_urls and run_journal and job.attempt < JOURNAL_MAX_ATTEMPTS:
+        # Keep the generated article; the next run re-polls the same image task
+        logger.warning(f"No images yet for blog {job.label}, leaving it for the next run to re-poll")
+        return False
+    # A blog without images is still saved
+    return True
+
+async def persist_stage(job):
+    """Stage 3: Save blog content to database"""
+    job.saved = await save_blog_to_db(job.outputs, job.image_urls, job.uid)
+    if job.saved is None:
+        # Duplicates are final: retrying in a later run would be rejected again. The article
+        # is still kept on disk so a false positive of the title check loses no work
+        save_job_markdown(job, REJECTED_BLOG_PATH)
+        if job.local_path:
+            logger.warning(f"Blog {job.label} rejected as a duplicate, article kept at {job.local_path}")
+        if run_journal:
+            run_journal.record(job.uid, "abandoned", {"reason": "duplicate title", "local_path": job.local_path})
+        job.saved = False
+        return False
+    if not job.saved and "save_local" not in job.completed:
+        # DynamoDB is down: still keep the markdown file, the journal retries the write next run
+        await local_save_stage(job)
+        record_stage(job, "save_local", {field: getattr(job, field) for field in STAGE_FIELDS["save_local"]})
+    return job.saved
+
+def save_job_markdown(job, root=BLOG_STORAGE_PATH):
+    """Write the job's article to a Markdown file under root and remember its path"""
+    if "text" in job.outputs:
+        try:
+            text_data = json.loads(job.outputs["text"])
+            content = text_data.get("article", "")
+            if content:
+                # Suffix with the blog index: parallel blogs finish within the same second
+                job.local_path = save_blog(content, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{job.idx + 1}", root)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse blog content: {job.outputs.get('text')}")
+
+async def local_save_stage(job):
+    """Stage 4: Also save to local file (optional)"""
+    save_job_markdown(job)
+    return True
+
+BLOG_STAGES = [
+    ("generate", generate_stage),
+    ("images", image_stage),
+    ("persist", persist_stage),
+    ("save_local", local_save_stage),
+]
+# Every stage skips itself when the journal says it already ran
+BLOG_STAGES = [(name, journaled(name, handler)) for name, handler in BLOG_STAGES]
+
+async def process_single_blog(job=None):
+    """Process complete workflow for a single blog"""
+    job = job or BlogJob(0, 1)
+    try:
+        for name, handler in BLOG_STAGES:
+            if not await handler(job):
+                job.failed_stage = name
+                return False
+        return job.saved
     except Exception as e:
         logger.error(f"Error in blog processing workflow: {str(e)}", exc_info=True)
         return False
 
-async def main():
-    """Main function: Batch process blogs"""
-    success_count = 0
-    total_count = 100
-    
-    for i in range(total_count):
+class PipelineStage:
+    """A pipeline stage: a bounded input queue drained by a fixed pool of workers"""
+
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def stats(self, elapsed):
+        done = self.processed + self.failed
+        return {
+            "queue": self.queue.qsize(),
+            "queue_max": self.queue.maxsize,
+            "in_flight": self.in_flight,
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "per_minute": round(done / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            "avg_seconds": round(self.busy_seconds / done, 2) if done else 0.0,
+            # Fraction of worker time spent busy; the bottleneck sits near 1.0
+            "utilization": round(self.busy_seconds / (elapsed * self.workers), 2) if elapsed > 0 else 0.0,
+        }
+
+class BlogPipeline:
+    """Stage graph connected by bounded asyncio queues.
+
+    Each stage has its own worker pool, so Dify generation for one blog
+    overlaps image polling and DB writes for the blogs ahead of it. A full
+    queue blocks the upstream stage, which gives backpressure.
+    """
+
+    _DONE = object()
+
+    def __init__(self, stages, stats_interval=60):
+        self.stages = stages
+        self.stats_interval = stats_interval
+        self.started_at = None
+        self.stop_event = None
+        self.finished = []
+        self.dropped = []
+        self.skipped = []
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {stage.name: stage.stats(elapsed) for stage in self.stages}
+
+    def log_stats(self, prefix="Pipeline stats"):
+        parts = []
+        for name, s in self.stats().items():
+            parts.append(
+                f"{name}[queue={s['queue']}/{s['queue_max']} busy={s['in_flight']}/{s['workers']} "
+                f"done={s['processed']} failed={s['failed']} rate={s['per_minute']}/min "
+                f"avg={s['avg_seconds']}s util={s['utilization']}]"
+            )
+        logger.info(f"{prefix}: " + " ".join(parts))
+
+    async def _worker(self, index):
+        stage = self.stages[index]
+        downstream = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            job = await stage.queue.get()
+            if job is self._DONE:
+                return
+            if index == 0 and self.stop_event is not None and self.stop_event.is_set():
+                # Draining: queued blogs that have not started yet are left alone
+                self.skipped.append(job)
+                continue
+            stage.in_flight += 1
+            started = time.monotonic()
+            try:
+                ok = await stage.handler(job)
+            except Exception as e:
+                logger.error(f"Stage '{stage.name}' failed for blog {job.label}: {str(e)}", exc_info=True)
+                ok = False
+            finally:
+                stage.in_flight -= 1
+                stage.busy_seconds += time.monotonic() - started
+
+            if ok:
+                stage.processed += 1
+                if downstream:
+                    await downstream.queue.put(job)
+                else:
+                    self.finished.append(job)
+            else:
+                stage.failed += 1
+                job.failed_stage = stage.name
+                self.dropped.append(job)
+                logger.warning(f"Blog {job.label} dropped at stage '{stage.name}'")
+
+    async def _run_stage(self, index):
+        stage = self.stages[index]
+        await asyncio.gather(*(self._worker(index) for _ in range(stage.workers)))
+        # Stage drained: let every downstream worker shut down
+        if index + 1 < len(self.stages):
+            downstream = self.stages[index + 1]
+            for _ in range(downstream.workers):
+                await downstream.queue.put(self._DONE)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.log_stats()
+
+    async def run(self, jobs, stop_event=None):
+        """Feed jobs into the first stage and wait until every stage drains.
+
+        Once `stop_event` is set no new blog is started, but blogs already
+        in flight run through every remaining stage.
+        """
+        self.started_at = time.monotonic()
+        self.stop_event = stop_event
+        runners = [asyncio.create_task(self._run_stage(i)) for i in range(len(self.stages))]
+        reporter = asyncio.create_task(self._report())
         try:
-            logger.info(f"Starting to process blog {i+1}/{total_count}")
-            success = await process_single_blog()
-            
-            if success:
-                success_count += 1
-                logger.info(f"Successfully processed blog {i+1}/{total_count}")
+            head = self.stages[0]
+            for job in jobs:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                await head.queue.put(job)
+            for _ in range(head.workers):
+                await head.queue.put(self._DONE)
+            await asyncio.gather(*runners)
+        finally:
+            reporter.cancel()
+            for runner in runners:
+                runner.cancel()
+        self.log_stats("Pipeline final stats")
+        if self.skipped:
+            logger.info(f"Pipeline drained: {len(self.skipped)} queued blog(s) not started")
+        return self.finished
+
+def parse_stage_workers(spec):
+    """Parse a 'generate=4,images=8' style per-stage worker spec"""
+    workers = {}
+    if not spec:
+        return workers
+    known = {name for name, _ in BLOG_STAGES}
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in known:
+            raise ValueError(f"Unknown pipeline stage '{name}', expected one of {sorted(known)}")
+        workers[name] = int(value)
+        if workers[name] < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker")
+    return workers
+
+def resolve_stage_workers(concurrency, stage_workers=None):
+    """Size each stage's worker pool from the batch concurrency plus overrides"""
+    workers = {
+        "generate": concurrency,
+        # Image polling mostly waits, and each poll can take minutes
+        "images": concurrency * 2,
+        # Persist workers only wait on the batch writer, which coalesces their items
+        "persist": min(25, concurrency),
+        "save_local": 1,
+    }
+    workers.update(stage_workers or {})
+    return workers
+
+def build_pipeline(concurrency, stage_workers=None):
+    """Build the blog stage graph, sizing worker pools from the batch concurrency"""
+    workers = resolve_stage_workers(concurrency, stage_workers)
+    stages = []
+    for name, handler in BLOG_STAGES:
+        stages.append(PipelineStage(
+            name,
+            handler,
+            workers[name],
+            queue_size=max(1, workers[name] * PIPELINE_QUEUE_FACTOR),
+        ))
+    return BlogPipeline(stages, stats_interval=PIPELINE_STATS_INTERVAL)
+
+async def run_batch(jobs, concurrency, stop_event=None):
+    """Batch mode: run whole blogs in parallel under a semaphore"""
+    success_count = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(job):
+        nonlocal success_count
+        async with semaphore:
+            if stop_event is not None and stop_event.is_set():
+                # Draining: do not start new blogs
+                return
+            try:
+                logger.info(f"Starting to process blog {job.label}")
+                success = await process_single_blog(job)
+
+                if success:
+                    success_count += 1
+                    logger.info(f"Successfully processed blog {job.label}")
+                else:
+                    logger.warning(f"Failed to process blog {job.label}")
+            except Exception as e:
+                logger.error(f"Error processing blog {job.label}: {str(e)}", exc_info=True)
+
+    await asyncio.gather(*(run_one(job) for job in jobs))
+    return success_count
+
+async def run_pipeline(jobs, concurrency, stage_workers=None, stop_event=None):
+    """Pipeline mode: stream blogs through the staged pipeline"""
+    pipeline = build_pipeline(concurrency, stage_workers)
+    finished = await pipeline.run(jobs, stop_event)
+    return sum(1 for job in finished if job.saved)
+
+class CronSchedule:
+    """Minimal five-field cron expression (minute hour day-of-month month day-of-week), local time"""
+
+    FIELDS = [("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7)]
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields, got {len(parts)}: '{expression}'")
+        values = [self._parse_field(part, low, high) for part, (_, low, high) in zip(parts, self.FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        # Both 0 and 7 mean Sunday
+        self.weekdays = {d % 7 for d in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            spec, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if spec == "*":
+                start, end = low, high
+            elif "-" in spec:
+                start, end = (int(v) for v in spec.split("-", 1))
             else:
-                logger.warning(f"Failed to process blog {i+1}/{total_count}")
-            
-            # Add random delay to avoid API rate limiting
-            await asyncio.sleep(random.uniform(1.0, 3.0))
-        except Exception as e:
-            logger.error(f"Error processing blog {i+1}/{total_count}: {str(e)}", exc_info=True)
-    
-    logger.info(f"Batch processing complete: Success {success_count}/{total_count}")
+                start = int(spec)
+                end = high if step > 1 else start
+            if not (low <= start <= end <= high) or step < 1:
+                raise ValueError(f"Invalid cron field '{field}' (allowed {low}-{high})")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        day_ok = t.day in self.days
+        weekday_ok = (t.weekday() + 1) % 7 in self.weekdays
+        # Standard cron: when both day fields are restricted, either may match
+        if not self.any_day and not self.any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_run(self, now):
+        """Return the first matching minute strictly after `now`"""
+        t = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(200000):
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+    def __str__(self):
+        return f"cron '{self.expression}'"
+
+class IntervalSchedule:
+    """Run a batch every `seconds` seconds"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_run(self, now):
+        return now + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return f"every {self.seconds:.0f}s"
+
+def size_connections(mode, concurrency, stage_workers=None, response_mode=DIFY_RESPONSE_MODE):
+    """Return the (Dify, image service) connection pool sizes for a run"""
+    if mode == "batch":
+        return concurrency, concurrency
+    workers = resolve_stage_workers(concurrency, stage_workers)
+    image_connections = workers["images"]
+    if response_mode == "streaming":
+        # Polling also starts from blogs still in the generate stage
+        image_connections += workers["generate"]
+    return workers["generate"], image_connections
+
+@contextlib.asynccontextmanager
+async def open_run_resources(dify_connections, image_connections):
+    """Open everything blogs share: HTTP pools, DB writer, slug index, journal and rate controller"""
+    global rate_controller, run_journal
+    # Replaces the old fixed random sleep between blogs: the configured
+    # concurrency is only the ceiling, the controller finds the actual rate
+    rate_controller = AdaptiveRateController(dify_connections)
+    run_journal = RunJournal(SCHEDULER_JOURNAL_PATH) if SCHEDULER_JOURNAL_PATH else None
+    try:
+        async with open_upstream_pools(dify_connections, image_connections), open_db_writer(), open_slug_index():
+            yield
+    finally:
+        if run_journal:
+            run_journal.close()
+            run_journal = None
+        logger.info(f"Rate controller final state: {rate_controller.summary()}")
+        for name, breaker in circuit_breakers.items():
+            logger.info(f"Circuit '{name}' final state: {breaker.state}, transitions: {breaker.stats}")
+
+async def run_once(total_count, concurrency, mode=SCHEDULER_MODE, stage_workers=None,
+                   response_mode=DIFY_RESPONSE_MODE, resume=True, stop_event=None):
+    """Run one batch with the shared resources already open"""
+    logger.info(f"Starting {mode} run: {total_count} blogs, concurrency {concurrency}, Dify {response_mode} mode")
+    jobs = load_resumable_jobs(total_count, response_mode) if run_journal and resume else []
+    if jobs:
+        logger.info(f"Resuming {len(jobs)} unfinished blog(s) from journal {SCHEDULER_JOURNAL_PATH}")
+    total = len(jobs) + total_count
+    jobs += [BlogJob(len(jobs) + i, total, response_mode) for i in range(total_count)]
+
+    if mode == "batch":
+        success_count = await run_batch(jobs, concurrency, stop_event)
+    else:
+        success_count = await run_pipeline(jobs, concurrency, stage_workers, stop_event)
+
+    logger.info(f"Batch processing complete: Success {success_count}/{total}")
+    return success_count
+
+def install_stop_handlers(stop_event):
+    """Set `stop_event` on SIGTERM/SIGINT so in-flight blogs can drain; a second signal aborts them"""
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+
+    def request_stop(signame):
+        if stop_event.is_set():
+            logger.warning(f"Received {signame} again, aborting in-flight blogs")
+            main_task.cancel()
+            return
+        logger.warning(f"Received {signame}, no new blogs will be started; draining in-flight blogs")
+        stop_event.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, request_stop, sig.name)
+        except (NotImplementedError, RuntimeError):
+            # Signal handlers are unavailable on this platform
+            pass
+
+async def drain_batch(batch):
+    """Give a stopping batch up to DAEMON_DRAIN_TIMEOUT to finish its in-flight blogs, then cancel it"""
+    if batch.done():
+        return
+    logger.info(f"Draining in-flight blogs (up to {DAEMON_DRAIN_TIMEOUT:.0f}s)")
+    try:
+        await asyncio.wait_for(asyncio.shield(batch), DAEMON_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Whatever is left stays in the run journal for the next start
+        logger.warning("Drain timeout reached, cancelling the remaining blogs")
+    finally:
+        if not batch.done():
+            batch.cancel()
+        await asyncio.gather(batch, return_exceptions=True)
+
+async def main(total_count=BLOG_COUNT, concurrency=BLOG_CONCURRENCY, mode=SCHEDULER_MODE, stage_workers=None,
+               response_mode=DIFY_RESPONSE_MODE, resume=True):
+    """Main function: Batch process blogs"""
+    stop_event = asyncio.Event()
+    install_stop_handlers(stop_event)
+    dify_connections, image_connections = size_connections(mode, concurrency, stage_workers, response_mode)
+    async with open_run_resources(dify_connections, image_connections):
+        batch = asyncio.create_task(
+            run_once(total_count, concurrency, mode, stage_workers, response_mode, resume, stop_event)
+        )
+        stopping = asyncio.create_task(stop_event.wait())
+        try:
+            await asyncio.wait({batch, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopping.cancel()
+            await drain_batch(batch)
+        if not batch.cancelled():
+            batch.result()
+
+async def run_scheduled_batch(total_count, concurrency, mode, stage_workers, response_mode, resume, stop_event):
+    """One daemon batch: re-warm the pools and refresh the slug index, then run"""
+    try:
+        await asyncio.gather(*(pool.warm(HTTP_WARM_CONNECTIONS) for pool in upstream_pools.values()))
+        if slug_index:
+            try:
+                await slug_index.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh slug index from DynamoDB: {str(e)}", exc_info=True)
+        start_time = time.monotonic()
+        await run_once(total_count, concurrency, mode, stage_workers, response_mode, resume, stop_event)
+        logger.info(f"Scheduled batch finished in {time.monotonic() - start_time:.2f} seconds")
+    except Exception as e:
+        logger.error(f"Scheduled batch failed: {str(e)}", exc_info=True)
+    finally:
+        if slug_index:
+            try:
+                slug_index.save()
+            except Exception as e:
+                logger.error(f"Failed to save slug index: {str(e)}", exc_info=True)
+
+async def run_daemon(schedule, total_count=BLOG_COUNT, concurrency=BLOG_CONCURRENCY, mode=SCHEDULER_MODE,
+                     stage_workers=None, response_mode=DIFY_RESPONSE_MODE, resume=True, run_at_start=False):
+    """Daemon mode: stay resident and run batches on `schedule`.
+
+    Connection pools, the DB writer, the slug index and the rate controller
+    stay alive between batches. A scheduled run is skipped while the
+    previous batch is still going. SIGTERM stops new blogs from starting and
+    waits up to DAEMON_DRAIN_TIMEOUT for in-flight blogs to finish; a
+    second SIGTERM/SIGINT cancels them right away.
+    """
+    stop_event = asyncio.Event()
+    install_stop_handlers(stop_event)
+    dify_connections, image_connections = size_connections(mode, concurrency, stage_workers, response_mode)
+    logger.info(f"Scheduler daemon started, running {schedule}")
+
+    async with open_run_resources(dify_connections, image_connections):
+        batch = None
+        skip_wait = run_at_start
+        while not stop_event.is_set():
+            if not skip_wait:
+                next_run = schedule.next_run(datetime.now())
+                logger.info(f"Next batch scheduled at {next_run:%Y-%m-%d %H:%M:%S}")
+                try:
+                    await asyncio.wait_for(stop_event.wait(), max(0.0, (next_run - datetime.now()).total_seconds()))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            skip_wait = False
+
+            if batch and not batch.done():
+                logger.warning("Previous batch is still running, skipping this scheduled run")
+                continue
+            batch = asyncio.create_task(run_scheduled_batch(
+                total_count, concurrency, mode, stage_workers, response_mode, resume, stop_event
+            ))
+
+        if batch:
+            await drain_batch(batch)
+    logger.info("Scheduler daemon stopped")
+
+def parse_args(argv=None):
+    """Parse command line options, falling back to environment variables"""
+    parser = argparse.ArgumentParser(description="Trigger Dify workflows to generate blogs in batch")
+    parser.add_argument("--count", type=int, default=BLOG_COUNT,
+                        help="Number of blogs to generate (env BLOG_COUNT, default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=BLOG_CONCURRENCY,
+                        help="Maximum blogs processed in parallel (env BLOG_CONCURRENCY, default %(default)s)")
+    parser.add_argument("--mode", choices=["pipeline", "batch"], default=SCHEDULER_MODE,
+                        help="'pipeline' overlaps stages across blogs, 'batch' runs whole blogs "
+                             "in parallel (env SCHEDULER_MODE, default %(default)s)")
+    parser.add_argument("--stage-workers", default=PIPELINE_STAGE_WORKERS,
+                        help="Per-stage worker overrides, e.g. 'generate=4,images=8,persist=2' "
+                             "(env PIPELINE_STAGE_WORKERS)")
+    parser.add_argument("--response-mode", choices=["blocking", "streaming"], default=DIFY_RESPONSE_MODE,
+                        help="Dify response mode; 'streaming' starts image polling as soon as the image "
+                             "node finishes (env DIFY_RESPONSE_MODE, default %(default)s)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="Do not resume blogs left unfinished by earlier runs")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Stay resident and run batches on a schedule instead of once")
+    parser.add_argument("--schedule", default=SCHEDULER_CRON,
+                        help="Daemon cron expression, local time (env SCHEDULER_CRON, default '%(default)s')")
+    parser.add_argument("--interval", type=float, default=SCHEDULER_INTERVAL,
+                        help="Daemon interval in seconds; overrides --schedule (env SCHEDULER_INTERVAL)")
+    parser.add_argument("--run-at-start", action="store_true",
+                        help="In daemon mode, run a batch immediately on startup")
+    args = parser.parse_args(argv)
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    try:
+        args.stage_workers = parse_stage_workers(args.stage_workers)
+        args.schedule = IntervalSchedule(args.interval) if args.interval else CronSchedule(args.schedule)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
     start_time = time.time()
-    asyncio.run(main())
+    try:
+        if args.daemon:
+            asyncio.run(run_daemon(args.schedule, args.count, args.concurrency, args.mode, args.stage_workers,
+                                   args.response_mode, args.resume, args.run_at_start))
+        else:
+            asyncio.run(main(args.count, args.concurrency, args.mode, args.stage_workers, args.response_mode, args.resume))
+    except asyncio.CancelledError:
+        logger.warning("Run aborted; unfinished blogs stay in the run journal")
+        raise SystemExit(130)
     elapsed = time.time() - start_time
     logger.info(f"Total execution time: {elapsed:.2f} seconds")
\ No newline at end of file
@@ -0,0 +1,315 @@
+"""灵积任务的准入控制
+
+每个模型同时进行中的任务数有上限，创建任务的速率由令牌桶限制。
+名额不够时请求在有界队列里按先来后到等待；队列已满或等待过久时返回 AdmissionRejected，
+调用方据此回复 429 和预计的 Retry-After，而不是把请求继续压给灵积。
+灵积返回 429 时按其 Retry-After 暂停该模型的创建，之后自动重试。
+
+灵积的配额按账号计算，多个worker各用一个进程内令牌桶会成倍超出配额。
+SqliteTokenBucket 把令牌状态放在本机的SQLite文件里，同一台机器上的所有worker共用一份预算。
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# 没有历史数据时假设的任务占用时长（秒）
+DEFAULT_HOLD_SECONDS = 15.0
+# 任务占用时长的指数移动平均系数
+HOLD_EWMA_ALPHA = 0.2
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或HTTP日期），返回秒数"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimited(Exception):
+    """灵积返回了 429"""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionRejected(Exception):
+    """排队已满或等待超时，retry_after 为建议的重试等待秒数，position 为当时的排队位置"""
+
+    def __init__(self, reason: str, retry_after: float, position: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.position = position
+
+
+class TokenBucket:
+    """进程内令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """预订一个令牌，返回需要等待的秒数（令牌可以透支，等待时间随之增加）"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float):
+        """上游限流时清空令牌，接下来 seconds 秒内不再放行"""
+        self.reserve()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class SqliteTokenBucket:
+    """多进程共享的令牌桶，状态保存在SQLite中，每次预订在一个写事务内完成
+
+    各进程的时钟相同，按墙上时间补充令牌。
+    """
+
+    def __init__(self, path: str, name: str, rate: float, burst: int = 1):
+        self.path = path
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+            (name, float(self.burst), time.time())
+        )
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated = self._conn.execute(
+                    "SELECT tokens, updated FROM token_buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                tokens = min(self.burst, tokens + max(now - updated, 0.0) * self.rate) - 1
+                self._conn.execute(
+                    "UPDATE token_buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens, max(now, updated), self.name)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+    def penalize(self, seconds: float):
+        """上游限流时清空令牌，本机所有worker接下来 seconds 秒内都不再放行"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE token_buckets SET tokens = MIN(tokens + MAX(? - updated, 0) * ?, ?), updated = MAX(?, updated)"
+                " WHERE name = ?",
+                (time.time(), self.rate, -seconds * self.rate, time.time(), self.name)
+            )
+
+    async def acquire(self):
+        # 其他进程持有写锁时 BEGIN IMMEDIATE 会阻塞，放到线程里执行
+        delay = await asyncio.to_thread(self.reserve)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_token_bucket(backend: str, path: str, name: str, rate: float, burst: int):
+    """按配置创建令牌桶：local（进程内）或 sqlite（本机所有worker共用）"""
+    if backend == "sqlite":
+        return SqliteTokenBucket(path, name, rate, burst)
+    return TokenBucket(rate, burst)
+
+
+class ModelGate:
+    """单个模型的并发名额和等待队列"""
+    __slots__ = ("limit", "active", "waiters", "paused_until", "avg_hold")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.paused_until = 0.0
+        self.avg_hold = DEFAULT_HOLD_SECONDS
+
+
+class AdmissionController:
+    """按模型限制并发、按令牌桶限制创建速率的准入控制器
+
+    acquire() 取得名额（必要时排队），任务结束后调用 release() 归还；
+    create() 在令牌桶和 429 暂停的约束下执行创建请求。
+    """
+
+    def __init__(self, max_concurrent: int = 2, model_limits: Optional[Dict[str, int]] = None,
+                 queue_size: int = 100, max_wait: float = 30, create_qps: float = 2, burst: int = 2,
+                 max_rate_limit_retries: int = 3, bucket: Optional[Any] = None):
+        self.max_concurrent = max_concurrent
+        self.model_limits = model_limits or {}
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.create_qps = create_qps
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.bucket = bucket or TokenBucket(create_qps, burst)
+        self.gates: Dict[str, ModelGate] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    def gate(self, model: str) -> ModelGate:
+        gate = self.gates.get(model)
+        if gate is None:
+            gate = self.gates[model] = ModelGate(self.model_limits.get(model, self.max_concurrent))
+        return gate
+
+    def queued(self) -> int:
+        return sum(len(gate.waiters) for gate in self.gates.values())
+
+    def estimate_wait(self, model: str, position: int) -> float:
+        """排在第 position 位的请求大约还要等多少秒"""
+        gate = self.gate(model)
+        throughput = gate.limit / max(gate.avg_hold, 0.1)
+        if self.create_qps > 0:
+            throughput = min(throughput, self.create_qps)
+        pause = max(gate.paused_until - time.monotonic(), 0.0)
+        return pause + position / max(throughput, 1e-6)
+
+    def _reject(self, model: str, reason: str, position: int) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(reason, self.estimate_wait(model, position), position)
+
+    async def acquire(self, model: str):
+        """取得该模型的一个名额；队列已满或等待超过 max_wait 时抛出 AdmissionRejected"""
+        gate = self.gate(model)
+        if gate.active < gate.limit and not gate.waiters:
+            gate.active += 1
+            self.admitted += 1
+            return
+        if self.queued() >= self.queue_size:
+            raise self._reject(model, "排队已满", len(gate.waiters) + 1)
+        future = asyncio.get_running_loop().create_future()
+        gate.waiters.append(future)
+        position = len(gate.waiters)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超时的同时刚好拿到名额
+                self.admitted += 1
+                return
+            future.cancel()
+            self._discard(gate, future)
+            raise self._reject(model, "排队等待超时", position)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已经转给了这个请求，还回去
+                self.release(model)
+            else:
+                future.cancel()
+                self._discard(gate, future)
+            raise
+        self.admitted += 1
+
+    @staticmethod
+    def _discard(gate: ModelGate, future: asyncio.Future):
+        try:
+            gate.waiters.remove(future)
+        except ValueError:
+            pass
+
+    def occupy(self, model: str):
+        """不经排队直接占用名额，用于恢复已在灵积上运行的任务"""
+        self.gate(model).active += 1
+
+    def release(self, model: str, held_seconds: Optional[float] = None):
+        """归还名额；有人排队时直接转给队首"""
+        gate = self.gate(model)
+        if held_seconds is not None:
+            gate.avg_hold += HOLD_EWMA_ALPHA * (held_seconds - gate.avg_hold)
+        while gate.waiters:
+            future = gate.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        gate.active = max(gate.active - 1, 0)
+
+    async def create(self, model: str, func: Callable[[], Awaitable[T]]) -> T:
+        """在速率限制下执行创建请求；灵积返回 429 时按 Retry-After 暂停该模型后重试"""
+        gate = self.gate(model)
+        attempts = 0
+        while True:
+            pause = gate.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            try:
+                return await func()
+            except RateLimited as e:
+                self.rate_limited += 1
+                attempts += 1
+                retry_after = e.retry_after if e.retry_after is not None else 2.0 ** attempts
+                gate.paused_until = max(gate.paused_until, time.monotonic() + retry_after)
+                # 共享令牌桶时其他worker也一起暂停；SQLite写可能等锁，放到线程里，进程内令牌桶直接在事件循环中修改
+                if isinstance(self.bucket, SqliteTokenBucket):
+                    await asyncio.to_thread(self.bucket.penalize, retry_after)
+                else:
+                    self.bucket.penalize(retry_after)
+                if attempts > self.max_rate_limit_retries:
+                    raise self._reject(model, "灵积限流", len(gate.waiters) + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "queued": self.queued(),
+            "queue_size": self.queue_size,
+            "create_qps": self.create_qps,
+            "create_bucket": type(self.bucket).__name__,
+            "models": {
+                model: {
+                    "active": gate.active,
+                    "limit": gate.limit,
+                    "queued": len(gate.waiters),
+                    "avg_task_seconds": round(gate.avg_hold, 2),
+                    "paused_seconds": round(max(gate.paused_until - now, 0.0), 2)
+                }
+                for model, gate in self.gates.items()
+            }
+        }
@@ -0,0 +1,36 @@
+"""编码方式基准测试：比较各编码方式的输出大小和编码耗时
+
+以原有的PNG编码为基准，输出每个规格在各编码方式下的字节数、相对PNG节省的比例和编码耗时。
+
+用法:
+    python bench_encoding_profiles.py --quality 80
+"""
+import argparse
+
+import imaging
+from bench_image_executor import sample_image
+
+
+def main(quality, rounds: int):
+    image, plan = imaging.decode_working_image(sample_image(), imaging.DEFAULT_VARIANTS)
+    baseline = {}
+    print(f"{'编码方式':<14}{'规格':<8}{'字节数':>10}{'相对PNG':>10}{'编码耗时':>12}")
+    for name in imaging.ENCODING_PROFILES:
+        profile = imaging.resolve_profile(name, quality)
+        for spec in imaging.DEFAULT_VARIANTS:
+            suffix = spec.name
+            results = [imaging.render_variant(image, plan.boxes[suffix], plan.sizes[suffix], profile)
+                       for _ in range(rounds)]
+            data_size = len(results[0].data)
+            encode_ms = min(r.encode_seconds for r in results) * 1000
+            baseline.setdefault(suffix, data_size)
+            saved = 1 - data_size / baseline[suffix]
+            print(f"{name:<16}{suffix:<8}{data_size:>12}{saved:>10.1%}{encode_ms:>12.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比较各编码方式的输出大小和编码耗时")
+    parser.add_argument("--quality", type=int, default=None, help="有损编码质量，默认使用各编码方式的预设")
+    parser.add_argument("--rounds", type=int, default=3, help="每个组合重复编码次数，取最快一次")
+    args = parser.parse_args()
+    main(args.quality, args.rounds)
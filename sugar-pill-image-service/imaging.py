@@ -0,0 +1,323 @@
+"""图片处理：解码、裁剪、缩放和编码
+
+这里的处理函数都是同步的CPU密集计算，由 main.py 通过 iter_rendered_variants()
+放到线程池或进程池中执行，不能在事件循环里直接调用。模块本身没有副作用，
+进程池的子进程只需要导入这个模块。
+"""
+import asyncio
+import functools
+import io
+import math
+import multiprocessing
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+from PIL import Image
+
+# 取景方式：cover 居中裁剪铺满目标尺寸，contain 完整保留原图并等比缩放到目标尺寸以内
+FIT_MODES = ("cover", "contain")
+
+
+class VariantSpec(NamedTuple):
+    """一个输出规格"""
+    name: str
+    width: int
+    height: int
+    fit: str = "cover"
+    encoding: Optional[str] = None  # 编码方式，None 表示使用服务端配置
+
+
+# 默认为每张原图生成的规格
+DEFAULT_VARIANTS = (
+    VariantSpec("org", 1600, 896),
+    VariantSpec("card", 776, 435),
+    VariantSpec("cover", 1600, 300),
+)
+
+
+# 大比例缩小时先整数倍 reduce()，保证最后一步LANCZOS至少从目标分辨率的这么多倍开始缩放，
+# 效果和直接LANCZOS肉眼无差别（见Pillow文档中的 reducing_gap）
+REDUCING_GAP = 2.0
+
+Box = Tuple[float, float, float, float]
+
+
+class EncodingProfile(NamedTuple):
+    """一种输出编码方式"""
+    name: str
+    format: str  # Pillow 的 save() 格式名
+    extension: str  # S3 key 的扩展名
+    content_type: str
+    options: Dict[str, Any]  # 传给 save() 的参数
+
+
+# 可选的编码方式；quality 只对有损格式生效
+ENCODING_PROFILES = {
+    # 原有行为：默认压缩级别的PNG
+    "png": EncodingProfile("png", "PNG", "png", "image/png", {"compress_level": 6}),
+    # 最大压缩的PNG，文件更小但编码更慢
+    "png-optimized": EncodingProfile("png-optimized", "PNG", "png", "image/png", {"optimize": True}),
+    "webp": EncodingProfile("webp", "WEBP", "webp", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": EncodingProfile("jpeg", "JPEG", "jpg", "image/jpeg", {"quality": 85, "progressive": True, "optimize": True}),
+}
+
+
+class EncodedVariant(NamedTuple):
+    """一个编码完成的规格"""
+    data: bytes
+    profile: EncodingProfile
+    size: Tuple[int, int]
+    encode_seconds: float
+    # 同一位图用原有PNG编码的字节数，只在抽样测量时有值
+    baseline_bytes: Optional[int] = None
+
+
+def resolve_profile(name: str, quality: Optional[int] = None,
+                    png_compress_level: Optional[int] = None) -> EncodingProfile:
+    """按名称取编码方式，并应用质量或PNG压缩级别覆盖"""
+    profile = ENCODING_PROFILES.get(name)
+    if profile is None:
+        raise ValueError(f"不支持的编码方式: {name}，可选: {', '.join(ENCODING_PROFILES)}")
+    options = dict(profile.options)
+    if quality is not None and "quality" in options:
+        options["quality"] = quality
+    if png_compress_level is not None and "compress_level" in options:
+        options["compress_level"] = png_compress_level
+    return profile._replace(options=options)
+
+
+class ImageDecodeError(Exception):
+    """原图无法被Pillow解码"""
+
+
+class VariantPlan(NamedTuple):
+    """一组规格在某个原图尺寸下的处理方案，只和几何尺寸有关，可以缓存复用"""
+    draft_size: Tuple[int, int]  # JPEG draft() 请求的最小解码尺寸
+    reduce_box: Tuple[int, int, int, int]  # 所有规格取景框的并集，工作图只保留这部分
+    factor: int  # 工作图相对原图的整数缩小倍数，1 表示直接使用原图
+    boxes: Dict[str, Box]  # 各规格在工作图坐标系中的取景框
+    sizes: Dict[str, Tuple[int, int]]  # 各规格的实际输出尺寸
+
+
+def center_crop_box(src_size: Tuple[int, int], target_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """计算把原图居中裁剪到目标宽高比的裁剪框"""
+    src_w, src_h = src_size
+    target_w, target_h = target_size
+    src_ratio = src_w / src_h
+    target_ratio = target_w / target_h
+    if src_ratio > target_ratio:
+        # 原图更宽，裁掉两侧
+        new_w = int(src_h * target_ratio)
+        left = (src_w - new_w) // 2
+        return (left, 0, left + new_w, src_h)
+    # 原图更高，裁掉上下
+    new_h = int(src_w / target_ratio)
+    top = (src_h - new_h) // 2
+    return (0, top, src_w, top + new_h)
+
+
+def variant_geometry(src_size: Tuple[int, int], spec: VariantSpec) -> Tuple[Tuple[int, int, int, int], Tuple[int, int]]:
+    """返回一个规格在原图上的取景框和输出尺寸"""
+    if spec.fit == "contain":
+        # 完整保留原图，等比缩放到目标尺寸以内
+        scale = min(spec.width / src_size[0], spec.height / src_size[1])
+        size = (max(1, round(src_size[0] * scale)), max(1, round(src_size[1] * scale)))
+        return (0, 0, src_size[0], src_size[1]), size
+    return center_crop_box(src_size, (spec.width, spec.height)), (spec.width, spec.height)
+
+
+@functools.lru_cache(maxsize=64)
+def plan_variants(src_size: Tuple[int, int], specs: Tuple[VariantSpec, ...]) -> VariantPlan:
+    """计算各规格的取景框、输出尺寸、可用的JPEG draft尺寸和reduce倍数"""
+    geometry = {spec.name: variant_geometry(src_size, spec) for spec in specs}
+    boxes = {name: box for name, (box, _) in geometry.items()}
+    sizes = {name: size for name, (_, size) in geometry.items()}
+    # 放大倍数最大的规格决定工作图至少要保留多少分辨率
+    scale = max(sizes[name][0] / (box[2] - box[0]) for name, box in boxes.items())
+    keep = min(1.0, scale * REDUCING_GAP)
+    draft_size = (math.ceil(src_size[0] * keep), math.ceil(src_size[1] * keep))
+    factor = max(1, int(1 / keep))
+    if factor == 1:
+        return VariantPlan(draft_size, (0, 0) + tuple(src_size), 1, boxes, sizes)
+    reduce_box = (
+        min(b[0] for b in boxes.values()), min(b[1] for b in boxes.values()),
+        max(b[2] for b in boxes.values()), max(b[3] for b in boxes.values())
+    )
+    left, top = reduce_box[0], reduce_box[1]
+    working_boxes = {
+        name: ((b[0] - left) / factor, (b[1] - top) / factor, (b[2] - left) / factor, (b[3] - top) / factor)
+        for name, b in boxes.items()
+    }
+    return VariantPlan(draft_size, reduce_box, factor, working_boxes, sizes)
+
+
+def sniff_extension(data: bytes) -> str:
+    """按文件头判断原图格式，返回保存用的扩展名"""
+    if data.startswith(b"\x89PNG"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+
+def decode_image(data: bytes, specs: Optional[Sequence[VariantSpec]] = None) -> Image.Image:
+    """把下载到的图片字节解码为RGB位图
+
+    传入 specs 且原图是JPEG时，用 draft() 让解码器直接按1/2、1/4、1/8解码，
+    只保留这些规格实际需要的分辨率。
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if specs and image.format == "JPEG":
+            image.draft("RGB", plan_variants(image.size, tuple(specs)).draft_size)
+        image.load()
+        return image if image.mode == "RGB" else image.convert("RGB")
+    except Exception as e:
+        raise ImageDecodeError(str(e)) from e
+
+
+def prepare_working_image(image: Image.Image, specs: Sequence[VariantSpec]) -> Tuple[Image.Image, VariantPlan]:
+    """返回所有规格共用的工作图及处理方案（方案中的取景框以工作图为坐标系）
+
+    大图先裁到各规格取景框的并集并整数倍缩小，之后每个规格都从这张较小的工作图缩放。
+    """
+    plan = plan_variants(image.size, tuple(specs))
+    if plan.factor > 1:
+        return image.reduce(plan.factor, plan.reduce_box), plan
+    return image, plan
+
+
+def decode_working_image(data: bytes, specs: Sequence[VariantSpec]) -> Tuple[Image.Image, VariantPlan]:
+    """解码并准备工作图"""
+    return prepare_working_image(decode_image(data, specs), specs)
+
+
+def encode_image(image: Image.Image, profile: EncodingProfile) -> EncodedVariant:
+    """按编码方式编码一张位图，并记录编码耗时"""
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, format=profile.format, **profile.options)
+    return EncodedVariant(buffer.getvalue(), profile, image.size, time.perf_counter() - start)
+
+
+def render_variant(image: Image.Image, box: Box, size: Tuple[int, int],
+                   profile: EncodingProfile = ENCODING_PROFILES["png"],
+                   measure_baseline: bool = False) -> EncodedVariant:
+    """把工作图上的裁剪框缩放为一个规格并编码
+
+    resize(box=...) 直接读取裁剪区域，不再复制整图或生成中间裁剪图。
+    measure_baseline 为真时再用原有PNG编码一次，记录其字节数用于统计节省的大小。
+    """
+    img_resized = image.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+    encoded = encode_image(img_resized, profile)
+    if not measure_baseline:
+        return encoded
+    baseline = ENCODING_PROFILES["png"]
+    if profile == baseline:
+        return encoded._replace(baseline_bytes=len(encoded.data))
+    return encoded._replace(baseline_bytes=len(encode_image(img_resized, baseline).data))
+
+
+def share_working_image(data: bytes, specs: Sequence[VariantSpec]):
+    """解码并准备工作图，把像素复制到一块新的共享内存，调用方负责 close() 和 unlink()
+
+    返回 (共享内存, 模式, 工作图尺寸, 处理方案)。
+    """
+    image, plan = decode_working_image(data, specs)
+    raw = image.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=len(raw))
+    shm.buf[:len(raw)] = raw
+    return shm, image.mode, image.size, plan
+
+
+def render_shared_variant(shm_name: str, mode: str, image_size: Tuple[int, int], box: Box,
+                          size: Tuple[int, int], profile: EncodingProfile,
+                          measure_baseline: bool = False) -> EncodedVariant:
+    """进程池入口：直接在共享内存里的像素上生成一个规格，不复制整张位图"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = Image.frombuffer(mode, image_size, shm.buf, "raw", mode, 0, 1)
+        try:
+            return render_variant(image, box, size, profile, measure_baseline)
+        finally:
+            # 释放对共享内存的引用，否则 shm.close() 会报 BufferError
+            image.close()
+            del image
+    finally:
+        shm.close()
+
+
+def build_executor(kind: str, workers: int) -> Executor:
+    """创建图片处理执行器：'thread' 为线程池，'process' 为进程池"""
+    if kind == "process":
+        # 主进程里有HTTP和S3的后台线程，用spawn避免fork带锁的线程状态
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    raise ValueError(f"未知的图片处理执行器类型: {kind}")
+
+
+async def prime_executor(executor: Executor, workers: int):
+    """预先启动进程池的全部子进程，避免第一批图片承担进程启动开销"""
+    if isinstance(executor, ProcessPoolExecutor):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, _noop) for _ in range(workers)))
+
+
+def _noop():
+    return None
+
+
+async def iter_rendered_variants(executor: Executor, data: bytes, specs: Sequence[VariantSpec],
+                                 profiles: Optional[Dict[str, EncodingProfile]] = None,
+                                 baseline_sample_rate: float = 0.0):
+    """解码一次并准备工作图，各规格并行处理，按完成顺序产出 (规格名, EncodedVariant)
+
+    profiles 指定各规格的编码方式，未指定的规格使用PNG。
+    按 baseline_sample_rate 的比例抽样，额外测量原有PNG编码的大小（见 render_variant）。
+
+    调用方可以在拿到第一个规格后立即上传，和剩余规格的编码重叠。
+    """
+    loop = asyncio.get_running_loop()
+    shm = None
+    if isinstance(executor, ProcessPoolExecutor):
+        # 进程池：解码后的像素放进共享内存，只把名称传给子进程，避免pickle整张位图
+        shm, mode, image_size, plan = await asyncio.to_thread(share_working_image, data, specs)
+        render_one = functools.partial(render_shared_variant, shm.name, mode, image_size)
+    else:
+        image, plan = await loop.run_in_executor(executor, decode_working_image, data, specs)
+        render_one = functools.partial(render_variant, image)
+
+    profiles = profiles or {}
+
+    async def render(name):
+        profile = profiles.get(name, ENCODING_PROFILES["png"])
+        measure = random.random() < baseline_sample_rate
+        return name, await loop.run_in_executor(
+            executor, render_one, plan.boxes[name], plan.sizes[name], profile, measure
+        )
+
+    jobs = [asyncio.ensure_future(render(spec.name)) for spec in specs]
+    try:
+        for job in asyncio.as_completed(jobs):
+            yield await job
+    finally:
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+async def render_in_executor(executor: Executor, data: bytes, specs: Sequence[VariantSpec],
+                             profiles: Optional[Dict[str, EncodingProfile]] = None,
+                             baseline_sample_rate: float = 0.0) -> Dict[str, EncodedVariant]:
+    """在执行器中生成所有规格，返回 规格名 -> EncodedVariant"""
+    return {name: encoded async for name, encoded in
+            iter_rendered_variants(executor, data, specs, profiles, baseline_sample_rate)}
@@ -1,24 +1,39 @@
 from fastapi.staticfiles import StaticFiles
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Sequence, Tuple
 import asyncio
+import functools
 import requests
 import json
 import os
 import time
 import uuid
+import re
+import hashlib
+import math
+import socket
+from collections import OrderedDict
 from datetime import datetime
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 import logging
 import aiofiles
 from dotenv import load_dotenv
 import sys
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 import io
-from PIL import Image
+import imaging
+from task_store import build_task_store
+from poller import TaskPoller
+from webhooks import SecretSealer, WebhookDispatcher, check_callback_host, load_secret_key
+from admission import AdmissionController, AdmissionRejected, RateLimited, build_token_bucket, parse_retry_after
 
 
 # 加载环境变量
@@ -40,7 +55,13 @@ TASK_CONFIG = {
     "max_wait_seconds": 300,
     "check_interval": 3,
     "http_timeout": 10,
-    "max_retries": 3
+    "max_retries": 3,
+    "create_timeout": 30,
+    "download_timeout": 15,
+    "connect_timeout": 5,
+    "max_connections": int(os.getenv("HTTP_MAX_CONNECTIONS", "50")),
+    "max_keepalive_connections": int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+    "keepalive_expiry": float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
 }
 
 # 环境变量或默认值
@@ -52,6 +73,55 @@ S3_PREFIX = os.getenv("S3_PREFIX", "starrybook/image/blogs/")
 S3_REGION = os.getenv("S3_REGION", "ap-southeast-1")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+S3_UPLOAD_THREADS = int(os.getenv("S3_UPLOAD_THREADS", "4"))
+# 全局同时进行的S3上传数上限（所有任务共享）
+S3_MAX_INFLIGHT_UPLOADS = int(os.getenv("S3_MAX_INFLIGHT_UPLOADS", "16"))
+# 任务轮询：按各模型的历史完成耗时安排查询时间，间隔限制在 [POLL_MIN_INTERVAL, POLL_MAX_INTERVAL] 内
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.5"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "15"))
+# 同时进行的查询请求数上限
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "16"))
+# 准入控制：每个模型同时进行中的任务数、创建任务的QPS，以及等待名额的队列长度和最长等待秒数
+DASHSCOPE_MAX_CONCURRENT = int(os.getenv("DASHSCOPE_MAX_CONCURRENT", "2"))
+# 按模型覆盖并发上限，如 "wanx2.1-t2i-turbo=4,wanx2.1-t2i-plus=2"
+DASHSCOPE_MODEL_CONCURRENCY = os.getenv("DASHSCOPE_MODEL_CONCURRENCY", "")
+DASHSCOPE_CREATE_QPS = float(os.getenv("DASHSCOPE_CREATE_QPS", "2"))
+DASHSCOPE_CREATE_BURST = int(os.getenv("DASHSCOPE_CREATE_BURST", "2"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30"))
+# 查询任务状态的QPS上限，0表示不限
+DASHSCOPE_QUERY_QPS = float(os.getenv("DASHSCOPE_QUERY_QPS", "10"))
+DASHSCOPE_QUERY_BURST = int(os.getenv("DASHSCOPE_QUERY_BURST", "10"))
+# 配额计数方式：local（每个worker各自计数）或 sqlite（本机所有worker共用一份配额）
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "local").lower()
+# 图片处理执行器：thread（线程池）或 process（进程池，像素通过共享内存传递）
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "thread").lower()
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+# 默认编码方式（png / png-optimized / webp / jpeg），可按规格覆盖，如 "org=webp,card=webp,cover=jpeg"
+IMAGE_ENCODING = os.getenv("IMAGE_ENCODING", "png")
+IMAGE_ENCODING_VARIANTS = os.getenv("IMAGE_ENCODING_VARIANTS", "")
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY")) if os.getenv("IMAGE_QUALITY") else None
+# 只对 png 编码生效；png-optimized 总是使用最大压缩
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+# 按这个比例抽样，额外用原有PNG编码测量大小，/stats 据此估算各编码方式相对PNG节省的字节
+ENCODING_BASELINE_SAMPLE_RATE = float(os.getenv("ENCODING_BASELINE_SAMPLE_RATE", "0.05"))
+# 额外的预设规格，格式 "名称=宽x高[:取景方式][:编码]"，如 "thumb=320x180,square=512x512:contain:webp"
+IMAGE_VARIANT_PRESETS = os.getenv("IMAGE_VARIANT_PRESETS", "")
+# 请求中自定义规格的限制
+VARIANT_MIN_DIMENSION = 16
+VARIANT_MAX_DIMENSION = int(os.getenv("VARIANT_MAX_DIMENSION", "2400"))
+VARIANT_MAX_ASPECT_RATIO = float(os.getenv("VARIANT_MAX_ASPECT_RATIO", "8"))
+VARIANT_MAX_COUNT = int(os.getenv("VARIANT_MAX_COUNT", "8"))
+VARIANT_NAME_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+# S3上传配置：小图直接单次上传，超过阈值的文件分片并发上传
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=S3_UPLOAD_THREADS,
+    use_threads=True
+)
 
 # 检查环境变量是否成功加载
 if not API_KEY:
@@ -69,47 +139,482 @@ if not PUBLIC_URL_BASE:
     PUBLIC_URL_BASE = "http://118.178.87.173:8000"
     logger.info(f"使用默认公共URL: {PUBLIC_URL_BASE}")
 
+if IMAGE_ENCODING not in imaging.ENCODING_PROFILES:
+    logger.error(f"IMAGE_ENCODING 配置无效: {IMAGE_ENCODING}")
+    IMAGE_ENCODING = "png"
+    logger.info(f"使用默认编码方式: {IMAGE_ENCODING}")
+
+def validate_variant_spec(spec: imaging.VariantSpec):
+    """检查规格是否在允许范围内，不合法时抛出 ValueError"""
+    if not VARIANT_NAME_PATTERN.match(spec.name):
+        raise ValueError(f"规格名称不合法: {spec.name}（只能包含小写字母、数字、-、_，最长32个字符）")
+    for value in (spec.width, spec.height):
+        if not VARIANT_MIN_DIMENSION <= value <= VARIANT_MAX_DIMENSION:
+            raise ValueError(f"规格 {spec.name} 的尺寸必须在 {VARIANT_MIN_DIMENSION}-{VARIANT_MAX_DIMENSION} 像素之间")
+    if max(spec.width, spec.height) / min(spec.width, spec.height) > VARIANT_MAX_ASPECT_RATIO:
+        raise ValueError(f"规格 {spec.name} 的宽高比不能超过 {VARIANT_MAX_ASPECT_RATIO}")
+    if spec.fit not in imaging.FIT_MODES:
+        raise ValueError(f"规格 {spec.name} 的取景方式不支持: {spec.fit}，可选: {', '.join(imaging.FIT_MODES)}")
+    if spec.encoding is not None and spec.encoding not in imaging.ENCODING_PROFILES:
+        raise ValueError(f"规格 {spec.name} 的编码方式不支持: {spec.encoding}，可选: {', '.join(imaging.ENCODING_PROFILES)}")
+
+def parse_variant_preset(item: str) -> imaging.VariantSpec:
+    """解析一条预设规格配置，如 "thumb=320x180:contain:webp" """
+    name, _, definition = item.partition("=")
+    dimensions, *options = definition.split(":")
+    width, _, height = dimensions.partition("x")
+    spec = imaging.VariantSpec(
+        name.strip(), int(width), int(height),
+        options[0] if len(options) > 0 and options[0] else "cover",
+        options[1] if len(options) > 1 and options[1] else None
+    )
+    validate_variant_spec(spec)
+    return spec
+
+# 服务端规格注册表：默认规格加上环境变量中的预设规格，请求可以只按名称引用
+VARIANT_REGISTRY: Dict[str, imaging.VariantSpec] = {spec.name: spec for spec in imaging.DEFAULT_VARIANTS}
+for item in filter(None, (part.strip() for part in IMAGE_VARIANT_PRESETS.split(","))):
+    try:
+        preset = parse_variant_preset(item)
+        VARIANT_REGISTRY[preset.name] = preset
+    except ValueError as e:
+        logger.error(f"IMAGE_VARIANT_PRESETS 中的配置无效，已忽略: {item}, 原因: {str(e)}")
+
+# 按规格覆盖的编码方式
+variant_encodings: Dict[str, str] = {}
+for item in filter(None, (part.strip() for part in IMAGE_ENCODING_VARIANTS.split(","))):
+    suffix, _, encoding = item.partition("=")
+    if encoding.strip() in imaging.ENCODING_PROFILES:
+        variant_encodings[suffix.strip()] = encoding.strip()
+    else:
+        logger.error(f"IMAGE_ENCODING_VARIANTS 中的配置无效，已忽略: {item}")
+
+# 按模型覆盖的并发上限
+model_concurrency: Dict[str, int] = {}
+for item in filter(None, (part.strip() for part in DASHSCOPE_MODEL_CONCURRENCY.split(","))):
+    model, _, limit = item.partition("=")
+    if limit.strip().isdigit() and int(limit) > 0:
+        model_concurrency[model.strip()] = int(limit)
+    else:
+        logger.error(f"DASHSCOPE_MODEL_CONCURRENCY 中的配置无效，已忽略: {item}")
+
+def build_http_client(timeout: float, headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+    """创建带连接池的httpx客户端，连接在请求之间复用"""
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=httpx.Timeout(timeout, connect=TASK_CONFIG["connect_timeout"]),
+        limits=httpx.Limits(
+            max_connections=TASK_CONFIG["max_connections"],
+            max_keepalive_connections=TASK_CONFIG["max_keepalive_connections"],
+            keepalive_expiry=TASK_CONFIG["keepalive_expiry"]
+        )
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建任务跟踪集合和共享连接池，关闭时释放"""
+    logger.info("服务正在启动，初始化任务跟踪集合和HTTP连接池")
+    app.state.task_set = set()
+    # 灵积API（创建/查询任务）和结果图片下载（OSS）各用一个连接池
+    app.state.dashscope_client = build_http_client(
+        TASK_CONFIG["http_timeout"],
+        headers={"Authorization": f"Bearer {API_KEY}"}
+    )
+    app.state.download_client = build_http_client(TASK_CONFIG["download_timeout"])
+    logger.info(f"当前环境配置: API_KEY长度={len(API_KEY) if API_KEY else 0}, 存储目录={IMAGE_STORAGE_DIR}, PUBLIC_URL={PUBLIC_URL_BASE}")
+    logger.info(f"HTTP连接池配置: 最大连接数={TASK_CONFIG['max_connections']}, 保活连接数={TASK_CONFIG['max_keepalive_connections']}")
+    await warm_s3_client()
+    app.state.image_executor = imaging.build_executor(IMAGE_EXECUTOR, IMAGE_WORKERS)
+    # 上传线程池的大小即全局上传并发上限
+    app.state.upload_executor = ThreadPoolExecutor(max_workers=S3_MAX_INFLIGHT_UPLOADS, thread_name_prefix="s3-upload")
+    await imaging.prime_executor(app.state.image_executor, IMAGE_WORKERS)
+    logger.info(f"图片处理执行器: {IMAGE_EXECUTOR}, 工作线程/进程数: {IMAGE_WORKERS}")
+    app.state.webhook_client = build_http_client(WEBHOOK_TIMEOUT)
+    app.state.webhooks = WebhookDispatcher(
+        app.state.webhook_client,
+        WEBHOOK_DEAD_LETTER_PATH,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        workers=WEBHOOK_WORKERS,
+        max_attempts=WEBHOOK_MAX_ATTEMPTS,
+        allowed_hosts=WEBHOOK_ALLOWED_HOSTS
+    )
+    app.state.webhooks.start()
+    app.state.admission = AdmissionController(
+        max_concurrent=DASHSCOPE_MAX_CONCURRENT,
+        model_limits=model_concurrency,
+        queue_size=ADMISSION_QUEUE_SIZE,
+        max_wait=ADMISSION_MAX_WAIT,
+        create_qps=DASHSCOPE_CREATE_QPS,
+        bucket=build_token_bucket(QUOTA_BACKEND, QUOTA_DB_PATH, "create", DASHSCOPE_CREATE_QPS, DASHSCOPE_CREATE_BURST)
+    )
+    # 所有进行中的任务由一个轮询器统一查询
+    app.state.poller = TaskPoller(
+        poll_dashscope,
+        default_interval=TASK_CONFIG["check_interval"],
+        min_interval=POLL_MIN_INTERVAL,
+        max_interval=POLL_MAX_INTERVAL,
+        concurrency=POLL_CONCURRENCY,
+        max_errors=TASK_CONFIG["max_retries"],
+        rate_limiter=build_token_bucket(QUOTA_BACKEND, QUOTA_DB_PATH, "query", DASHSCOPE_QUERY_QPS, DASHSCOPE_QUERY_BURST)
+    )
+    logger.info(f"灵积配额: 创建 {DASHSCOPE_CREATE_QPS} QPS, 查询 {DASHSCOPE_QUERY_QPS} QPS, 计数方式 {QUOTA_BACKEND}")
+    app.state.poller.start()
+    # 恢复上次关闭时放弃的任务，之后定期续约和认领
+    logger.info(f"任务存储: {TASK_STORE}, worker: {WORKER_ID}")
+    reclaimed = await reclaim_stale_tasks()
+    if reclaimed:
+        logger.info(f"启动时认领了 {reclaimed} 个未完成的任务")
+    maintenance = asyncio.create_task(task_maintenance_loop())
+    try:
+        yield
+    finally:
+        maintenance.cancel()
+        pending = [t for t in app.state.task_set if not t.done()]
+        if pending:
+            logger.warning(f"服务关闭，取消 {len(pending)} 个未完成的后台任务")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await app.state.poller.stop()
+        # 已结束任务的回调尽量发完，发不完的写入死信
+        await app.state.webhooks.stop()
+        await app.state.webhook_client.aclose()
+        # 放弃本worker的未完成任务，让其他worker或重启后的服务立即认领
+        await store_call(task_status.release, WORKER_ID)
+        task_status.close()
+        await app.state.dashscope_client.aclose()
+        await app.state.download_client.aclose()
+        app.state.image_executor.shutdown(wait=False, cancel_futures=True)
+        app.state.upload_executor.shutdown(wait=True)
+        logger.info("HTTP连接池已关闭")
+
+# S3客户端缓存，按区域和凭证区分
+_s3_clients: Dict[tuple, Any] = {}
+_s3_clients_lock = threading.Lock()
+
+def get_s3_client(region: Optional[str] = None):
+    """获取进程内共享的S3客户端
+
+    boto3客户端是线程安全的，创建一次后所有上传路径共用，
+    避免每次上传都重新解析凭证和初始化endpoint。Session本身不是线程安全的，
+    所以创建过程放在锁内。
+    """
+    region = region or S3_REGION
+    key = (region, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    client = _s3_clients.get(key)
+    if client is None:
+        with _s3_clients_lock:
+            client = _s3_clients.get(key)
+            if client is None:
+                session = boto3.session.Session()
+                client = session.client(
+                    's3',
+                    region_name=region,
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        connect_timeout=5,
+                        read_timeout=30,
+                        retries={"max_attempts": 3, "mode": "standard"},
+                        tcp_keepalive=True
+                    )
+                )
+                _s3_clients[key] = client
+                logger.info(f"成功初始化S3客户端，区域: {region}, 连接池大小: {S3_MAX_POOL_CONNECTIONS}")
+    return client
+
+async def warm_s3_client():
+    """启动时预热S3客户端：解析凭证并建立到存储桶的连接"""
+    start = time.perf_counter()
+    try:
+        client = get_s3_client()
+        await asyncio.to_thread(client.head_bucket, Bucket=S3_BUCKET)
+        logger.info(f"S3客户端预热完成，耗时 {time.perf_counter() - start:.2f} 秒")
+    except Exception as e:
+        # 预热失败不影响启动，首次上传时会再次尝试
+        logger.warning(f"S3客户端预热失败: {str(e)}")
+
 # 初始化FastAPI应用（关键修改点）
 app = FastAPI(
     title="bailian_image_service",
     version="0.1.0",
     servers=[{"url": PUBLIC_URL_BASE, "description": "生产环境API服务"}],
-    openapi_url="/openapi.json"
+    openapi_url="/openapi.json",
+    lifespan=lifespan
 )
 
-@app.on_event("startup")
-async def init():
-    """初始化任务跟踪集合"""
-    logger.info("服务正在启动，初始化任务跟踪集合")
-    app.state.task_set = set()
-    logger.info(f"当前环境配置: API_KEY长度={len(API_KEY) if API_KEY else 0}, 存储目录={IMAGE_STORAGE_DIR}, PUBLIC_URL={PUBLIC_URL_BASE}")
-
-# 静态文件挂载
-app.mount("/images", StaticFiles(directory=IMAGE_STORAGE_DIR), name="images")
-
 # 创建存储目录
 os.makedirs(IMAGE_STORAGE_DIR, exist_ok=True)
 logger.info(f"确保图片存储目录存在: {IMAGE_STORAGE_DIR}")
 
+# 不对外公开的数据（原图、任务存储等）放在这里，不能位于 IMAGE_STORAGE_DIR（以 /images 公开）之内
+IMAGE_DATA_DIR = os.getenv("IMAGE_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+
+def ensure_private_path(name: str, path: str) -> str:
+    """确认 path 不在公开的静态目录下，否则拒绝启动"""
+    static_root = os.path.realpath(IMAGE_STORAGE_DIR)
+    resolved = os.path.realpath(path)
+    if resolved == static_root or resolved.startswith(static_root + os.sep):
+        raise RuntimeError(f"{name}={path} 位于公开的静态目录 {IMAGE_STORAGE_DIR} 之内，会被 /images 直接下载，请改到其他目录")
+    return path
+
+os.makedirs(ensure_private_path("IMAGE_DATA_DIR", IMAGE_DATA_DIR), exist_ok=True)
+
+# 按需生成规格：原图和生成结果都写入按总大小淘汰的磁盘缓存
+ORIGINALS_DIR = os.path.join(IMAGE_DATA_DIR, "originals")
+ORIGINALS_MAX_BYTES = int(float(os.getenv("ORIGINALS_MAX_MB", "4096")) * 1024 * 1024)
+VARIANT_CACHE_DIR = os.path.join(IMAGE_STORAGE_DIR, "cache")
+VARIANT_CACHE_MAX_BYTES = int(float(os.getenv("VARIANT_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+# 原图在S3上的备份前缀，为空则只保存在本地（超出 ORIGINALS_MAX_MB 被淘汰的原图无法再按需生成规格）；
+# 本地缺失时从这里取回
+ORIGINALS_S3_PREFIX = os.getenv("ORIGINALS_S3_PREFIX", "")
+ORIGINAL_EXTENSIONS = ("png", "jpg", "webp", "bin")
+# 按需接口支持的扩展名 -> 编码方式
+ON_DEMAND_FORMATS = {"png": "png", "webp": "webp", "jpg": "jpeg", "jpeg": "jpeg"}
+IMAGE_ID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class DiskLRUCache:
+    """按总大小限制的LRU磁盘缓存，保存原图和按需生成的规格
+
+    启动时按文件修改时间重建索引，命中时刷新修改时间，所以重启后仍大致保持LRU顺序。
+    多个worker共用同一目录时各自维护索引，读取前会确认文件仍然存在。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[bytes]:
+        """读取缓存内容，未命中返回None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.total_bytes -= size
+                self.misses += 1
+            return None
+        with self._lock:
+            if key not in self.entries:
+                # 其他worker写入的文件
+                self.entries[key] = len(data)
+                self.total_bytes += len(data)
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """写入缓存（先写临时文件再原子替换），必要时淘汰最久未使用的条目"""
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        # 至少保留刚写入的一条
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+variant_cache = DiskLRUCache(VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES)
+originals_cache = DiskLRUCache(ORIGINALS_DIR, ORIGINALS_MAX_BYTES)
+if not ORIGINALS_S3_PREFIX:
+    logger.warning("未配置 ORIGINALS_S3_PREFIX，超出 ORIGINALS_MAX_MB 被淘汰的原图无法再按需生成规格")
+# 正在生成中的按需规格，同一规格的并发请求共用一次生成
+inflight_renders: Dict[str, asyncio.Future] = {}
+
+DEFAULT_MODEL = "wanx2.1-t2i-turbo"
+
 # API端点
 CREATE_TASK_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis"
 QUERY_TASK_URL = "https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
 
-# 任务状态跟踪
-task_status = {}
+# 任务状态跟踪：终态任务保留 TASK_TTL_SECONDS 秒，总数超过 TASK_REGISTRY_MAX_SIZE 时淘汰最早完成的任务。
+# 调度器会在第二天恢复未完成的博客并重新查询任务，保留时间要长于这个恢复窗口
+TASK_REGISTRY_MAX_SIZE = int(os.getenv("TASK_REGISTRY_MAX_SIZE", "10000"))
+TASK_TTL_SECONDS = float(os.getenv("TASK_TTL_SECONDS", "172800"))
+# TASK_STORE=sqlite 时任务保存在共享的SQLite文件中，可以用 uvicorn --workers N 运行多个worker，重启也不丢任务
+TASK_STORE = os.getenv("TASK_STORE", "memory")
+TASK_STORE_PATH = ensure_private_path("TASK_STORE_PATH", os.getenv("TASK_STORE_PATH", os.path.join(IMAGE_DATA_DIR, "tasks.db")))
+# 每个worker定期为自己的未完成任务续约，超过 TASK_LEASE_SECONDS 未续约的任务由其他worker认领
+TASK_HEARTBEAT_INTERVAL = float(os.getenv("TASK_HEARTBEAT_INTERVAL", "10"))
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", "30"))
+if TASK_STORE not in ("memory", "sqlite"):
+    logger.warning(f"未知的 TASK_STORE: {TASK_STORE}，使用 memory")
+    TASK_STORE = "memory"
+# 多个worker各自持有一份进程内任务表，查询会随机落到不知道该任务的worker上
+IMAGE_SERVICE_WORKERS = int(os.getenv("IMAGE_SERVICE_WORKERS") or os.getenv("WEB_CONCURRENCY") or "1")
+if IMAGE_SERVICE_WORKERS > 1 and TASK_STORE == "memory":
+    raise RuntimeError(f"以 {IMAGE_SERVICE_WORKERS} 个worker运行时必须设置 TASK_STORE=sqlite，进程内任务表无法在worker之间共享")
+task_status = build_task_store(TASK_STORE, TASK_STORE_PATH, TASK_REGISTRY_MAX_SIZE, TASK_TTL_SECONDS)
+QUOTA_DB_PATH = ensure_private_path("QUOTA_DB_PATH", os.getenv("QUOTA_DB_PATH", os.path.join(IMAGE_DATA_DIR, "quota.db")))
+if QUOTA_BACKEND not in ("local", "sqlite"):
+    logger.warning(f"未知的 QUOTA_BACKEND: {QUOTA_BACKEND}，使用 local")
+    QUOTA_BACKEND = "local"
+# 当前worker的标识，用于任务续约和认领
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+# 长轮询 /task/{task_id}?wait= 允许的最长等待秒数，SSE连接的心跳间隔
+TASK_WAIT_MAX = float(os.getenv("TASK_WAIT_MAX", "60"))
+TASK_EVENTS_HEARTBEAT = float(os.getenv("TASK_EVENTS_HEARTBEAT", "15"))
+# 共享任务存储时任务可能由其他worker更新，本地收不到通知，等待方每隔这么久重新读一次
+TASK_WATCH_RECHECK = float(os.getenv("TASK_WATCH_RECHECK", "2")) if TASK_STORE == "sqlite" else None
+# 任务完成回调：投递队列长度、发送协程数、最多尝试次数、默认签名密钥和死信文件
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_DEAD_LETTER_PATH = ensure_private_path("WEBHOOK_DEAD_LETTER_PATH", os.getenv(
+    "WEBHOOK_DEAD_LETTER_PATH", os.path.join(IMAGE_DATA_DIR, "webhook_dead_letter.jsonl")
+))
+# 允许的回调主机，逗号分隔；为空时允许任意主机，但只能解析到公网地址
+WEBHOOK_ALLOWED_HOSTS = frozenset(
+    host.strip().lower() for host in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+)
+# 请求自带的回调密钥加密后才随任务保存，加密密钥放在这个文件里（不存在时自动生成）
+CALLBACK_SECRET_KEY_PATH = ensure_private_path("CALLBACK_SECRET_KEY_PATH", os.getenv(
+    "CALLBACK_SECRET_KEY_PATH", os.path.join(IMAGE_DATA_DIR, "callback_secret.key")
+))
+callback_sealer = SecretSealer(load_secret_key(CALLBACK_SECRET_KEY_PATH))
+
+
+class TaskEvents:
+    """任务状态变化通知：每个等待方持有一个 asyncio.Event，状态写入时唤醒该任务的所有等待方"""
+
+    def __init__(self):
+        self._waiters: Dict[str, set] = {}
+
+    def subscribe(self, task_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        self._waiters.setdefault(task_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, task_id: str, event: asyncio.Event):
+        waiters = self._waiters.get(task_id)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[task_id]
+
+    def notify(self, task_id: str):
+        for event in self._waiters.get(task_id, ()):
+            event.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {"watched_tasks": len(self._waiters), "waiters": sum(len(w) for w in self._waiters.values())}
+
+
+task_events = TaskEvents()
+
+async def store_call(func, *args, **kwargs):
+    """调用任务存储；SQLite存储可能等待其他worker的写锁，放到线程里执行，不阻塞事件循环"""
+    if task_status.blocking:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+async def update_task(task_id: str, status: str, **fields):
+    """写入任务状态，并唤醒等待该任务的长轮询和SSE连接"""
+    record = await store_call(task_status.set, task_id, status, **fields)
+    task_events.notify(task_id)
+    return record
+
+async def wait_for_task_change(task_id: str, record, timeout: float):
+    """等待任务状态相对 record 发生变化，最多等 timeout 秒，返回最新记录（任务已被淘汰时为None）"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    event = task_events.subscribe(task_id)
+    try:
+        while True:
+            latest = await store_call(task_status.get, task_id)
+            if latest is None or latest.status != record.status or latest.updated_at != record.updated_at:
+                return latest
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return latest
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, TASK_WATCH_RECHECK or remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        task_events.unsubscribe(task_id, event)
 
 
+class VariantRequest(BaseModel):
+    name: str = Field(..., description="规格名称；预设规格只填名称即可", example="card")
+    width: Optional[int] = Field(None, description="输出宽度", ge=VARIANT_MIN_DIMENSION, le=VARIANT_MAX_DIMENSION, example=776)
+    height: Optional[int] = Field(None, description="输出高度", ge=VARIANT_MIN_DIMENSION, le=VARIANT_MAX_DIMENSION, example=435)
+    fit: Optional[str] = Field(None, description="取景方式：cover（居中裁剪，默认）或 contain（完整保留，等比缩放）", example="cover")
+    format: Optional[str] = Field(None, description="该规格的编码方式，优先于请求的 encoding", example="webp")
+
 class ImageRequest(BaseModel):
     prompt: str = Field(..., description="图像生成提示词", example="一只可爱的猫咪在草地上玩耍")
     negative_prompt: str = Field("", description="负面提示词，指定不希望出现的内容", example="模糊, 低质量")
-    model: str = Field("wanx2.1-t2i-turbo", description="使用的模型名称", example="wanx2.1-t2i-turbo")
+    model: str = Field(DEFAULT_MODEL, description="使用的模型名称", example="wanx2.1-t2i-turbo")
     size: str = Field("1024*1024", description="图像尺寸", example="1024*1024")
     n: int = Field(1, description="生成图像数量", ge=1, le=4)
+    callback_url: Optional[str] = Field(None, description="任务结束（COMPLETED/FAILED/TIMEOUT）后接收最终结果的回调地址，须解析到公网地址或在 WEBHOOK_ALLOWED_HOSTS 中", example="https://example.com/hooks/image")
+    callback_secret: Optional[str] = Field(None, description="回调签名密钥，默认使用服务端配置的 WEBHOOK_SECRET")
+    encoding: Optional[str] = Field(None, description="输出编码：png、png-optimized、webp、jpeg，默认使用服务端配置", example="webp")
+    quality: Optional[int] = Field(None, description="有损编码（webp、jpeg）的质量", ge=1, le=100, example=80)
+    variants: Optional[List[VariantRequest]] = Field(None, description="需要生成的规格，默认生成 org、card、cover 三种")
 
 class ImageResponse(BaseModel):
     task_id: str
     status: str
     image_urls: List[str] = []
+    variants: Dict[str, List[str]] = {}
+    image_ids: List[str] = []
     error: Optional[str] = None
 
 
@@ -117,7 +622,6 @@ async def create_image_task(request: ImageRequest) -> str:
     """创建阿里云图像生成异步任务"""
     logger.info(f"开始创建图像任务，提示词: {request.prompt}")
     headers = {
-        "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json",
         "Accept": "application/json",
         "X-DashScope-Async": "enable"
@@ -134,21 +638,24 @@ async def create_image_task(request: ImageRequest) -> str:
     logger.debug(f"API请求体: {json.dumps(payload)}")
     
     try:
-        async with httpx.AsyncClient() as client:
-            logger.info(f"发送请求到阿里云API: {CREATE_TASK_URL}")
-            response = await client.post(
-                CREATE_TASK_URL,
-                headers=headers,
-                json=payload,
-                timeout=30.0
-            )
-            logger.info(f"阿里云API响应状态码: {response.status_code}")
-            response_json = response.json()
-            logger.debug(f"阿里云API响应内容: {json.dumps(response_json)}")
-            response.raise_for_status()
-            task_id = response_json["output"]["task_id"]
-            logger.info(f"成功创建任务，任务ID: {task_id}")
-            return task_id
+        client = app.state.dashscope_client
+        logger.info(f"发送请求到阿里云API: {CREATE_TASK_URL}")
+        response = await client.post(
+            CREATE_TASK_URL,
+            headers=headers,
+            json=payload,
+            timeout=TASK_CONFIG["create_timeout"]
+        )
+        logger.info(f"阿里云API响应状态码: {response.status_code}")
+        if response.status_code == 429:
+            logger.warning(f"阿里云API限流: {response.text}")
+            raise RateLimited(parse_retry_after(response.headers.get("Retry-After")))
+        response_json = response.json()
+        logger.debug(f"阿里云API响应内容: {json.dumps(response_json)}")
+        response.raise_for_status()
+        task_id = response_json["output"]["task_id"]
+        logger.info(f"成功创建任务，任务ID: {task_id}")
+        return task_id
     except httpx.TimeoutException:
         logger.error("请求阿里云API超时")
         raise HTTPException(status_code=504, detail="请求阿里云API超时")
@@ -157,27 +664,27 @@ async def create_image_task(request: ImageRequest) -> str:
         if hasattr(e, 'response') and e.response:
             logger.error(f"错误响应内容: {e.response.text}")
         raise HTTPException(status_code=500, detail=f"请求阿里云API失败: {str(e)}")
+    except RateLimited:
+        raise
     except Exception as e:
         logger.error(f"创建图像任务时发生未知错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"未知错误: {str(e)}")
 
 async def query_task(task_id: str) -> Dict[str, Any]:
-    """查询阿里云任务状态"""
+    """查询阿里云任务状态，与轮询器共用查询配额"""
     logger.info(f"开始查询任务状态，任务ID: {task_id}")
     try:
-        async with httpx.AsyncClient() as client:
-            url = QUERY_TASK_URL.format(task_id=task_id)
-            logger.info(f"发送请求到: {url}")
-            response = await client.get(
-                url,
-                headers={"Authorization": f"Bearer {API_KEY}"},
-                timeout=10.0
-            )
-            logger.info(f"查询响应状态码: {response.status_code}")
-            response_json = response.json()
-            logger.debug(f"查询响应内容: {json.dumps(response_json)}")
-            response.raise_for_status()
-            return response_json
+        if app.state.poller.rate_limiter is not None:
+            await app.state.poller.rate_limiter.acquire()
+        client = app.state.dashscope_client
+        url = QUERY_TASK_URL.format(task_id=task_id)
+        logger.info(f"发送请求到: {url}")
+        response = await client.get(url)
+        logger.info(f"查询响应状态码: {response.status_code}")
+        response_json = response.json()
+        logger.debug(f"查询响应内容: {json.dumps(response_json)}")
+        response.raise_for_status()
+        return response_json
     except httpx.TimeoutException:
         logger.error("查询任务状态超时")
         raise HTTPException(status_code=504, detail="查询任务状态超时")
@@ -190,7 +697,211 @@ async def query_task(task_id: str) -> Dict[str, Any]:
         logger.error(f"查询任务状态时发生未知错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"未知错误: {str(e)}")
 
-async def save_images(task_result: Dict[str, Any], prompt: str) -> List[str]:
+def resolve_variants(requested: Optional[List[VariantRequest]] = None) -> Tuple[imaging.VariantSpec, ...]:
+    """把请求中的规格按注册表补全并校验，未指定时返回默认规格"""
+    if not requested:
+        return imaging.DEFAULT_VARIANTS
+    if len(requested) > VARIANT_MAX_COUNT:
+        raise ValueError(f"一次最多请求 {VARIANT_MAX_COUNT} 种规格")
+    specs = []
+    for item in requested:
+        if any(spec.name == item.name for spec in specs):
+            raise ValueError(f"规格名称重复: {item.name}")
+        preset = VARIANT_REGISTRY.get(item.name)
+        width = item.width or (preset.width if preset else None)
+        height = item.height or (preset.height if preset else None)
+        if width is None or height is None:
+            raise ValueError(f"规格 {item.name} 不是预设规格，必须指定 width 和 height")
+        spec = imaging.VariantSpec(
+            item.name, width, height,
+            item.fit or (preset.fit if preset else "cover"),
+            item.format or (preset.encoding if preset else None)
+        )
+        validate_variant_spec(spec)
+        specs.append(spec)
+    return tuple(specs)
+
+def resolve_encoding_profiles(specs: Sequence[imaging.VariantSpec] = imaging.DEFAULT_VARIANTS,
+                              encoding: Optional[str] = None,
+                              quality: Optional[int] = None) -> Dict[str, imaging.EncodingProfile]:
+    """确定各规格的编码方式：规格自身的编码优先，其次是请求参数、按规格的环境变量配置，最后是默认配置"""
+    return {
+        spec.name: imaging.resolve_profile(
+            spec.encoding or encoding or variant_encodings.get(spec.name, IMAGE_ENCODING),
+            quality or IMAGE_QUALITY,
+            PNG_COMPRESS_LEVEL
+        )
+        for spec in specs
+    }
+
+# 编码统计，按编码方式汇总
+encoding_stats: Dict[str, Dict[str, float]] = {}
+
+def record_encoding(variant: imaging.EncodedVariant):
+    """记录一次编码的输出大小和耗时"""
+    stats = encoding_stats.setdefault(variant.profile.name, {
+        "count": 0, "bytes": 0, "raw_bytes": 0, "encode_seconds": 0.0,
+        "sampled": 0, "sampled_bytes": 0, "png_bytes": 0
+    })
+    stats["count"] += 1
+    stats["bytes"] += len(variant.data)
+    # 未压缩的RGB位图大小，用于计算压缩比
+    stats["raw_bytes"] += variant.size[0] * variant.size[1] * 3
+    stats["encode_seconds"] += variant.encode_seconds
+    if variant.baseline_bytes is not None:
+        stats["sampled"] += 1
+        stats["sampled_bytes"] += len(variant.data)
+        stats["png_bytes"] += variant.baseline_bytes
+
+def encoding_summary() -> Dict[str, Dict[str, float]]:
+    """编码统计汇总：平均大小、平均编码耗时，以及按抽样估算的相对原有PNG节省的字节"""
+    summary = {}
+    for name, stats in encoding_stats.items():
+        count = stats["count"] or 1
+        # 抽样中 实际大小/PNG大小 的比例推算到全部输出
+        size_vs_png = stats["sampled_bytes"] / stats["png_bytes"] if stats["png_bytes"] else None
+        summary[name] = {
+            "count": stats["count"],
+            "total_bytes": stats["bytes"],
+            "avg_bytes": round(stats["bytes"] / count),
+            "png_samples": stats["sampled"],
+            "size_vs_png": round(size_vs_png, 3) if size_vs_png else None,
+            "est_bytes_saved_vs_png": round(stats["bytes"] / size_vs_png - stats["bytes"]) if size_vs_png else None,
+            "compression_ratio": round(stats["raw_bytes"] / stats["bytes"], 2) if stats["bytes"] else None,
+            "avg_encode_ms": round(stats["encode_seconds"] / count * 1000, 1)
+        }
+    return summary
+
+async def upload_variant(s3_client, variant: imaging.EncodedVariant, s3_key: str, suffix: str,
+                         metadata: Dict[str, str]) -> Optional[str]:
+    """在上传线程池中上传一个规格，返回公开URL，失败返回None"""
+    logger.info(f"上传{suffix}图片到S3: {S3_BUCKET}/{s3_key}")
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            app.state.upload_executor,
+            functools.partial(
+                s3_client.upload_fileobj,
+                io.BytesIO(variant.data),
+                S3_BUCKET,
+                s3_key,
+                ExtraArgs={
+                    'ContentType': variant.profile.content_type,
+                    'CacheControl': 'max-age=31536000',
+                    'Metadata': metadata,
+                    'ACL': 'public-read'
+                },
+                Config=S3_TRANSFER_CONFIG
+            )
+        )
+        s3_url = f"https://{S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{s3_key}"
+        logger.info(f"{suffix}图片上传S3成功，URL: {s3_url}")
+        return s3_url
+    except Exception as e:
+        logger.error(f"上传{suffix}图片到S3失败: {str(e)}", exc_info=True)
+        return None
+
+def original_key(image_id: str) -> Optional[str]:
+    """返回本地缓存中原图的键，不存在返回None"""
+    for extension in ORIGINAL_EXTENSIONS:
+        key = f"{image_id}.{extension}"
+        if originals_cache.exists(key):
+            return key
+    return None
+
+async def store_original(s3_client, image_id: str, data: bytes):
+    """保存原图供按需生成规格使用：写入本地缓存，配置了 ORIGINALS_S3_PREFIX 时再备份到S3"""
+    try:
+        await asyncio.to_thread(originals_cache.put, f"{image_id}.{imaging.sniff_extension(data)}", data)
+        if ORIGINALS_S3_PREFIX:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                app.state.upload_executor,
+                functools.partial(
+                    s3_client.upload_fileobj, io.BytesIO(data), S3_BUCKET, f"{ORIGINALS_S3_PREFIX}{image_id}",
+                    Config=S3_TRANSFER_CONFIG
+                )
+            )
+    except Exception as e:
+        logger.error(f"保存原图 {image_id} 失败: {str(e)}", exc_info=True)
+
+async def load_original(image_id: str) -> bytes:
+    """读取原图：先找本地缓存，找不到时从S3备份取回并写回本地缓存"""
+    key = original_key(image_id)
+    data = await asyncio.to_thread(originals_cache.get, key) if key else None
+    if data is not None:
+        return data
+    if ORIGINALS_S3_PREFIX:
+        try:
+            s3_client = get_s3_client()
+            response = await asyncio.to_thread(
+                s3_client.get_object, Bucket=S3_BUCKET, Key=f"{ORIGINALS_S3_PREFIX}{image_id}"
+            )
+            data = await asyncio.to_thread(response["Body"].read)
+        except Exception as e:
+            logger.warning(f"从S3取回原图 {image_id} 失败: {str(e)}")
+        else:
+            await asyncio.to_thread(originals_cache.put, f"{image_id}.{imaging.sniff_extension(data)}", data)
+            return data
+    raise HTTPException(status_code=404, detail=f"原图不存在: {image_id}")
+
+async def save_result_image(client: httpx.AsyncClient, s3_client, i: int, img_url: str,
+                            specs: Sequence[imaging.VariantSpec],
+                            profiles: Dict[str, imaging.EncodingProfile]) -> List[Tuple[str, str, str]]:
+    """下载一张结果图，保存原图，生成各规格并边编码边上传
+
+    返回按规格顺序排列的 (图片ID, 规格名, URL)。
+    """
+    logger.info(f"开始下载图片 #{i}: {img_url}")
+    retry_count = 0
+    max_retries = TASK_CONFIG["max_retries"]
+    while retry_count < max_retries:
+        uploads = {}
+        try:
+            img_response = await client.get(img_url)
+            img_response.raise_for_status()
+            logger.info(f"成功下载图片 #{i}, 状态码: {img_response.status_code}, 大小: {len(img_response.content)} 字节")
+            # 生成唯一ID
+            unique_id = uuid.uuid4()
+            date_prefix = datetime.now().strftime("%Y%m%d")
+            metadata = {'generated-by': 'sugar-pill-image-service'}
+            # 原图保存和规格处理同时进行
+            uploads["original"] = asyncio.create_task(store_original(s3_client, str(unique_id), img_response.content))
+            # 用Pillow处理请求的规格（在线程池或进程池中执行），每个规格编码完成后立即开始上传
+            render_start = time.perf_counter()
+            try:
+                async for suffix, variant in imaging.iter_rendered_variants(
+                    app.state.image_executor, img_response.content, specs, profiles, ENCODING_BASELINE_SAMPLE_RATE
+                ):
+                    record_encoding(variant)
+                    logger.info(f"{suffix}图片编码完成: {variant.profile.name}, {len(variant.data)} 字节, "
+                                f"耗时 {variant.encode_seconds * 1000:.0f} 毫秒")
+                    s3_key = f"{S3_PREFIX}{date_prefix}/{unique_id}-{suffix}.{variant.profile.extension}"
+                    uploads[suffix] = asyncio.create_task(upload_variant(s3_client, variant, s3_key, suffix, metadata))
+            except imaging.ImageDecodeError as e:
+                logger.error(f"Pillow无法打开图片: {str(e)}", exc_info=True)
+                uploads.pop("original").cancel()
+                return []
+            logger.info(f"图片 #{i} 规格处理完成，耗时 {time.perf_counter() - render_start:.2f} 秒")
+            names = [spec.name for spec in specs if spec.name in uploads]
+            urls = await asyncio.gather(*(uploads[name] for name in names))
+            await uploads["original"]
+            return [(str(unique_id), name, url) for name, url in zip(names, urls) if url]
+        except Exception as e:
+            for task in uploads.values():
+                task.cancel()
+            retry_count += 1
+            logger.warning(f"图片 #{i} 处理失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
+            if retry_count >= max_retries:
+                logger.error(f"⚠️ 图片 #{i} 处理最终失败: {str(e)}", exc_info=True)
+            else:
+                await asyncio.sleep(1)
+    return []
+
+async def save_images(task_result: Dict[str, Any], prompt: str,
+                      specs: Sequence[imaging.VariantSpec] = imaging.DEFAULT_VARIANTS,
+                      profiles: Optional[Dict[str, imaging.EncodingProfile]] = None) -> List[Tuple[str, str, str]]:
+    """处理任务的全部结果图，返回按结果图和规格顺序排列的 (图片ID, 规格名, URL)"""
     logger.info(f"开始处理图片，任务结果包含结果数: {len(task_result.get('output', {}).get('results', []))}")
     s3_urls = []
     if "output" not in task_result or not task_result["output"].get("results"):
@@ -199,189 +910,218 @@ async def save_images(task_result: Dict[str, Any], prompt: str) -> List[str]:
 
     logger.info(f"找到 {len(task_result['output']['results'])} 张图片")
 
-    # 使用环境变量中的 S3 配置
-    s3_bucket = S3_BUCKET
-    s3_prefix = S3_PREFIX
-    s3_region = S3_REGION
     try:
-        s3_client = boto3.client(
-            's3', 
-            region_name=s3_region,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-        logger.info(f"成功初始化S3客户端，区域: {s3_region}")
+        s3_client = get_s3_client(S3_REGION)
     except Exception as e:
         logger.error(f"初始化S3客户端失败: {str(e)}", exc_info=True)
         return s3_urls
 
-    # 下载并处理图片，生成三种规格并上传
-    async with httpx.AsyncClient() as client:
-        for i, result in enumerate(task_result["output"]["results"]):
-            if not result.get("url"):
-                logger.warning(f"结果 #{i} 中没有URL字段")
-                continue
-            img_url = result["url"]
-            logger.info(f"开始下载图片 #{i}: {img_url}")
-            retry_count = 0
-            max_retries = 3
-            while retry_count < max_retries:
-                try:
-                    img_response = await client.get(img_url, timeout=15.0)
-                    img_response.raise_for_status()
-                    logger.info(f"成功下载图片 #{i}, 状态码: {img_response.status_code}, 大小: {len(img_response.content)} 字节")
-                    # 生成唯一ID
-                    unique_id = uuid.uuid4()
-                    date_prefix = datetime.now().strftime("%Y%m%d")
-                    metadata = {'generated-by': 'sugar-pill-image-service'}
-                    # 用Pillow处理三种规格
-                    try:
-                        image = Image.open(io.BytesIO(img_response.content)).convert("RGB")
-                    except Exception as e:
-                        logger.error(f"Pillow无法打开图片: {str(e)}", exc_info=True)
-                        break
-                    sizes = {
-                        "org": (1600, 896),
-                        "card": (776, 435),
-                        "cover": (1600, 300)
-                    }
-                    for suffix, size in sizes.items():
-                        img_copy = image.copy()
-                        # 居中裁剪到目标比例
-                        target_w, target_h = size
-                        src_w, src_h = img_copy.size
-                        src_ratio = src_w / src_h
-                        target_ratio = target_w / target_h
-                        if src_ratio > target_ratio:
-                            # 原图更宽，裁掉两侧
-                            new_w = int(src_h * target_ratio)
-                            left = (src_w - new_w) // 2
-                            right = left + new_w
-                            box = (left, 0, right, src_h)
-                        else:
-                            # 原图更高，裁掉上下
-                            new_h = int(src_w / target_ratio)
-                            top = (src_h - new_h) // 2
-                            bottom = top + new_h
-                            box = (0, top, src_w, bottom)
-                        img_cropped = img_copy.crop(box)
-                        img_resized = img_cropped.resize((target_w, target_h), Image.LANCZOS)
-                        buffer = io.BytesIO()
-                        img_resized.save(buffer, format="PNG")
-                        buffer.seek(0)
-                        filename = f"{unique_id}-{suffix}.png"
-                        s3_key = f"{s3_prefix}{date_prefix}/{filename}"
-                        logger.info(f"上传{suffix}图片到S3: {s3_bucket}/{s3_key}")
-                        try:
-                            s3_client.upload_fileobj(
-                                buffer,
-                                s3_bucket,
-                                s3_key,
-                                ExtraArgs={
-                                    'ContentType': 'image/png',
-                                    'CacheControl': 'max-age=31536000',
-                                    'Metadata': metadata,
-                                    'ACL': 'public-read'
-                                }
-                            )
-                            s3_url = f"https://{s3_bucket}.s3.{s3_region}.amazonaws.com/{s3_key}"
-                            s3_urls.append(s3_url)
-                            logger.info(f"{suffix}图片上传S3成功，URL: {s3_url}")
-                        except Exception as e:
-                            logger.error(f"上传{suffix}图片到S3失败: {str(e)}", exc_info=True)
-                    break  # 成功处理一张原图后退出重试
-                except Exception as e:
-                    retry_count += 1
-                    logger.warning(f"图片 #{i} 处理失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
-                    if retry_count >= max_retries:
-                        logger.error(f"⚠️ 图片 #{i} 处理最终失败: {str(e)}", exc_info=True)
-                    else:
-                        await asyncio.sleep(1)
+    # 各张结果图并行下载、处理并上传，上传总数受上传线程池限制
+    client = app.state.download_client
+    jobs = []
+    for i, result in enumerate(task_result["output"]["results"]):
+        if not result.get("url"):
+            logger.warning(f"结果 #{i} 中没有URL字段")
+            continue
+        jobs.append(save_result_image(
+            client, s3_client, i, result["url"], specs, profiles or resolve_encoding_profiles(specs)
+        ))
+    for urls in await asyncio.gather(*jobs):
+        s3_urls.extend(urls)
     logger.info(f"图片处理完成，共上传到S3 {len(s3_urls)} 张图片")
     return s3_urls
 
-async def process_task_background(task_id: str, prompt: str):
+async def poll_dashscope(task_id: str) -> Dict[str, Any]:
+    """供轮询器调用的单次任务查询，响应格式不对时抛出异常"""
+    response = await app.state.dashscope_client.get(QUERY_TASK_URL.format(task_id=task_id))
+    result = response.json()
+    logger.debug(f"查询结果: {json.dumps(result)}")
+    if "output" not in result:
+        logger.error(f"无效的响应格式: {json.dumps(result)}")
+        raise ValueError("Invalid response format")
+    return result
+
+async def process_task_background(task_id: str, prompt: str,
+                                  specs: Sequence[imaging.VariantSpec] = imaging.DEFAULT_VARIANTS,
+                                  profiles: Optional[Dict[str, imaging.EncodingProfile]] = None,
+                                  started_at: Optional[float] = None, model: str = DEFAULT_MODEL,
+                                  callback_url: Optional[str] = None, callback_secret: Optional[str] = None):
+    """等待任务结束并保存结果；started_at 为认领的旧任务的创建时间，超时从那时算起
+
+    指定了 callback_url 时，任务结束后把最终状态交给回调投递队列。
+    """
     logger.info(f"开始后台处理任务: {task_id}, 提示词: {prompt}")
-    max_wait_seconds = 300
-    check_interval = 3
-    start_time = time.time()
-    
-    # 初始化时包含task_id
-    task_status[task_id] = {"task_id": task_id, "status": "PROCESSING", "image_urls": []}
-    logger.info(f"任务 {task_id} 状态已初始化为 'PROCESSING'")
-    
-    async with httpx.AsyncClient() as client:
-        while time.time() - start_time < max_wait_seconds:
-            try:
-                logger.info(f"查询任务 {task_id} 状态, 已等待 {int(time.time() - start_time)} 秒")
-                response = await client.get(
-                    QUERY_TASK_URL.format(task_id=task_id),
-                    headers={"Authorization": f"Bearer {API_KEY}"}
-                )
-                result = response.json()
-                logger.debug(f"查询结果: {json.dumps(result)}")
-                
-                if "output" not in result:
-                    logger.error(f"无效的响应格式: {json.dumps(result)}")
-                    raise ValueError("Invalid response format")
-                
-                status = result["output"]["task_status"]
-                logger.info(f"任务 {task_id} 状态: {status}")
-                
-                if status == "SUCCEEDED":
-                    logger.info(f"任务 {task_id} 成功完成")
-                    if "results" in result["output"]:
-                        results_count = len(result["output"].get("results", []))
-                        logger.info(f"开始保存图片，结果数量: {results_count}")
-                        image_urls = await save_images(result, prompt)
-                        logger.info(f"图片保存完成，URL: {image_urls}")
-                        task_status[task_id] = {"task_id": task_id, "status": "COMPLETED", "image_urls": image_urls}
-                    else:
-                        logger.warning(f"任务 {task_id} 成功但没有结果")
-                        task_status[task_id] = {"task_id": task_id, "status": "FAILED", "error": "No results in response"}
-                    return
-                elif status == "FAILED":
-                    error_msg = result["output"].get("error", {}).get("message", "Unknown error")
-                    logger.error(f"任务 {task_id} 失败: {error_msg}")
-                    task_status[task_id] = {"task_id": task_id, "status": "FAILED", "error": error_msg}
-                    return
-                elif status in ["PENDING", "RUNNING"]:
-                    logger.info(f"任务 {task_id} 进行中: {status}，等待 {check_interval} 秒")
-                    await asyncio.sleep(check_interval)
-                    continue
-                else:
-                    logger.warning(f"任务 {task_id} 未知状态: {status}")
-                    task_status[task_id] = {"task_id": task_id, "status": "FAILED", "error": f"Unknown status: {status}"}
-                    return
-                    
-            except Exception as e:
-                logger.error(f"处理任务 {task_id} 时出错: {str(e)}", exc_info=True)
-                task_status[task_id] = {"task_id": task_id, "status": "FAILED", "error": str(e)}
-                return
-                
+    max_wait_seconds = TASK_CONFIG["max_wait_seconds"]
+    start_time = started_at or time.time()
+    try:
+        # 轮询交给统一的轮询器，这里只等待结果；灵积上的任务结束后立即归还准入名额
+        try:
+            result = await app.state.poller.wait(task_id, model, max_wait_seconds, started_at)
+        finally:
+            app.state.admission.release(model, time.time() - start_time)
+        status = result["output"]["task_status"]
+        logger.info(f"任务 {task_id} 状态: {status}")
+
+        if status == "SUCCEEDED":
+            logger.info(f"任务 {task_id} 成功完成")
+            if "results" in result["output"]:
+                results_count = len(result["output"].get("results", []))
+                logger.info(f"开始保存图片，结果数量: {results_count}")
+                saved = await save_images(result, prompt, specs, profiles)
+                image_urls = [url for _, _, url in saved]
+                variants: Dict[str, List[str]] = {}
+                for _, name, url in saved:
+                    variants.setdefault(name, []).append(url)
+                image_ids = list(dict.fromkeys(image_id for image_id, _, _ in saved))
+                logger.info(f"图片保存完成，URL: {image_urls}")
+                await update_task(task_id, "COMPLETED", image_urls=image_urls, variants=variants, image_ids=image_ids)
+            else:
+                logger.warning(f"任务 {task_id} 成功但没有结果")
+                await update_task(task_id, "FAILED", error="No results in response")
+        elif status == "FAILED":
+            error_msg = result["output"].get("error", {}).get("message", "Unknown error")
+            logger.error(f"任务 {task_id} 失败: {error_msg}")
+            await update_task(task_id, "FAILED", error=error_msg)
+        else:
+            logger.warning(f"任务 {task_id} 未知状态: {status}")
+            await update_task(task_id, "FAILED", error=f"Unknown status: {status}")
+
+    except asyncio.TimeoutError:
         logger.warning(f"任务 {task_id} 处理超时，已等待 {max_wait_seconds} 秒")
-        task_status[task_id] = {"task_id": task_id, "status": "TIMEOUT", "error": "Task processing timeout"}
+        await update_task(task_id, "TIMEOUT", error="Task processing timeout")
+    except Exception as e:
+        logger.error(f"处理任务 {task_id} 时出错: {str(e)}", exc_info=True)
+        await update_task(task_id, "FAILED", error=str(e))
+
+    if callback_url:
+        record = await store_call(task_status.get, task_id)
+        if record is not None:
+            payload = ImageResponse(**record.to_dict()).dict()
+            app.state.webhooks.enqueue(callback_url, payload, callback_secret or WEBHOOK_SECRET)
+
+
+async def validate_callback_url(url: Optional[str]):
+    """回调地址必须是 http(s) 绝对地址，且主机在白名单内或只解析到公网地址"""
+    if url is None:
+        return
+    try:
+        parsed = httpx.URL(url)
+    except Exception:
+        parsed = None
+    if parsed is None or parsed.scheme not in ("http", "https") or not parsed.host:
+        raise ValueError(f"无效的 callback_url: {url}，必须是 http(s) 地址")
+    try:
+        await check_callback_host(url, WEBHOOK_ALLOWED_HOSTS)
+    except socket.gaierror as e:
+        raise ValueError(f"无法解析 callback_url 的主机 {parsed.host}: {str(e)}")
+
+def task_params(specs: Sequence[imaging.VariantSpec], encoding: Optional[str], quality: Optional[int],
+                model: str = DEFAULT_MODEL, callback_url: Optional[str] = None,
+                callback_secret: Optional[str] = None) -> Dict[str, Any]:
+    """任务恢复轮询所需的参数，保存在任务存储中；回调密钥只保存密文"""
+    return {
+        "variants": [spec._asdict() for spec in specs], "encoding": encoding, "quality": quality, "model": model,
+        "callback_url": callback_url,
+        "sealed_callback_secret": callback_sealer.seal(callback_secret) if callback_secret else None
+    }
+
+def start_background_task(task_id: str, prompt: str, specs: Sequence[imaging.VariantSpec],
+                          profiles: Optional[Dict[str, imaging.EncodingProfile]],
+                          started_at: Optional[float] = None, model: str = DEFAULT_MODEL,
+                          callback_url: Optional[str] = None, callback_secret: Optional[str] = None):
+    """创建并跟踪后台任务，任务完成后自动从集合中移除"""
+    task = asyncio.create_task(process_task_background(
+        task_id, prompt, specs, profiles, started_at, model, callback_url, callback_secret
+    ))
+    app.state.task_set.add(task)
+    task.add_done_callback(app.state.task_set.discard)
+    logger.info(f"已创建后台任务，当前任务集合大小: {len(app.state.task_set)}")
+
+async def reclaim_stale_tasks():
+    """认领续约过期的未完成任务（所属worker已退出），恢复轮询"""
+    claimed = await store_call(task_status.claim_stale, WORKER_ID, TASK_LEASE_SECONDS)
+    for task in claimed:
+        try:
+            specs = tuple(imaging.VariantSpec(**spec) for spec in task.params["variants"])
+            profiles = resolve_encoding_profiles(specs, task.params.get("encoding"), task.params.get("quality"))
+            sealed_secret = task.params.get("sealed_callback_secret")
+            # 旧版本保存的是明文 callback_secret
+            callback_secret = callback_sealer.unseal(sealed_secret) if sealed_secret else task.params.get("callback_secret")
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"无法恢复任务 {task.task_id}: {str(e)}")
+            await update_task(task.task_id, "FAILED", error=f"无法恢复任务参数: {str(e)}")
+            continue
+        logger.info(f"认领未完成的任务 {task.task_id}，已创建 {int(time.time() - task.created_at)} 秒")
+        model = task.params.get("model", DEFAULT_MODEL)
+        # 任务已经在灵积上运行，直接占用名额
+        app.state.admission.occupy(model)
+        start_background_task(task.task_id, task.prompt, specs, profiles, task.created_at, model,
+                              task.params.get("callback_url"), callback_secret)
+    return len(claimed)
 
+async def task_maintenance_loop():
+    """定期续约本worker的任务、认领其他worker遗留的任务、淘汰过期的终态任务"""
+    while True:
+        await asyncio.sleep(TASK_HEARTBEAT_INTERVAL)
+        try:
+            await store_call(task_status.heartbeat, WORKER_ID)
+            await reclaim_stale_tasks()
+            await store_call(task_status.sweep)
+        except Exception as e:
+            logger.error(f"任务存储维护失败: {str(e)}", exc_info=True)
+
+def rejection_response(e: AdmissionRejected) -> HTTPException:
+    """准入被拒绝时回复 429，附带预计的重试等待时间和排队位置"""
+    retry_after = max(math.ceil(e.retry_after), 1)
+    logger.warning(f"准入被拒绝: {e.reason}, 排队位置 {e.position}, 建议 {retry_after} 秒后重试")
+    return HTTPException(
+        status_code=429,
+        detail=f"{e.reason}，请 {retry_after} 秒后重试（排队位置 {e.position}）",
+        headers={"Retry-After": str(retry_after), "X-Queue-Position": str(e.position)}
+    )
+
+async def admit_and_create(request: ImageRequest) -> str:
+    """取得准入名额后创建灵积任务；创建失败时归还名额，成功后名额由后台任务在结束时归还"""
+    admission = app.state.admission
+    try:
+        await admission.acquire(request.model)
+    except AdmissionRejected as e:
+        raise rejection_response(e)
+    try:
+        return await admission.create(request.model, functools.partial(create_image_task, request))
+    except AdmissionRejected as e:
+        admission.release(request.model)
+        raise rejection_response(e)
+    except BaseException:
+        admission.release(request.model)
+        raise
 
 @app.post("/generate-image", response_model=ImageResponse)
 async def generate_image(request: ImageRequest):
     """修改后的生成图片接口（使用asyncio.create_task）"""
-    logger.info(f"收到完整请求: {request.dict()}")
+    logger.info(f"收到完整请求: {request.dict(exclude={'callback_secret'})}")
     try:
-        task_id = await create_image_task(request)
+        # 先校验规格和编码参数，避免无效请求白白生成图片
+        try:
+            specs = resolve_variants(request.variants)
+            profiles = resolve_encoding_profiles(specs, request.encoding, request.quality)
+            await validate_callback_url(request.callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        task_id = await admit_and_create(request)
         logger.info(f"成功创建阿里云任务，任务ID: {task_id}")
         
-        # 创建并跟踪后台任务
-        task = asyncio.create_task(
-            process_task_background(task_id, request.prompt)
-        )
-        app.state.task_set.add(task)
-        logger.info(f"已创建后台任务，当前任务集合大小: {len(app.state.task_set)}")
-        
-        # 任务完成后自动清理
-        task.add_done_callback(
-            lambda t: app.state.task_set.discard(t)
-        )
+        # 登记任务（连同恢复轮询所需的参数），再创建后台任务；登记失败时后台任务不会启动，由这里归还名额
+        try:
+            await store_call(task_status.create, task_id, request.prompt, task_params(
+                specs, request.encoding, request.quality, request.model, request.callback_url, request.callback_secret
+            ), WORKER_ID)
+        except BaseException:
+            app.state.admission.release(request.model)
+            raise
+        logger.info(f"任务 {task_id} 状态已初始化为 'PROCESSING'")
+        start_background_task(task_id, request.prompt, specs, profiles, model=request.model,
+                              callback_url=request.callback_url, callback_secret=request.callback_secret)
         
         return ImageResponse(
             task_id=task_id,
@@ -396,41 +1136,45 @@ async def generate_image(request: ImageRequest):
         logger.error(f"生成图像失败(Exception): {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"生成图像失败: {str(e)}")
 
-@app.get("/task/{task_id}", response_model=ImageResponse)
-async def get_task_status(task_id: str):
-    logger.info(f"获取任务状态: {task_id}")
+async def remote_task_response(task_id: str) -> ImageResponse:
+    """任务不在本地（从未提交过或已被淘汰）时从阿里云查询状态
+
+    本地记录已被淘汰时处理后的规格无从得知，成功的任务返回灵积的原图地址（灵积只保留24小时）。
+    """
+    logger.info(f"任务 {task_id} 不在本地任务表中，尝试从阿里云查询")
     try:
-        # 如果任务不在字典中
-        if task_id not in task_status:
-            logger.info(f"任务 {task_id} 不在本地状态字典中，尝试从阿里云查询")
-            # 尝试从阿里云获取状态
-            try:
-                result = await query_task(task_id)
-                status = result.get("output", {}).get("task_status", "UNKNOWN")
-                logger.info(f"从阿里云获取到任务状态: {status}")
-                return ImageResponse(
-                    task_id=task_id,
-                    status=status,
-                    image_urls=[],
-                    error=None
-                )
-            except Exception as e:
-                logger.error(f"任务状态查询失败: {str(e)}")
-                return ImageResponse(
-                    task_id=task_id,
-                    status="ERROR",
-                    image_urls=[],
-                    error=f"任务状态查询失败: {str(e)}"
-                )
-        
-        logger.info(f"任务 {task_id} 在本地状态字典中: {task_status[task_id]}")
-        # 直接创建ImageResponse对象
+        result = await query_task(task_id)
+        output = result.get("output", {})
+        status = output.get("task_status", "UNKNOWN")
+        logger.info(f"从阿里云获取到任务状态: {status}")
         return ImageResponse(
             task_id=task_id,
-            status=task_status[task_id].get("status", "UNKNOWN"),
-            image_urls=task_status[task_id].get("image_urls", []),
-            error=task_status[task_id].get("error")
+            status=status,
+            image_urls=[item["url"] for item in output.get("results", []) if item.get("url")],
+            error=output.get("message")
         )
+    except Exception as e:
+        logger.error(f"任务状态查询失败: {str(e)}")
+        return ImageResponse(
+            task_id=task_id,
+            status="ERROR",
+            image_urls=[],
+            error=f"任务状态查询失败: {str(e)}"
+        )
+
+@app.get("/task/{task_id}", response_model=ImageResponse)
+async def get_task_status(task_id: str,
+                          wait: float = Query(0, ge=0, le=TASK_WAIT_MAX,
+                                              description="长轮询：任务未结束时最多等待的秒数，状态一变化立即返回")):
+    logger.info(f"获取任务状态: {task_id}")
+    try:
+        record = await store_call(task_status.get, task_id)
+        if record is None:
+            return await remote_task_response(task_id)
+        if wait > 0 and not record.terminal:
+            record = await wait_for_task_change(task_id, record, wait) or record
+        logger.info(f"任务 {task_id} 在本地任务表中: {record}")
+        return ImageResponse(**record.to_dict())
     except Exception as e:
         logger.error(f"处理任务状态请求出错: {str(e)}")
         return ImageResponse(
@@ -440,6 +1184,36 @@ async def get_task_status(task_id: str):
             error=f"处理请求时出错: {str(e)}"
         )
 
+def format_task_event(data: Dict[str, Any]) -> str:
+    return f"event: status\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def task_event_stream(task_id: str, record):
+    """先推送当前状态，之后每次状态变化推送一次，任务结束后关闭；空闲时定期发送注释行保持连接"""
+    yield format_task_event(record.to_dict())
+    while not record.terminal:
+        latest = await wait_for_task_change(task_id, record, TASK_EVENTS_HEARTBEAT)
+        if latest is None:
+            yield format_task_event({"task_id": task_id, "status": "ERROR", "error": "任务已过期"})
+            return
+        if latest.status == record.status and latest.updated_at == record.updated_at:
+            yield ": ping\n\n"
+            continue
+        record = latest
+        yield format_task_event(record.to_dict())
+
+@app.get("/task/{task_id}/events")
+async def get_task_events(task_id: str):
+    """以 Server-Sent Events 推送任务状态变化，任务结束后关闭连接"""
+    record = await store_call(task_status.get, task_id)
+    if record is None:
+        response = await remote_task_response(task_id)
+        return StreamingResponse(iter([format_task_event(response.dict())]), media_type="text/event-stream")
+    return StreamingResponse(
+        task_event_stream(task_id, record),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/openapi.json", include_in_schema=False)
 async def get_openapi_spec():
     return {
@@ -478,6 +1252,13 @@ async def get_openapi_spec():
                                     "schema": {"$ref": "#/components/schemas/HTTPValidationError"}
                                 }
                             }
+                        },
+                        "429": {
+                            "description": "排队已满或灵积限流，按 Retry-After 头的秒数后重试",
+                            "headers": {
+                                "Retry-After": {"schema": {"type": "integer"}},
+                                "X-Queue-Position": {"schema": {"type": "integer"}}
+                            }
                         }
                     }
                 }
@@ -490,6 +1271,12 @@ async def get_openapi_spec():
                         "in": "path",
                         "required": True,
                         "schema": {"type": "string"}
+                    }, {
+                        "name": "wait",
+                        "in": "query",
+                        "required": False,
+                        "description": "长轮询：任务未结束时最多等待的秒数，状态一变化立即返回",
+                        "schema": {"type": "number", "minimum": 0, "maximum": TASK_WAIT_MAX, "default": 0}
                     }],
                     "responses": {
                         "200": {
@@ -502,6 +1289,23 @@ async def get_openapi_spec():
                         }
                     }
                 }
+            },
+            "/task/{task_id}/events": {
+                "get": {
+                    "summary": "订阅任务状态（SSE）",
+                    "parameters": [{
+                        "name": "task_id",
+                        "in": "path",
+                        "required": True,
+                        "schema": {"type": "string"}
+                    }],
+                    "responses": {
+                        "200": {
+                            "description": "text/event-stream，每次状态变化推送一个 status 事件（数据同 ImageResponse），任务结束后关闭",
+                            "content": {"text/event-stream": {"schema": {"type": "string"}}}
+                        }
+                    }
+                }
             }
         },
         "components": {
@@ -513,8 +1317,29 @@ async def get_openapi_spec():
                         "prompt": {"type": "string", "example": "一只可爱的猫咪"},
                         "negative_prompt": {"type": "string", "default": ""},
                         "model": {"type": "string", "default": "wanx2.1-t2i-turbo"},
+                        "callback_url": {"type": "string", "format": "uri", "nullable": True},
+                        "callback_secret": {"type": "string", "nullable": True},
                         "size": {"type": "string", "default": "1024*1024"},
-                        "n": {"type": "integer", "default": 1, "minimum": 1, "maximum": 4}
+                        "n": {"type": "integer", "default": 1, "minimum": 1, "maximum": 4},
+                        "encoding": {"type": "string", "enum": list(imaging.ENCODING_PROFILES), "nullable": True},
+                        "quality": {"type": "integer", "minimum": 1, "maximum": 100, "nullable": True},
+                        "variants": {
+                            "type": "array",
+                            "nullable": True,
+                            "maxItems": VARIANT_MAX_COUNT,
+                            "items": {"$ref": "#/components/schemas/VariantRequest"}
+                        }
+                    }
+                },
+                "VariantRequest": {
+                    "type": "object",
+                    "required": ["name"],
+                    "properties": {
+                        "name": {"type": "string", "example": "card"},
+                        "width": {"type": "integer", "minimum": VARIANT_MIN_DIMENSION, "maximum": VARIANT_MAX_DIMENSION},
+                        "height": {"type": "integer", "minimum": VARIANT_MIN_DIMENSION, "maximum": VARIANT_MAX_DIMENSION},
+                        "fit": {"type": "string", "enum": list(imaging.FIT_MODES)},
+                        "format": {"type": "string", "enum": list(imaging.ENCODING_PROFILES)}
                     }
                 },
                 "ImageResponse": {
@@ -524,6 +1349,11 @@ async def get_openapi_spec():
                         "task_id": {"type": "string"},
                         "status": {"type": "string"},
                         "image_urls": {"type": "array", "items": {"type": "string"}},
+                        "variants": {
+                            "type": "object",
+                            "additionalProperties": {"type": "array", "items": {"type": "string"}}
+                        },
+                        "image_ids": {"type": "array", "items": {"type": "string"}},
                         "error": {"type": "string", "nullable": True}
                     }
                 },
@@ -571,16 +1401,12 @@ async def plugin_manifest():
 async def test_s3_connection():
     """测试S3连接和配置"""
     try:
-        # 初始化S3客户端
-        s3_client = boto3.client(
-            's3', 
-            region_name=os.getenv("AWS_REGION", "ap-southeast-1"),
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
-        )
+        # 复用缓存的S3客户端
+        s3_client = get_s3_client(os.getenv("AWS_REGION", "ap-southeast-1"))
         
-        # 列出存储桶中的对象（最多10个）
-        response = s3_client.list_objects_v2(
+        # 列出存储桶中的对象（最多10个），放到线程中避免阻塞事件循环
+        response = await asyncio.to_thread(
+            s3_client.list_objects_v2,
             Bucket=os.getenv("S3_BUCKET", "sparkle-web-static"),
             Prefix=os.getenv("S3_PREFIX", "starrybook/image/blogs/"),
             MaxKeys=10
@@ -613,6 +1439,37 @@ async def test_s3_connection():
             "prefix": os.getenv("S3_PREFIX", "starrybook/image/blogs/"),
             "region": os.getenv("AWS_REGION", "ap-southeast-1")
         }
+@app.get("/variants")
+async def list_variants():
+    """可按名称引用的预设规格及自定义规格的限制"""
+    return {
+        "presets": {name: spec._asdict() for name, spec in VARIANT_REGISTRY.items()},
+        "default": [spec.name for spec in imaging.DEFAULT_VARIANTS],
+        "limits": {
+            "min_dimension": VARIANT_MIN_DIMENSION,
+            "max_dimension": VARIANT_MAX_DIMENSION,
+            "max_aspect_ratio": VARIANT_MAX_ASPECT_RATIO,
+            "max_variants": VARIANT_MAX_COUNT,
+            "fit_modes": list(imaging.FIT_MODES),
+            "encodings": list(imaging.ENCODING_PROFILES)
+        }
+    }
+
+@app.get("/stats")
+async def get_stats():
+    """服务运行统计"""
+    await store_call(task_status.sweep)
+    return {
+        "tasks": await store_call(task_status.stats),
+        "poller": app.state.poller.stats(),
+        "admission": app.state.admission.stats(),
+        "task_events": task_events.stats(),
+        "webhooks": app.state.webhooks.stats(),
+        "encoding": encoding_summary(),
+        "variant_cache": variant_cache.stats(),
+        "originals": originals_cache.stats()
+    }
+
 @app.get("/test-env")
 async def test_env():
     """测试环境变量加载情况"""
@@ -624,6 +1481,70 @@ async def test_env():
         "s3_prefix": os.getenv("S3_PREFIX", "未设置")
     }   
 
+async def render_and_cache(key: str, image_id: str, spec: imaging.VariantSpec, quality: Optional[int]) -> bytes:
+    """从原图生成一个按需规格并写入磁盘缓存"""
+    data = await load_original(image_id)
+    profiles = {spec.name: imaging.resolve_profile(spec.encoding, quality, PNG_COMPRESS_LEVEL)}
+    try:
+        variants = await imaging.render_in_executor(
+            app.state.image_executor, data, (spec,), profiles, ENCODING_BASELINE_SAMPLE_RATE
+        )
+    except imaging.ImageDecodeError as e:
+        logger.error(f"原图 {image_id} 无法解码: {str(e)}")
+        raise HTTPException(status_code=500, detail="原图无法解码")
+    variant = variants[spec.name]
+    record_encoding(variant)
+    await asyncio.to_thread(variant_cache.put, key, variant.data)
+    logger.info(f"按需生成规格完成: {key}, {len(variant.data)} 字节")
+    return variant.data
+
+async def render_on_demand(key: str, image_id: str, spec: imaging.VariantSpec, quality: Optional[int]) -> bytes:
+    """同一规格的并发请求只生成一次，其余请求等待同一个结果"""
+    future = inflight_renders.get(key)
+    if future is None:
+        future = asyncio.ensure_future(render_and_cache(key, image_id, spec, quality))
+        inflight_renders[key] = future
+        future.add_done_callback(lambda _: inflight_renders.pop(key, None))
+    # shield: 某个客户端断开时不能取消其他请求也在等待的生成
+    return await asyncio.shield(future)
+
+@app.get("/images/{image_id}/{width:int}x{height:int}.{fmt}")
+async def get_image_variant(request: Request, image_id: str, width: int, height: int, fmt: str,
+                            fit: str = Query("cover", description="取景方式：cover 或 contain"),
+                            quality: Optional[int] = Query(None, ge=1, le=100, description="有损编码质量")):
+    """按需生成原图的任意规格：首次请求时生成并写入磁盘缓存，之后直接返回缓存"""
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise HTTPException(status_code=404, detail=f"原图不存在: {image_id}")
+    fmt = fmt.lower()
+    if fmt not in ON_DEMAND_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {fmt}，可选: {', '.join(ON_DEMAND_FORMATS)}")
+    spec = imaging.VariantSpec("on-demand", width, height, fit, ON_DEMAND_FORMATS[fmt])
+    try:
+        validate_variant_spec(spec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 原图不可变，同一组参数的结果也不变，ETag 直接由参数决定
+    key = f"{image_id}-{width}x{height}-{fit}-q{quality or 'default'}.{fmt}"
+    headers = {
+        "ETag": f'"{hashlib.sha1(key.encode()).hexdigest()[:20]}"',
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if headers["ETag"] in request.headers.get("if-none-match", ""):
+        # ETag 只由参数决定，先确认这张原图确实存在（或生成过该规格），否则任意ID都会得到304
+        if original_key(image_id) is None and not variant_cache.exists(key):
+            await load_original(image_id)
+        return Response(status_code=304, headers=headers)
+
+    data = await asyncio.to_thread(variant_cache.get, key)
+    headers["X-Cache"] = "HIT" if data is not None else "MISS"
+    if data is None:
+        data = await render_on_demand(key, image_id, spec, quality)
+    return Response(content=data, media_type=imaging.ENCODING_PROFILES[spec.encoding].content_type, headers=headers)
+
+# 静态文件挂载，放在所有路由之后，避免覆盖 /images/{image_id}/... 按需规格接口
+app.mount("/images", StaticFiles(directory=IMAGE_STORAGE_DIR), name="images")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""集中式任务轮询
+
+所有进行中的灵积任务由一个 TaskPoller 统一轮询：任务按下次轮询时间放在一个最小堆里，
+单个循环只在堆顶任务到期时醒来，到期任务并发查询（数量有上限）。
+等待结果的协程只等待各自的 Future，不再各自持有定时器。
+
+任务登记时立即查询一次（认领来的旧任务可能早已结束），之后的轮询时间按模型的历史完成耗时安排：
+依次落在耗时分布的各个分位点上（约三成、六成、八成五的任务已完成的时间点）；
+超过 p85 仍未完成时按指数退避轮询。历史样本不足时退化为固定间隔轮询。
+到达截止时间时总会再查询一次，仍未结束才判定超时。
+"""
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RUNNING_STATUSES = frozenset({"PENDING", "RUNNING"})
+# 安排轮询时间用的分位点：点越多发现越及时，查询也越多
+POLL_QUANTILES = (0.3, 0.6, 0.85)
+DASHSCOPE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def reported_duration(output: Dict[str, Any]) -> Optional[float]:
+    """从灵积返回的 submit_time / end_time 计算任务实际耗时，比按发现完成的时间计算更准确"""
+    try:
+        submitted = datetime.strptime(output["submit_time"], DASHSCOPE_TIME_FORMAT)
+        ended = datetime.strptime(output["end_time"], DASHSCOPE_TIME_FORMAT)
+    except (KeyError, TypeError, ValueError):
+        return None
+    duration = (ended - submitted).total_seconds()
+    return duration if duration >= 0 else None
+
+
+class CompletionHistogram:
+    """某个模型最近若干次任务的完成耗时"""
+
+    def __init__(self, history: int = 200, min_samples: int = 5):
+        self.samples: Deque[float] = deque(maxlen=history)
+        self.min_samples = min_samples
+        self._quantiles: Optional[Tuple[float, ...]] = None
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._quantiles = None
+
+    def quantiles(self) -> Optional[Tuple[float, ...]]:
+        """POLL_QUANTILES 对应的耗时，样本不足返回None"""
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._quantiles is None:
+            ordered = sorted(self.samples)
+            self._quantiles = tuple(ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in POLL_QUANTILES)
+        return self._quantiles
+
+
+class PolledTask:
+    __slots__ = ("task_id", "model", "started_at", "deadline", "future", "polls", "errors", "backoff")
+
+    def __init__(self, task_id: str, model: str, started_at: float, deadline: float, future: asyncio.Future):
+        self.task_id = task_id
+        self.model = model
+        self.started_at = started_at
+        self.deadline = deadline
+        self.future = future
+        self.polls = 0
+        self.errors = 0
+        self.backoff = 0
+
+
+class TaskPoller:
+    """统一轮询所有进行中的任务
+
+    query(task_id) 返回灵积的查询结果；wait() 在任务进入终态时返回该结果，
+    超时抛出 asyncio.TimeoutError，连续查询失败 max_errors 次时抛出最后一次的异常。
+    rate_limiter 为可选的令牌桶（需有 acquire 协程方法），用来限制查询QPS。
+    """
+
+    def __init__(self, query: Callable[[str], Awaitable[Dict[str, Any]]], default_interval: float = 3,
+                 min_interval: float = 0.5, max_interval: float = 15, concurrency: int = 16,
+                 max_errors: int = 3, history: int = 200, time_func: Callable[[], float] = time.time,
+                 rate_limiter: Optional[Any] = None):
+        self.query = query
+        self.default_interval = default_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_errors = max_errors
+        self.history = history
+        self.time = time_func
+        self.rate_limiter = rate_limiter
+        self.histograms: Dict[str, CompletionHistogram] = {}
+        self.tasks: Dict[str, PolledTask] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: set = set()
+        self._runner: Optional[asyncio.Task] = None
+        self.queries = 0
+        self.completed = 0
+        self.detection_lag_total = 0.0
+        self.detection_lag_count = 0
+
+    def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+        for polled in self.tasks.values():
+            polled.future.cancel()
+        self.tasks.clear()
+
+    def histogram(self, model: str) -> CompletionHistogram:
+        histogram = self.histograms.get(model)
+        if histogram is None:
+            histogram = self.histograms[model] = CompletionHistogram(self.history)
+        return histogram
+
+    async def wait(self, task_id: str, model: str, timeout: float, started_at: Optional[float] = None) -> Dict[str, Any]:
+        """登记任务并等待其进入终态，返回最后一次查询结果"""
+        polled = self.tasks.get(task_id)
+        if polled is None:
+            started_at = started_at or self.time()
+            polled = PolledTask(task_id, model, started_at, started_at + timeout,
+                                asyncio.get_running_loop().create_future())
+            self.tasks[task_id] = polled
+            self._schedule(polled, 0)
+        # shield: 某个等待者被取消时不影响同一任务的其他等待者
+        return await asyncio.shield(polled.future)
+
+    def next_delay(self, polled: PolledTask) -> float:
+        """距下次轮询的秒数"""
+        elapsed = self.time() - polled.started_at
+        quantiles = self.histogram(polled.model).quantiles()
+        if quantiles is None:
+            delay = self.default_interval
+        else:
+            # 下一个还没到的分位点；都已过去则指数退避
+            index = bisect.bisect_right(quantiles, elapsed)
+            if index < len(quantiles):
+                delay = quantiles[index] - elapsed
+            else:
+                delay = self.default_interval * (2 ** polled.backoff)
+                polled.backoff += 1
+        delay = min(max(delay, self.min_interval), self.max_interval)
+        return min(delay, max(polled.deadline - self.time(), 0))
+
+    def _schedule(self, polled: PolledTask, delay: Optional[float] = None):
+        due = self.time() + (self.next_delay(polled) if delay is None else delay)
+        if not self._heap or due < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (due, next(self._counter), polled.task_id))
+
+    async def _run(self):
+        while True:
+            now = self.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, task_id = heapq.heappop(self._heap)
+                polled = self.tasks.get(task_id)
+                if polled is None:
+                    continue
+                await self._semaphore.acquire()
+                job = asyncio.create_task(self._poll(polled))
+                self._inflight.add(job)
+                job.add_done_callback(self._inflight.discard)
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - self.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _finish(self, polled: PolledTask, result: Optional[Dict[str, Any]] = None,
+                error: Optional[BaseException] = None):
+        self.tasks.pop(polled.task_id, None)
+        if polled.future.done():
+            return
+        if error is not None:
+            polled.future.set_exception(error)
+        else:
+            polled.future.set_result(result)
+
+    def _timeout(self, polled: PolledTask):
+        logger.warning(f"任务 {polled.task_id} 到达截止时间仍未结束，共轮询 {polled.polls} 次")
+        self._finish(polled, error=asyncio.TimeoutError(f"任务 {polled.task_id} 轮询超时"))
+
+    async def _poll(self, polled: PolledTask):
+        try:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            self.queries += 1
+            polled.polls += 1
+            try:
+                result = await self.query(polled.task_id)
+                status = result["output"]["task_status"]
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                polled.errors += 1
+                logger.warning(f"查询任务 {polled.task_id} 失败（第 {polled.errors} 次）: {str(e)}")
+                if polled.errors >= self.max_errors:
+                    self._finish(polled, error=e)
+                elif self.time() >= polled.deadline:
+                    self._timeout(polled)
+                else:
+                    self._schedule(polled, self.default_interval)
+                return
+            polled.errors = 0
+            if status in RUNNING_STATUSES:
+                # 截止前的最后一次查询已经做过
+                if self.time() >= polled.deadline:
+                    self._timeout(polled)
+                else:
+                    self._schedule(polled)
+                return
+            if status == "SUCCEEDED":
+                self._observe(polled, result["output"])
+            self.completed += 1
+            logger.info(f"任务 {polled.task_id} 进入终态 {status}，共轮询 {polled.polls} 次")
+            self._finish(polled, result)
+        finally:
+            self._semaphore.release()
+
+    def _observe(self, polled: PolledTask, output: Dict[str, Any]):
+        detected = self.time() - polled.started_at
+        duration = reported_duration(output)
+        if duration is None:
+            duration = detected
+        else:
+            self.detection_lag_total += max(detected - duration, 0)
+            self.detection_lag_count += 1
+        self.histogram(polled.model).observe(duration)
+
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for model, histogram in self.histograms.items():
+            quantiles = histogram.quantiles()
+            models[model] = {
+                "samples": len(histogram.samples),
+                "quantiles": dict(zip((f"p{int(q * 100)}" for q in POLL_QUANTILES), quantiles)) if quantiles else None
+            }
+        return {
+            "in_flight": len(self.tasks),
+            "queries": self.queries,
+            "completed": self.completed,
+            "queries_per_task": round(self.queries / self.completed, 2) if self.completed else None,
+            "avg_detection_lag_seconds": (round(self.detection_lag_total / self.detection_lag_count, 3)
+                                          if self.detection_lag_count else None),
+            "models": models
+        }
@@ -0,0 +1,324 @@
+"""任务状态存储
+
+TaskRegistry 是进程内的任务登记表：按 task_id O(1) 查询，记录使用 __slots__ 减小内存占用。
+终态（COMPLETED/FAILED/TIMEOUT）任务超过 TTL 后淘汰，总数超过上限时按完成先后淘汰最早的终态任务；
+处理中的任务不会被淘汰。
+
+SqliteTaskStore 把任务保存在本地SQLite（WAL模式）文件中，同一台机器上的多个worker共用，
+重启后也不会丢失。每个worker定期为自己负责的未完成任务续约，续约过期的任务
+（worker崩溃或重启）由其他worker认领并继续轮询。
+"""
+import abc
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional
+
+TERMINAL_STATUSES = frozenset({"COMPLETED", "FAILED", "TIMEOUT"})
+
+
+class TaskRecord:
+    """单个任务的状态"""
+    __slots__ = ("task_id", "status", "image_urls", "variants", "image_ids", "error", "updated_at")
+
+    def __init__(self, task_id: str, status: str, image_urls: Optional[List[str]] = None,
+                 variants: Optional[Dict[str, List[str]]] = None, image_ids: Optional[List[str]] = None,
+                 error: Optional[str] = None, updated_at: Optional[float] = None):
+        self.task_id = task_id
+        self.status = status
+        # 结果不再变化，用元组存放
+        self.image_urls = tuple(image_urls or ())
+        self.variants = {name: tuple(urls) for name, urls in (variants or {}).items()}
+        self.image_ids = tuple(image_ids or ())
+        self.error = error
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    @property
+    def terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def to_dict(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "status": self.status,
+            "image_urls": list(self.image_urls),
+            "variants": {name: list(urls) for name, urls in self.variants.items()},
+            "image_ids": list(self.image_ids),
+            "error": self.error
+        }
+
+    def __repr__(self) -> str:
+        return f"TaskRecord({self.task_id!r}, {self.status!r}, urls={len(self.image_urls)}, error={self.error!r})"
+
+
+class ClaimedTask(NamedTuple):
+    """被认领、需要继续轮询的任务"""
+    task_id: str
+    prompt: str
+    params: Dict[str, Any]
+    created_at: float
+
+
+class TaskStore(abc.ABC):
+    """任务存储接口
+
+    create 登记新任务（附带恢复轮询所需的参数），set 更新状态，get 查询。
+    heartbeat / release / claim_stale 用于多worker之间交接未完成的任务，单进程存储无需实现。
+    blocking 为True的存储可能等待其他进程的锁，调用方应放到线程里执行，不要直接在事件循环中调用。
+    """
+    blocking = False
+
+    def create(self, task_id: str, prompt: str, params: Dict[str, Any], owner: str) -> TaskRecord:
+        return self.set(task_id, "PROCESSING")
+
+    @abc.abstractmethod
+    def set(self, task_id: str, status: str, **fields) -> TaskRecord:
+        """写入任务的最新状态，返回新记录"""
+
+    @abc.abstractmethod
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        """查询任务，不存在或已过期返回None"""
+
+    def __contains__(self, task_id: str) -> bool:
+        return self.get(task_id) is not None
+
+    def heartbeat(self, owner: str):
+        """为 owner 负责的未完成任务续约"""
+
+    def release(self, owner: str):
+        """放弃 owner 负责的未完成任务，让其他worker立即认领"""
+
+    def claim_stale(self, owner: str, lease: float) -> List[ClaimedTask]:
+        """认领续约已超过 lease 秒的未完成任务"""
+        return []
+
+    def sweep(self):
+        """淘汰已过期的终态任务，供定期调用"""
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """存储的大小和淘汰计数"""
+
+    def close(self):
+        pass
+
+
+class TaskRegistry(TaskStore):
+    """有大小上限和TTL的进程内任务登记表"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records: Dict[str, TaskRecord] = {}
+        # 终态任务按完成时间排序，淘汰时从头部取，O(1)
+        self._terminal: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def set(self, task_id: str, status: str, **fields) -> TaskRecord:
+        """写入任务的最新状态，返回新记录"""
+        record = TaskRecord(task_id, status, **fields)
+        with self._lock:
+            self._records[task_id] = record
+            self._terminal.pop(task_id, None)
+            if record.terminal:
+                self._terminal[task_id] = record.updated_at
+            self._evict(record.updated_at)
+        return record
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        """查询任务，不存在或已过期返回None"""
+        record = self._records.get(task_id)
+        if record is not None and record.terminal and time.time() - record.updated_at > self.ttl:
+            with self._lock:
+                self._evict(time.time())
+            return None
+        return record
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _evict(self, now: float):
+        while self._terminal:
+            task_id, finished_at = next(iter(self._terminal.items()))
+            if now - finished_at > self.ttl:
+                self.expired += 1
+            elif len(self._records) > self.max_size:
+                self.evicted += 1
+            else:
+                break
+            self._terminal.popitem(last=False)
+            self._records.pop(task_id, None)
+
+    def sweep(self):
+        with self._lock:
+            self._evict(time.time())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "size": len(self._records),
+            "active": len(self._records) - len(self._terminal),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+
+class SqliteTaskStore(TaskStore):
+    """多个worker共用的SQLite任务存储
+
+    WAL模式下读不阻塞写，但写操作可能要等其他worker的写锁（最多30秒），所以标记为 blocking，
+    由调用方放到线程里执行。
+    """
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            result TEXT NOT NULL DEFAULT '{}',
+            prompt TEXT,
+            params TEXT,
+            owner TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status_updated ON tasks (status, updated_at);
+    """
+
+    def __init__(self, path: str, max_size: int = 10000, ttl: float = 3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.expired = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._terminal = tuple(TERMINAL_STATUSES)
+        self._terminal_marks = ",".join("?" * len(self._terminal))
+
+    def _execute(self, sql: str, args=()) -> int:
+        """执行写语句，返回影响的行数"""
+        with self._lock:
+            return self._conn.execute(sql, args).rowcount
+
+    def _query_one(self, sql: str, args=()) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, args).fetchone()
+
+    def create(self, task_id: str, prompt: str, params: Dict[str, Any], owner: str) -> TaskRecord:
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, prompt, params, owner, created_at, updated_at, heartbeat_at)"
+            " VALUES (?, 'PROCESSING', ?, ?, ?, ?, ?, ?)",
+            (task_id, prompt, json.dumps(params, ensure_ascii=False), owner, now, now, now)
+        )
+        return TaskRecord(task_id, "PROCESSING", updated_at=now)
+
+    def set(self, task_id: str, status: str, **fields) -> TaskRecord:
+        record = TaskRecord(task_id, status, **fields)
+        result = record.to_dict()
+        for key in ("task_id", "status"):
+            result.pop(key)
+        self._execute(
+            "INSERT INTO tasks (task_id, status, result, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(task_id) DO UPDATE SET status = excluded.status, result = excluded.result,"
+            " updated_at = excluded.updated_at",
+            (task_id, status, json.dumps(result, ensure_ascii=False), record.updated_at, record.updated_at)
+        )
+        return record
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        row = self._query_one("SELECT status, result, updated_at FROM tasks WHERE task_id = ?", (task_id,))
+        if row is None:
+            return None
+        status, result, updated_at = row
+        record = TaskRecord(task_id, status, updated_at=updated_at, **json.loads(result))
+        if record.terminal and time.time() - updated_at > self.ttl:
+            return None
+        return record
+
+    def heartbeat(self, owner: str):
+        self._execute(
+            f"UPDATE tasks SET heartbeat_at = ? WHERE owner = ? AND status NOT IN ({self._terminal_marks})",
+            (time.time(), owner, *self._terminal)
+        )
+
+    def release(self, owner: str):
+        self._execute(
+            f"UPDATE tasks SET heartbeat_at = 0 WHERE owner = ? AND status NOT IN ({self._terminal_marks})",
+            (owner, *self._terminal)
+        )
+
+    def claim_stale(self, owner: str, lease: float) -> List[ClaimedTask]:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE 先拿写锁，保证同一任务只会被一个worker认领
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT task_id, prompt, params, created_at FROM tasks"
+                    f" WHERE status NOT IN ({self._terminal_marks}) AND heartbeat_at < ? AND params IS NOT NULL",
+                    (*self._terminal, now - lease)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE tasks SET owner = ?, heartbeat_at = ? WHERE task_id = ?",
+                    [(owner, now, row[0]) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [ClaimedTask(task_id, prompt, json.loads(params), created_at)
+                for task_id, prompt, params, created_at in rows]
+
+    def sweep(self):
+        now = time.time()
+        expired = self._execute(
+            f"DELETE FROM tasks WHERE status IN ({self._terminal_marks}) AND updated_at < ?",
+            (*self._terminal, now - self.ttl)
+        )
+        excess = self._query_one("SELECT COUNT(*) FROM tasks")[0] - self.max_size
+        evicted = 0
+        if excess > 0:
+            evicted = self._execute(
+                f"DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks WHERE status IN ({self._terminal_marks})"
+                f" ORDER BY updated_at LIMIT ?)",
+                (*self._terminal, excess)
+            )
+        self.expired += expired
+        self.evicted += evicted
+
+    def stats(self) -> Dict[str, Any]:
+        size, active = self._query_one(
+            f"SELECT COUNT(*), COALESCE(SUM(status NOT IN ({self._terminal_marks})), 0) FROM tasks", self._terminal
+        )
+        return {
+            "backend": "sqlite",
+            "size": size,
+            "active": active,
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_task_store(kind: str, path: str, max_size: int, ttl: float) -> TaskStore:
+    """按配置创建任务存储：memory（进程内）或 sqlite（多worker共用）"""
+    if kind == "sqlite":
+        return SqliteTaskStore(path, max_size, ttl)
+    return TaskRegistry(max_size, ttl)
@@ -0,0 +1,294 @@
+"""任务完成回调
+
+任务结束后把最终状态 POST 到请求里的 callback_url。投递走一个有界队列，由固定数量的协程发送：
+失败按指数退避重试（遵守 Retry-After），重试耗尽、对方明确拒绝或队列已满的回调
+写入死信文件（每行一个JSON），方便排查和人工补发。
+
+配置了密钥时附带签名头：
+    X-Webhook-Timestamp: <unix秒>
+    X-Webhook-Signature: sha256=<hex(HMAC-SHA256(密钥, "<timestamp>." + 请求体))>
+同一回调的每次重试 X-Webhook-Id 相同，接收方可据此去重。
+
+回调地址在提交和每次投递前都会解析主机名，解析到本机、内网、链路本地（含云元数据地址）等
+非公网地址时拒绝，防止借回调访问内部服务。httpx 连接时会再解析一次，所以建立TCP连接后、
+发送请求前还会检查实际连上的地址，防止DNS重绑定绕过检查；重定向一律不跟随。
+配置了主机白名单时只允许名单内的主机。
+请求自带的签名密钥要随任务保存以便其他worker接手，保存前用服务端的密钥文件加密。
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Any, Collection, Dict, Optional
+
+import aiofiles
+import httpx
+from cryptography.fernet import Fernet, InvalidToken
+
+from admission import parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# 这些状态码重试也不会成功，直接进死信；重定向不跟随，同样视为失败
+PERMANENT_FAILURE_STATUSES = frozenset({301, 302, 303, 307, 308, 400, 401, 403, 404, 405, 410, 413, 422})
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+class UnsafeCallbackURL(ValueError):
+    """回调地址不在白名单中，或解析到了非公网地址"""
+
+
+async def check_callback_host(url: str, allowed_hosts: Collection[str] = ()):
+    """确认回调地址可以投递，否则抛出 UnsafeCallbackURL；主机名解析失败时抛出 socket.gaierror
+
+    allowed_hosts 非空时只允许名单内的主机（名单内的主机可以是内网地址），
+    否则要求主机名解析出的所有地址都是公网地址。
+    """
+    parsed = httpx.URL(url)
+    host = parsed.host.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise UnsafeCallbackURL(f"回调主机 {host} 不在 WEBHOOK_ALLOWED_HOSTS 中")
+        return
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        ensure_public_address(host, sockaddr[0])
+
+
+def ensure_public_address(host: str, address: str):
+    """address 不是公网地址时抛出 UnsafeCallbackURL"""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    if not ip.is_global or ip.is_multicast:
+        raise UnsafeCallbackURL(f"回调主机 {host} 解析到非公网地址 {ip}")
+
+
+def peer_guard(url: str, allowed_hosts: Collection[str] = ()):
+    """返回 httpx 的 trace 回调：TCP连接建立后、发送请求前检查实际连上的地址，白名单内的主机不检查"""
+    host = httpx.URL(url).host.lower()
+
+    async def trace(event: str, info: Dict[str, Any]):
+        if event != "connection.connect_tcp.complete" or host in allowed_hosts:
+            return
+        stream = info["return_value"]
+        try:
+            ensure_public_address(host, stream.get_extra_info("server_addr")[0])
+        except UnsafeCallbackURL:
+            await stream.aclose()
+            raise
+
+    return trace
+
+
+def load_secret_key(path: str) -> bytes:
+    """读取加密回调密钥用的服务端密钥，文件不存在时生成一个（仅所有者可读写），同机的worker共用"""
+    try:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    # 先写临时文件再硬链接到目标路径，多个worker同时启动时只有一个能创建成功，其余读取它写好的文件
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(Fernet.generate_key())
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(path, "rb") as f:
+        return f.read().strip()
+
+
+class SecretSealer:
+    """加密保存回调密钥，任务存储里只有密文"""
+
+    def __init__(self, key: bytes):
+        self._fernet = Fernet(key)
+
+    def seal(self, secret: str) -> str:
+        return self._fernet.encrypt(secret.encode()).decode()
+
+    def unseal(self, token: str) -> str:
+        """解密 seal 的结果，密钥不匹配或密文被改动时抛出 ValueError"""
+        try:
+            return self._fernet.decrypt(token.encode()).decode()
+        except InvalidToken:
+            raise ValueError("回调密钥无法解密，服务端密钥可能已更换")
+
+
+class WebhookDelivery:
+    __slots__ = ("delivery_id", "url", "body", "secret", "task_id", "attempts", "last_error")
+
+    def __init__(self, url: str, payload: Dict[str, Any], secret: Optional[str]):
+        self.delivery_id = uuid.uuid4().hex
+        self.url = url
+        self.body = json.dumps(payload, ensure_ascii=False).encode()
+        self.secret = secret
+        self.task_id = payload.get("task_id")
+        self.attempts = 0
+        self.last_error: Optional[str] = None
+
+
+class WebhookDispatcher:
+    """有界队列 + 固定数量发送协程的回调投递器"""
+
+    def __init__(self, client: httpx.AsyncClient, dead_letter_path: str, queue_size: int = 1000,
+                 workers: int = 4, max_attempts: int = 6, base_delay: float = 2, max_delay: float = 300,
+                 allowed_hosts: Collection[str] = ()):
+        self.client = client
+        self.dead_letter_path = dead_letter_path
+        self.allowed_hosts = allowed_hosts
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+        # 等待重试的投递，退避期间不占用发送协程
+        self._retries: set = set()
+        self._writes: set = set()
+        self._dead_letter_lock = asyncio.Lock()
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def enqueue(self, url: str, payload: Dict[str, Any], secret: Optional[str] = None) -> bool:
+        """加入投递队列；队列已满时写入死信并返回False"""
+        delivery = WebhookDelivery(url, payload, secret)
+        try:
+            self._queue.put_nowait(delivery)
+            return True
+        except asyncio.QueueFull:
+            delivery.last_error = "投递队列已满"
+            task = asyncio.create_task(self._dead_letter(delivery))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+            return False
+
+    async def stop(self, timeout: float = 10):
+        """等待队列中的回调发完（最多 timeout 秒），剩余的写入死信"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"回调队列未在 {timeout} 秒内发完，剩余 {self._queue.qsize()} 个写入死信")
+        for task in list(self._retries) + self._workers:
+            task.cancel()
+        await asyncio.gather(*self._retries, *self._workers, return_exceptions=True)
+        while not self._queue.empty():
+            delivery = self._queue.get_nowait()
+            delivery.last_error = delivery.last_error or "服务关闭时未发送"
+            await self._dead_letter(delivery)
+        await asyncio.gather(*self._writes, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            delivery = await self._queue.get()
+            try:
+                await self._attempt(delivery)
+            except Exception as e:
+                logger.error(f"回调投递出错: {str(e)}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _attempt(self, delivery: WebhookDelivery):
+        delivery.attempts += 1
+        headers = {
+            "Content-Type": "application/json",
+            "X-Webhook-Id": delivery.delivery_id,
+            "X-Webhook-Attempt": str(delivery.attempts)
+        }
+        if delivery.secret:
+            timestamp = str(int(time.time()))
+            headers["X-Webhook-Timestamp"] = timestamp
+            headers["X-Webhook-Signature"] = sign_payload(delivery.secret, timestamp, delivery.body)
+        retry_after = None
+        try:
+            # 提交之后DNS可能已被改成指向内网，每次投递前重新检查，连接建立后再核对实际地址
+            await check_callback_host(delivery.url, self.allowed_hosts)
+            response = await self.client.post(
+                delivery.url, content=delivery.body, headers=headers, follow_redirects=False,
+                extensions={"trace": peer_guard(delivery.url, self.allowed_hosts)}
+            )
+        except UnsafeCallbackURL as e:
+            delivery.last_error = str(e)
+            await self._dead_letter(delivery)
+            return
+        except (httpx.HTTPError, socket.gaierror) as e:
+            delivery.last_error = f"{type(e).__name__}: {str(e)}"
+        else:
+            if response.is_success:
+                self.delivered += 1
+                logger.info(f"任务 {delivery.task_id} 的回调已送达 {delivery.url}（第 {delivery.attempts} 次）")
+                return
+            delivery.last_error = f"HTTP {response.status_code}"
+            if response.status_code in PERMANENT_FAILURE_STATUSES:
+                await self._dead_letter(delivery)
+                return
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+        if delivery.attempts >= self.max_attempts:
+            await self._dead_letter(delivery)
+            return
+        delay = retry_after if retry_after is not None else self.base_delay * (2 ** (delivery.attempts - 1))
+        delay = min(delay, self.max_delay) * random.uniform(1.0, 1.2)
+        logger.warning(f"任务 {delivery.task_id} 的回调失败（{delivery.last_error}），{delay:.1f} 秒后重试")
+        self.retried += 1
+        task = asyncio.create_task(self._requeue(delivery, delay))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _requeue(self, delivery: WebhookDelivery, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # 服务关闭时还在等待重试的回调同样写入死信
+            await self._dead_letter(delivery)
+            raise
+        await self._queue.put(delivery)
+
+    async def _dead_letter(self, delivery: WebhookDelivery):
+        self.dead_lettered += 1
+        logger.error(f"任务 {delivery.task_id} 的回调写入死信: {delivery.url}, 尝试 {delivery.attempts} 次, 原因: {delivery.last_error}")
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "delivery_id": delivery.delivery_id,
+            "task_id": delivery.task_id,
+            "url": delivery.url,
+            "attempts": delivery.attempts,
+            "error": delivery.last_error,
+            "payload": json.loads(delivery.body)
+        }
+        try:
+            async with self._dead_letter_lock:
+                async with aiofiles.open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    await f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"写入回调死信失败: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "waiting_retry": len(self._retries),
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered
+        }